@@ -1,137 +1,244 @@
 #!/usr/bin/python3
 
-import dbus
-import dbus.exceptions
-import dbus.mainloop.glib
-import dbus.service
+# Imported first, the time from the process start to this import is the interpreter startup phase
+import gatt_example.gatt_base.gatt_lib_startup as gatt_startup
+
 import logging
 import atexit
-import time
-import threading
-
-from signal import signal, SIGTERM
-from sys import exit
-from logging.handlers import RotatingFileHandler
-
-try:
-    from gi.repository import GObject
-except ImportError:
-    import gobject as GObject
+import argparse
 
 import gatt_example.gatt_base.gatt_lib_variables as gatt_vars
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_registration as gatt_registration
 import gatt_example.gatt_base.gatt_lib_advertisement as gatt_adv
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+import gatt_example.gatt_base.gatt_lib_shutdown as gatt_shutdown
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_profiler as gatt_profiler
+import gatt_example.gatt_implementations.gatt_lib_cycling_power_encoder as gatt_cp_enc
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
 
-mainloop = None
+logger = gatt_log.get_logger('advertiser')
 
 
 class CyclingAdvertisements(gatt_adv.Advertisement):
 
-    def __init__(self, bus, index):
-        logger = logging.getLogger("rotating.logger")
+    CYCLING_POWER_UUID = '1818'
+
+    def __init__(self, bus, index, broadcast=False):
         gatt_adv.Advertisement.__init__(self, bus, index, 'peripheral')
+        self.power_broadcast = None
 
-        self.add_service_uuid('1818')
-        logger.debug('[%s] Adding cycling power advertisement', time.strftime('%d/%m %H:%M:%S'))
-        self.add_manufacturer_data(0xFFFF, [0x00, 0x01, 0x02, 0x03, 0x04])
-        # self.add_service_data('1818', [0x01,0x20,0x00]) #TODO: Find out what needs to be here
+        self.add_service_uuid(self.CYCLING_POWER_UUID)
+        logger.debug('[ADVERTISER] Adding cycling power advertisement')
+        # Broadcasting puts the measurement in the service data instead, both do not fit the legacy payload
+        if not broadcast:
+            self.add_manufacturer_data(0xFFFF, [0x00, 0x01, 0x02, 0x03, 0x04])
         self.add_local_name('DevName')
-        self.include_tx_power = True
+        self.set_include_tx_power(True)
+
+    def rotation_sets(self):
+        """
+        The cycling power advertisement and one pointing at the device information, advertised in turn.
+
+        """
+        device_information = gatt_adv.AdvertisementData()
+        device_information.add_service_uuid('180A')
+        device_information.add_manufacturer_data(0xFFFF, [0x00, 0x01, 0x02, 0x03, 0x04])
+        device_information.add_local_name('DevName')
+        return [self.data, device_information]
+
+    def stop_updates(self):
+        self.stop_rotation()
+        if self.power_broadcast is not None:
+            self.power_broadcast.stop()
+
+
+class PowerBroadcast(object):
+    """
+    Connectionless broadcast of the live power. Every period_ms the latest sample of the sample ring is encoded as a
+    Cycling Power Measurement (flags and instantaneous power) and published as the service data of the Cycling
+    Power service, through PropertiesChanged and only when it changed.
+
+    """
+
+    def __init__(self, advertisement, period_ms, sample_ring_path=None):
+        self.advertisement = advertisement
+        self.period_ms = period_ms
+        self.encoder = gatt_cp_enc.CyclingPowerMeasurementEncoder()
+        self.measurement_flags = 0x0000
+        self.sample = {'instantaneous_power': 0}
+        self.sample_reader = None
+        self.updates = 0
+        self.unchanged = 0
+        self._source = None
+
+        if sample_ring_path is not None:
+            try:
+                self.sample_reader = gatt_ring.SampleRingReader(sample_ring_path)
+            except (OSError, ValueError) as error:
+                logger.warning('[ADVERTISER] Could not open sample ring: %s', error)
+
+        advertisement.add_service_data(advertisement.CYCLING_POWER_UUID, self.encode())
+
+    def encode(self):
+        return self.encoder.encode(self.measurement_flags, self.sample)
+
+    def start(self):
+        logger.info('[ADVERTISER] Broadcasting the power every %d ms', self.period_ms)
+        self._source = gatt_backend.get_backend().timeout_add(self.period_ms, self.update)
+
+    def stop(self):
+        if self._source is not None:
+            gatt_backend.get_backend().source_remove(self._source)
+            self._source = None
+
+    def update(self):
+        if self.sample_reader is not None:
+            sample = self.sample_reader.latest()
+            if sample is not None:
+                power = int(sample.values[gatt_ring.CHANNEL_POWER])
+                self.sample['instantaneous_power'] = max(-0x8000, min(0x7FFF, power))
+
+        if self.advertisement.update_service_data(self.advertisement.CYCLING_POWER_UUID, self.encode()):
+            self.updates += 1
+        else:
+            self.unchanged += 1
+        return True
+
+
+def prepare_advertisement(advertisement):
+    """
+    Compile the advertisement, and the rotation sets when configured, return False when they do not fit.
+
+    """
+    try:
+        if gatt_config.advertising_rotation_ms:
+            advertisement.start_rotation(advertisement.rotation_sets(), gatt_config.advertising_rotation_ms)
+        compiled = advertisement.compile()
+    except ValueError as error:
+        logger.error('[ADVERTISER] Advertisement does not fit: %s', error)
+        return False
+
+    logger.info('[ADVERTISER] Advertising data %s', compiled.describe())
+    return True
 
 
 def register_ad_cb():
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] Advertisement registered', time.strftime('%d/%m %H:%M:%S'))
+    logger.info('[ADVERTISER] Advertisement registered')
+    gatt_startup.done('advertisement')
 
 
-def register_ad_error_cb(error):
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] Failed to register advertisement, Error : %s', time.strftime('%d/%m %H:%M:%S'), str(error))
+def add_advertisement(registrar, advertisement):
+    """
+    Keep advertisement registered through registrar, after the registrations added before it on the same adapter.
 
-    global mainloop
-    mainloop.quit()
+    """
+    registrar.add('advertisement', gatt_vars.LE_ADVERTISING_MANAGER_IFACE, 'RegisterAdvertisement',
+                  'UnregisterAdvertisement', advertisement.get_path(), register_ad_cb)
 
 
-def find_adapter(bus):
-    remote_om = dbus.Interface(bus.get_object(gatt_vars.BLUEZ_SERVICE_NAME, '/'),
-                               gatt_vars.DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+def create_advertisement(bus):
+    if not gatt_config.broadcast_ms:
+        return CyclingAdvertisements(bus, 0)
 
-    for o, props in objects.items():
-        if gatt_vars.LE_ADVERTISING_MANAGER_IFACE in props:
-            return o
-    return None
+    advertisement = CyclingAdvertisements(bus, 0, broadcast=True)
+    advertisement.power_broadcast = PowerBroadcast(advertisement, gatt_config.broadcast_ms,
+                                                   gatt_config.sample_ring_path)
+    advertisement.power_broadcast.start()
+    return advertisement
 
 
 def run_gatt_advertiser():
-    logger = logging.getLogger("rotating.logger")
-
-    global mainloop
 
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    backend = gatt_backend.get_backend()
 
-    bus = dbus.SystemBus()
+    bus = backend.connect_system_bus()
+    gatt_startup.mark('bus')
+    shutdown = gatt_shutdown.GracefulShutdown(bus).install()
+    exporter = gatt_metrics.start_exporter('advertiser')
+    if exporter is not None:
+        shutdown.on_stop(exporter.stop)
+    profiler = gatt_profiler.install('advertiser', bus)
+    shutdown.on_stop(profiler.stop)
 
-    adapter = find_adapter(bus)
-    if not adapter:
-        logger.debug('[%s] LEAdvertisingManager1 interface not found', time.strftime('%d/%m %H:%M:%S'))
+    cycling_advertisements = create_advertisement(bus)
+    if not prepare_advertisement(cycling_advertisements):
+        gatt_startup.status('Advertisement does not fit')
         return
-
-    adapter_props = dbus.Interface(bus.get_object(gatt_vars.BLUEZ_SERVICE_NAME, adapter),
-                                   "org.freedesktop.DBus.Properties");
-
-    adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-
-    ad_manager = dbus.Interface(bus.get_object(gatt_vars.BLUEZ_SERVICE_NAME, adapter),
-                                gatt_vars.LE_ADVERTISING_MANAGER_IFACE)
-
-    cycling_advertisements = CyclingAdvertisements(bus, 0)
     atexit.register(cycling_advertisements.Release)
+    gatt_startup.mark('export')
 
-    mainloop = GObject.MainLoop()
-    logger.debug('[%s] Mainloop started', time.strftime('%d/%m %H:%M:%S'))
+    registrar = gatt_registration.Registrar(bus, shutdown, gatt_config.all_adapters)
+    add_advertisement(registrar, cycling_advertisements)
+    registrar.start()
+    gatt_startup.mark('adapter')
 
-    ad_manager.RegisterAdvertisement(cycling_advertisements.get_path(), {},
-                                     reply_handler=register_ad_cb,
-                                     error_handler=register_ad_error_cb)
-    logger.debug('[%s] Registering advertisements', time.strftime('%d/%m %H:%M:%S'))
-
-    mainloop.run()
-
-
-def signal_handle(signum, frame):
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] SIGTERM Received, exiting', time.strftime('%d/%m %H:%M:%S'))
-    gatt_vars.sigterm_thread_exit = True
-
-    global mainloop
-    mainloop.quit()
-    sleep_time = 2
-    time.sleep(sleep_time)
-    exit(0)
+    shutdown.on_stop(cycling_advertisements.stop_updates)
+    logger.debug('[ADVERTISER] Mainloop started')
+    backend.run()
 
 
 def main():
-    GObject.threads_init()
-
-    # Catch SIGTERM and do a normal exit
-    signal(SIGTERM, signal_handle)
-
-    logger = logging.getLogger("rotating.logger")
-    log_file_bytes = 1048576 * 5
-    log_files = 3
-    logging_file = '/var/log/GattLogs/Gattadvertiser.log'
-    logger.setLevel(logging.DEBUG)
-    rotating_handler = RotatingFileHandler(logging_file, maxBytes=log_file_bytes, backupCount=log_files)
-    logger.addHandler(rotating_handler)
-    logger.debug('[%s] ----NEW RUN----', time.strftime('%d/%m %H:%M:%S'))
-
-    global mainloop
-
-    logger.debug('[%s] Initialising Gatt Advertiser', time.strftime('%d/%m %H:%M:%S'))
-    gatt_advertiser_thread = threading.Thread(target=run_gatt_advertiser)
-    gatt_advertiser_thread.start()
-
-    gatt_advertiser_thread.join()
+    gatt_startup.mark('imports')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-D", action="store_true")
+    parser.add_argument("-l", "--log-file", default='/var/log/GattLogs/Gattadvertiser.log')
+    parser.add_argument("-L", "--log-level", action="append", default=[], type=gatt_log.level_override,
+                        metavar="SUBSYSTEM=LEVEL",
+                        help="Log level of a single subsystem, may be repeated")
+    parser.add_argument("-a", "--all-adapters", action="store_true",
+                        help="Advertise on every adapter, including adapters plugged in later")
+    parser.add_argument("-b", "--backend", choices=sorted(gatt_backend.BACKENDS), default='glib',
+                        help="D-Bus backend, dbus-python on GLib or the wire protocol on asyncio")
+    advertising_mode = parser.add_mutually_exclusive_group()
+    advertising_mode.add_argument("-r", "--rotate", type=int, default=None, metavar="MS",
+                                  help="Rotate between the advertisement sets every MS milliseconds")
+    advertising_mode.add_argument("--broadcast", type=int, default=None, metavar="MS",
+                                  help="Broadcast the live power in the service data, updated every MS milliseconds")
+    parser.add_argument("-s", "--sample-ring", default=None, help="Shared memory sample ring written by a producer")
+    parser.add_argument("--profile-rate", type=int, default=None, metavar="HZ",
+                        help="Samples per second of the profiler started by SIGUSR1 and stopped by SIGUSR2")
+    parser.add_argument("--profile-dir", default=None, help="Directory the profiler writes its collapsed stacks to")
+    parser.add_argument("--metrics-socket", default=None, metavar="PATH",
+                        help="Serve the metrics in the Prometheus text format on this Unix socket")
+    parser.add_argument("--metrics-textfile", default=None, metavar="PATH",
+                        help="Write the metrics in the Prometheus text format to this file, for the textfile collector")
+    args = parser.parse_args()
+    backend = gatt_backend.set_backend(gatt_backend.BACKENDS[args.backend]())
+    if args.backend == 'glib':
+        backend.GObject.threads_init()
+    gatt_startup.mark('backend')
+    if args.all_adapters:
+        gatt_config.all_adapters = True
+    if args.rotate:
+        gatt_config.advertising_rotation_ms = args.rotate
+    if args.broadcast:
+        gatt_config.broadcast_ms = args.broadcast
+    if args.sample_ring:
+        gatt_config.sample_ring_path = args.sample_ring
+    if args.metrics_socket:
+        gatt_config.metrics_socket_path = args.metrics_socket
+    if args.metrics_textfile:
+        gatt_config.metrics_textfile_path = args.metrics_textfile
+    if args.profile_rate:
+        gatt_config.profiler_rate_hz = args.profile_rate
+    if args.profile_dir:
+        gatt_config.profiler_dir = args.profile_dir
+    if args.D:
+        gatt_config.log_level = logging.DEBUG
+    gatt_config.log_levels.update(gatt_log.parse_level_overrides(args.log_level))
+
+    gatt_log.setup_logging(args.log_file)
+    logger.info('[ADVERTISER] ----NEW RUN----')
+    gatt_startup.begin('advertiser', 'advertisement')
+
+    logger.info('[ADVERTISER] Initialising Gatt Advertiser')
+    # On the main thread, the shutdown runs on the main loop from SIGTERM and SIGINT
+    run_gatt_advertiser()
+    gatt_log.flush_logging()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1179 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import math
+import json
+import time
+import signal
+import socket
+import struct
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import array
+
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_implementations.gatt_lib_custom_transport as gatt_transport
+import gatt_example.gatt_implementations.gatt_lib_cycling_power_encoder as gatt_cp_enc
+import gatt_example.gatt_implementations.gatt_lib_revolutions as gatt_revolutions
+import gatt_example.gatt_testing.gatt_lib_fake_bluez as gatt_fake_bluez
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def histogram_quantile(buckets, quantile):
+    """
+    Quantile of a Prometheus histogram from its (upper bound, cumulative count) buckets, interpolated within the
+    bucket it falls in as histogram_quantile() does. In the +Inf bucket it is the largest finite bound.
+
+    """
+    buckets = sorted(buckets)
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = quantile * buckets[-1][1]
+    lower, below = 0.0, 0
+    for bound, count in buckets:
+        if count >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (count - below) if count > below else bound
+        lower, below = bound, count
+    return lower
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def process_cpu_time(pid):
+    """
+    User + system CPU seconds of a process, from /proc.
+
+    """
+    with open('/proc/%d/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def process_rss_kb(pid):
+    """
+    Resident set size of a process in kB, from /proc.
+
+    """
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def start_private_bus():
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'], stdout=subprocess.PIPE)
+    address = daemon.stdout.readline().decode().strip()
+    if not address:
+        daemon.kill()
+        raise RuntimeError('dbus-daemon did not report its address')
+    return daemon, address
+
+
+def module_log_file(module, work_dir):
+    return os.path.join(work_dir, module.rsplit('.', 1)[1] + '.log')
+
+
+def spawn(module, args, address, work_dir, environment=None, root=PACKAGE_ROOT, log=True):
+    """
+    Run module of the tree at root, this one by default, on the bus at address. With log its log file goes to
+    work_dir, log=False leaves -l out for the builds that do not have it.
+
+    """
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address, **(environment or {}))
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    log_args = ['-l', module_log_file(module, work_dir)] if log else []
+    return subprocess.Popen([sys.executable, '-m', module] + log_args + args, env=env, cwd=root)
+
+
+def stop(process, timeout=10.0):
+    if process is None or process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def read_startup_records(log_file):
+    records = []
+    try:
+        with open(log_file) as log:
+            for line in log:
+                if '[STARTUP] ' in line:
+                    records.append(json.loads(line.split('[STARTUP] ', 1)[1]))
+    except FileNotFoundError:
+        pass
+    return records
+
+
+async def measure_startup(bluez, module, module_args, address, work_dir, runs, timeout):
+    """
+    Cold start a daemon runs times with a NOTIFY_SOCKET, as systemd does for Type=notify, and time the READY=1.
+    The phases are the medians of the startup records the daemon logged.
+
+    """
+    loop = asyncio.get_running_loop()
+    notify_path = os.path.join(work_dir, 'notify.sock')
+    log_file = module_log_file(module, work_dir)
+    ready = []
+    records = []
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+        notify_socket.bind(notify_path)
+        notify_socket.setblocking(False)
+        try:
+            for _ in range(runs):
+                seen = len(read_startup_records(log_file))
+                start = time.monotonic()
+                process = spawn(module, module_args, address, work_dir, {'NOTIFY_SOCKET': notify_path})
+                try:
+                    while True:
+                        message = await asyncio.wait_for(loop.sock_recv(notify_socket, 4096), timeout)
+                        if 'READY=1' in message.decode().split('\n'):
+                            break
+                    ready.append((time.monotonic() - start) * 1e3)
+                    # The record goes through the log queue, it may land just after READY=1
+                    deadline = time.monotonic() + timeout
+                    while len(read_startup_records(log_file)) == seen and time.monotonic() < deadline:
+                        await asyncio.sleep(0.01)
+                    records.extend(read_startup_records(log_file)[seen:])
+                finally:
+                    process.kill()
+                    process.wait()
+                # The fake drops the registrations once it sees the process leave the bus
+                deadline = time.monotonic() + timeout
+                while (bluez.applications or bluez.advertisements) and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+        finally:
+            os.unlink(notify_path)
+
+    phases = {}
+    for record in records:
+        for phase, duration in record['phases_ms'].items():
+            phases.setdefault(phase, []).append(duration)
+    return {
+        'runs': runs,
+        'spawn_to_ready_p50_ms': percentile(ready, 50),
+        'spawn_to_ready_max_ms': max(ready),
+        'process_start_to_ready_p50_ms': percentile([record['total_ms'] for record in records], 50),
+        'phases_p50_ms': dict((phase, percentile(durations, 50)) for phase, durations in phases.items()),
+    }
+
+
+async def measure_reads(bluez, application, count):
+    results = {}
+    for path in application.characteristics('read'):
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            await bluez.read_value(application, path)
+            latencies.append((time.perf_counter() - start) * 1e6)
+        results[path] = {
+            'uuid': application.uuid(path),
+            'reads': count,
+            'p50_us': percentile(latencies, 50),
+            'p99_us': percentile(latencies, 99),
+        }
+    return results
+
+
+async def measure_notifications(bluez, application, pid, duration, acquire):
+    results = {}
+    for path in application.characteristics('notify'):
+        acquired = acquire and 'NotifyAcquired' in application.properties(path)
+        if acquired:
+            await bluez.acquire_notify(application, path)
+        else:
+            await bluez.start_notify(application, path)
+
+        key = (application.device_path, path)
+        before = bluez.notifications[key]
+        cpu_before = process_cpu_time(pid)
+        await asyncio.sleep(duration)
+        count = bluez.notifications[key] - before
+        cpu = process_cpu_time(pid) - cpu_before
+
+        if acquired:
+            bluez.release_notify(application, path)
+        else:
+            await bluez.stop_notify(application, path)
+
+        results[path] = {
+            'uuid': application.uuid(path),
+            'path': 'acquired' if acquired else 'signal',
+            'notifications_per_s': count / duration,
+            'cpu_per_notification_us': cpu / count * 1e6 if count else None,
+        }
+    return results
+
+
+async def measure_backends(bluez, server_args, address, work_dir, args):
+    """
+    The read and notification workload against the server run with each backend in turn, alone on the fake.
+
+    """
+    results = {}
+    for backend in ('glib', 'asyncio'):
+        process = spawn('gatt_example.Gattserver', ['-b', backend] + server_args, address, work_dir)
+        try:
+            try:
+                application = await bluez.wait_application(args.timeout)
+            except asyncio.TimeoutError:
+                # e.g. PyGObject missing for glib, the server log says why
+                results[backend] = {'registered': False}
+                continue
+            reads = await measure_reads(bluez, application, args.reads)
+            notifications = await measure_notifications(bluez, application, process.pid, args.duration,
+                                                        args.acquire)
+        finally:
+            stop(process)
+            deadline = time.monotonic() + args.timeout
+            while bluez.applications and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+        results[backend] = {
+            'read_p50_us': percentile([read['p50_us'] for read in reads.values()], 50),
+            'read_p99_us': max(read['p99_us'] for read in reads.values()),
+            'notifications_per_s': sum(notification['notifications_per_s']
+                                       for notification in notifications.values()),
+            'cpu_per_notification_us': percentile([notification['cpu_per_notification_us']
+                                                   for notification in notifications.values()
+                                                   if notification['cpu_per_notification_us'] is not None], 50),
+            'reads': reads,
+            'notifications': notifications,
+        }
+    return results
+
+
+async def measure_transport(bluez, application, message_size, messages, timeout):
+    """
+    Echo messages through the framed transport of every write+notify characteristic.
+
+    """
+    results = {}
+    for path in application.characteristics('notify'):
+        if 'write-without-response' not in application.properties(path)['Flags']:
+            continue
+
+        replies = asyncio.Queue()
+        transport = gatt_transport.FramedTransport(
+            lambda frame: bluez.write_command(application, path, bytes(frame)),
+            lambda: bluez.mtu - 3,
+            lambda opcode, request_id, payload: replies.put_nowait((opcode, len(payload))))
+        await bluez.start_notify(application, path, lambda device, chrc_path, value: transport.receive_frame(value))
+
+        async def poll():
+            while True:
+                await asyncio.sleep(0.05)
+                transport.poll()
+        poller = asyncio.ensure_future(poll())
+
+        payload = bytes(message_size)
+        round_trips = []
+        start = time.perf_counter()
+        try:
+            for request_id in range(messages):
+                sent = time.perf_counter()
+                transport.send_message(gatt_transport.OPCODE_ECHO, request_id % 256, payload)
+                opcode, size = await asyncio.wait_for(replies.get(), timeout)
+                if opcode != gatt_transport.OPCODE_ECHO | gatt_transport.OPCODE_RESPONSE or size != message_size:
+                    raise RuntimeError('Unexpected echo reply 0x%02x of %d B' % (opcode, size))
+                round_trips.append((time.perf_counter() - sent) * 1e3)
+        finally:
+            poller.cancel()
+            await bluez.stop_notify(application, path)
+        elapsed = time.perf_counter() - start
+
+        results[path] = {
+            'uuid': application.uuid(path),
+            'mtu': bluez.mtu,
+            'message_size': message_size,
+            'bytes_per_s': 2 * message_size * messages / elapsed,
+            'round_trip_p50_ms': percentile(round_trips, 50),
+            'round_trip_p99_ms': percentile(round_trips, 99),
+            'retransmissions': transport.retransmissions,
+        }
+    return results
+
+
+def encode_measurement_per_byte(flags, sample):
+    """
+    The Cycling Power Measurement as the service built it before CyclingPowerMeasurementEncoder: a list grown byte
+    by byte with shifts and masks, extended to every optional field for the comparison. Its bytes are ints here,
+    not dbus.Byte, which makes it cheaper than it was.
+
+    """
+    encoder = gatt_cp_enc.CyclingPowerMeasurementEncoder
+    value = [flags & 0xFF, (flags >> 8) & 0xFF]
+    power = sample['instantaneous_power']
+    value.append(power & 0xFF)
+    value.append((power >> 8) & 0xFF)
+    for flag, field_format, keys in encoder.FIELDS:
+        if not flags & flag:
+            continue
+        if flag == encoder.EXTREME_ANGLES_PRESENT:
+            angles = (sample['maximum_angle'] & 0xFFF) | ((sample['minimum_angle'] & 0xFFF) << 12)
+            fields = ((angles, 3),)
+        else:
+            fields = [(sample[key], struct.calcsize('<' + code)) for key, code in zip(keys, field_format)]
+        for field, size in fields:
+            for shift in range(0, size * 8, 8):
+                value.append((field >> shift) & 0xFF)
+    return value
+
+
+def measure_measurement_encoding(frames):
+    """
+    In process cost of a Cycling Power Measurement frame with the struct compiled encoder and with the per byte
+    list encoder it replaced, for the flags the service sends and for every optional field.
+
+    """
+    encoder = gatt_cp_enc.CyclingPowerMeasurementEncoder()
+    sample = {
+        'instantaneous_power': 250, 'pedal_power_balance': 100, 'accumulated_torque': 5000,
+        'cumulative_wheel_revolutions': 123456, 'last_wheel_event_time': 2048,
+        'cumulative_crank_revolutions': 789, 'last_crank_event_time': 1024,
+        'maximum_force_magnitude': 400, 'minimum_force_magnitude': -50,
+        'maximum_torque_magnitude': 1200, 'minimum_torque_magnitude': -100,
+        'maximum_angle': 95, 'minimum_angle': 275, 'top_dead_spot_angle': 10, 'bottom_dead_spot_angle': 190,
+        'accumulated_energy': 42,
+    }
+    combinations = (
+        ('power', 0),
+        ('revolutions', encoder.WHEEL_REVOLUTION_DATA_PRESENT | encoder.CRANK_REVOLUTION_DATA_PRESENT),
+        ('all', sum(flag for flag, _, _ in encoder.FIELDS)),
+    )
+
+    results = {}
+    for name, flags in combinations:
+        if bytes(encode_measurement_per_byte(flags, sample)) != encoder.encode(flags, sample):
+            raise AssertionError('The encoders disagree on flags 0x%04x' % flags)
+        results[name] = {'bytes': encoder.frame_size(flags)}
+        for method, encode in (('struct', encoder.encode), ('per_byte', encode_measurement_per_byte)):
+            start = time.perf_counter()
+            for _ in range(frames):
+                encode(flags, sample)
+            elapsed = time.perf_counter() - start
+            results[name][method] = {'frames_per_s': frames / elapsed, 'frame_ns': elapsed / frames * 1e9}
+        results[name]['speedup'] = results[name]['per_byte']['frame_ns'] / results[name]['struct']['frame_ns']
+    return results
+
+
+def measure_managed_objects(address, attributes, calls):
+    """
+    GetManagedObjects of an application grown to attributes services, characteristics and descriptors, served from
+    the cached snapshot and rebuilt on every call as before the cache, in process and over the bus. The
+    application runs in this process on the asyncio backend.
+
+    """
+    import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+    import gatt_example.gatt_base.gatt_lib_service as gatt_service
+    import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+    import gatt_example.gatt_base.gatt_lib_descriptor as gatt_desc
+    import gatt_example.Gattserver as gatt_server
+
+    backend = gatt_backend.set_backend(gatt_backend.AsyncioBackend())
+    bus = backend.connect_system_bus(address)
+    client = backend.loop.run_until_complete(gatt_aio_bus.AsyncioBus(address, backend.loop).connect())
+    application = gatt_server.Application(bus)
+    index = len(application.services)
+    while len(application.get_managed_objects()) < attributes:
+        # A service of 8 characteristics with a descriptor each, as many as it takes
+        service = gatt_service.Service(bus, index, '0000%04x-0000-1000-8000-00805f9b34fb' % (0xA000 + index), True)
+        for chrc_index in range(8):
+            chrc = gatt_char.Characteristic(bus, chrc_index, '0000%04x-0000-1000-8000-00805f9b34fb' % (
+                0xB000 + index * 8 + chrc_index), ['read'], service)
+            chrc.add_descriptor(gatt_desc.Descriptor(bus, 0, '00002901-0000-1000-8000-00805f9b34fb', ['read'],
+                                                     chrc))
+            service.add_characteristic(chrc)
+        application.add_service(service)
+        index += 1
+    objects = list(application.get_managed_objects())
+
+    def uncached():
+        application.invalidate_managed_objects()
+        for service in application.services:
+            service._properties = None
+            for chrc in service.get_characteristics():
+                chrc._properties = None
+                for desc in chrc.get_descriptors():
+                    desc._properties = None
+
+    results = {'attributes': len(objects)}
+    try:
+        for mode, before in (('cached', lambda: None), ('rebuilt', uncached)):
+            durations = []
+            for _ in range(calls):
+                before()
+                start = time.perf_counter()
+                application.get_managed_objects()
+                durations.append(time.perf_counter() - start)
+            latencies = []
+            for _ in range(calls):
+                before()
+                start = time.perf_counter()
+                backend.loop.run_until_complete(client.call(bus.unique_name, application.path, gatt_var.DBUS_OM_IFACE,
+                                                            'GetManagedObjects'))
+                latencies.append(time.perf_counter() - start)
+            results[mode] = {
+                'in_process_us': percentile(durations, 50) * 1e6,
+                'call_p50_ms': percentile(latencies, 50) * 1e3,
+                'call_p99_ms': percentile(latencies, 99) * 1e3,
+            }
+    finally:
+        application.stop_notifications()
+        client.close()
+        bus.close()
+    return results
+
+
+def measure_transport_sweep(mtus, windows, losses=(0.0, 0.02), message_size=16384, messages=20, repeats=5):
+    """
+    Echo messages in process over two FramedTransports connected back to back, through a RequestDispatcher as the
+    custom characteristic does, for every MTU, window and frame loss. Frames are delivered in order as soon as
+    sent, lost ones are retransmitted once nothing else is in flight, so this is the cost of the transport alone.
+
+    Every configuration is run once as a warm-up, then repeats times losing the same frames, the medians are
+    reported so the configurations can be ranked.
+
+    """
+    import random
+    import statistics
+    import collections
+
+    payload = bytes(range(256)) * (message_size // 256) + bytes(message_size % 256)
+
+    def echo(loss, mtu, window):
+        generator = random.Random(mtu * window)
+        frames = collections.deque()
+        replies = []
+        dispatcher = gatt_transport.RequestDispatcher()
+        dispatcher.register(gatt_transport.OPCODE_ECHO, bytes)
+        transports = {}
+
+        def link(peer):
+            def send(frame):
+                if not loss or generator.random() >= loss:
+                    frames.append((peer, frame))
+            return send
+
+        transports['client'] = gatt_transport.FramedTransport(
+            link('server'), lambda: mtu - 3, lambda opcode, request_id, value: replies.append(len(value)),
+            window=window, retransmit_timeout=0.0)
+        transports['server'] = dispatcher.transport = gatt_transport.FramedTransport(
+            link('client'), lambda: mtu - 3, dispatcher.on_message, window=window, retransmit_timeout=0.0)
+
+        round_trips = []
+        start = time.perf_counter()
+        for request_id in range(messages):
+            sent = time.perf_counter()
+            transports['client'].send_message(gatt_transport.OPCODE_ECHO, request_id, payload)
+            while len(replies) <= request_id:
+                if frames:
+                    peer, frame = frames.popleft()
+                    transports[peer].receive_frame(frame)
+                elif not (transports['client'].poll() | transports['server'].poll()):
+                    raise AssertionError('Echo of message %d lost' % request_id)
+            round_trips.append(time.perf_counter() - sent)
+        elapsed = time.perf_counter() - start
+        if replies != [message_size] * messages:
+            raise AssertionError('Echoed messages differ from the ones sent')
+        return elapsed, percentile(round_trips, 50), (transports['client'].retransmissions +
+                                                      transports['server'].retransmissions)
+
+    results = {}
+    for loss in losses:
+        for mtu in mtus:
+            for window in windows:
+                echo(loss, mtu, window)
+                runs = [echo(loss, mtu, window) for _ in range(repeats)]
+                results.setdefault('loss_%g' % loss, {}).setdefault('mtu_%d' % mtu, {})['window_%d' % window] = {
+                    # Both directions, the request and its echo
+                    'mb_per_s': 2 * message_size * messages / statistics.median(run[0] for run in runs) / 1e6,
+                    'round_trip_p50_ms': statistics.median(run[1] for run in runs) * 1e3,
+                    'retransmissions': runs[0][2],
+                    'repeats': repeats,
+                }
+    return results
+
+
+def measure_logging(records, work_dir):
+    """
+    In process cost of a log call on the hot paths: a debug call below the level, the same behind an isEnabledFor
+    guard, and an emitted record put on the queue of the writer thread as gatt_lib_logging does, against written
+    to the rotating file by the caller as before the writer thread.
+
+    """
+    import queue
+    import logging
+    import logging.handlers
+
+    results = {}
+    logger = logging.getLogger('gatt_benchmark.logging')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    value = b'\x00\x00\x96\x00'
+
+    def run(name, call):
+        start = time.perf_counter()
+        for _ in range(records):
+            call()
+        results[name] = {'call_ns': (time.perf_counter() - start) / records * 1e9}
+
+    run('disabled', lambda: logger.debug('[BENCHMARK] Updated characteristic, Values: %s', repr(value)))
+    run('guarded', lambda: logger.isEnabledFor(logging.DEBUG) and logger.debug(
+        '[BENCHMARK] Updated characteristic, Values: %s', repr(value)))
+
+    for name, queued in (('queued', True), ('direct', False)):
+        handler = logging.handlers.RotatingFileHandler(os.path.join(work_dir, name + '.log'), maxBytes=1048576 * 5,
+                                                       backupCount=3)
+        handler.setFormatter(logging.Formatter(gatt_log.LOG_FORMAT, gatt_log.LOG_DATE_FORMAT))
+        listener = None
+        if queued:
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, handler)
+            listener.start()
+            logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        else:
+            logger.addHandler(handler)
+        try:
+            run(name, lambda: logger.info('[BENCHMARK] Updated characteristic, Values: %s', repr(value)))
+        finally:
+            if listener is not None:
+                listener.stop()
+            for added in logger.handlers[:]:
+                logger.removeHandler(added)
+            handler.close()
+    return results
+
+
+def measure_vector_packing(counts, budget=0.1):
+    """
+    In process throughput of packing Cycling Power Vector magnitudes into notifications, for count magnitudes
+    given as the floats read from the sample ring, as an array.array('h') and as a NumPy array when NumPy is
+    installed, at the payload of the default, a common and the largest ATT MTU.
+
+    """
+    encoder = gatt_cp_enc.CyclingPowerVectorEncoder()
+    flags = (encoder.CRANK_REVOLUTION_DATA_PRESENT | encoder.FIRST_CRANK_MEASUREMENT_ANGLE_PRESENT |
+             encoder.INSTANTANEOUS_FORCE_MAGNITUDE_ARRAY_PRESENT)
+    sample = {'cumulative_crank_revolutions': 1, 'last_crank_event_time': 1024, 'first_crank_measurement_angle': 0}
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    results = {}
+    for count in counts:
+        forces = [150.0 + 250.0 * math.sin(2 * math.pi * index / count) for index in range(count)]
+        inputs = {'list': forces, 'array': array.array('h', [int(force) for force in forces])}
+        if numpy is not None:
+            inputs['numpy'] = numpy.array(forces)
+        results[str(count)] = {}
+        for name, magnitudes in sorted(inputs.items()):
+            results[str(count)][name] = {}
+            for mtu in (23, 185, 517):
+                payload_size = mtu - 3
+                encodes = 0
+                start = time.perf_counter()
+                while True:
+                    packets = encoder.encode(flags, sample, magnitudes, payload_size)
+                    encodes += 1
+                    elapsed = time.perf_counter() - start
+                    if elapsed >= budget:
+                        break
+                results[str(count)][name]['mtu_%d' % mtu] = {
+                    'magnitudes_per_s': count * encodes / elapsed,
+                    'notifications': len(packets),
+                    # Share of the notification payloads carrying data, the rest is unused
+                    'fill': sum(len(packet) for packet in packets) / float(len(packets) * payload_size),
+                }
+    return results
+
+
+def measure_revolution_tracking(events, snapshot_every=64):
+    """
+    In process cost of a revolution edge, and the revolutions and time a client decodes from the wrapping counts
+    and event times, for synthetic streams of events edges at high cadence with jitter: long enough for the 16 bit
+    crank count and every event time to wrap many times. The client differences snapshots taken every
+    snapshot_every edges, as a notification would, the errors must be 0.
+
+    """
+    import random
+
+    results = {}
+    streams = (
+        # Crank at 200 rpm, 1/1024 s event times
+        ('crank', 200.0, gatt_revolutions.CRANK_REVOLUTION_BITS, gatt_revolutions.EVENT_TIME_1024),
+        # Wheel at 2000 rpm (about 250 km/h on a 2.1 m wheel), the 1/2048 s of the Cycling Power Measurement
+        ('wheel', 2000.0, gatt_revolutions.WHEEL_REVOLUTION_BITS, gatt_revolutions.EVENT_TIME_2048),
+    )
+    for name, rpm, bits, units_per_s in streams:
+        generator = random.Random(events)
+        period = 60.0 / rpm
+        timestamps = []
+        timestamp = 1000.0
+        for _ in range(events):
+            timestamp += period * generator.uniform(0.8, 1.2)
+            timestamps.append(timestamp)
+
+        tracker = gatt_revolutions.RevolutionTracker()
+        # Starting close to the wrap of the count
+        tracker.set_revolutions((1 << bits) - events // 3)
+        edge = tracker.edge
+        start = time.perf_counter()
+        for timestamp in timestamps:
+            edge(timestamp)
+        elapsed = time.perf_counter() - start
+
+        tracker = gatt_revolutions.RevolutionTracker()
+        tracker.set_revolutions((1 << bits) - events // 3)
+        count_mask = (1 << bits) - 1
+        previous = None
+        decoded_revolutions = 0
+        decoded_time = 0
+        wraps = 0
+        for index, timestamp in enumerate(timestamps):
+            tracker.edge(timestamp)
+            if index % snapshot_every and index != events - 1:
+                continue
+            snapshot = (tracker.cumulative(bits), tracker.event_time(units_per_s))
+            if previous is not None:
+                decoded_revolutions += (snapshot[0] - previous[0]) & count_mask
+                decoded_time += (snapshot[1] - previous[1]) & gatt_revolutions.EVENT_TIME_MASK
+                wraps += snapshot[1] < previous[1]
+            else:
+                first = (index, timestamp)
+            previous = snapshot
+
+        # Floored to the unit, the decoded time is within a unit of the true one
+        true_time = timestamps[-1] - first[1]
+        results[name] = {
+            'edges_per_s': events / elapsed,
+            'edge_ns': elapsed / events * 1e9,
+            'event_time_wraps': wraps,
+            'count_wrapped': tracker.revolutions > count_mask,
+            'revolution_errors': abs(decoded_revolutions - (events - 1 - first[0])),
+            'time_errors_units': max(0, abs(decoded_time - true_time * units_per_s) - 1),
+        }
+    return results
+
+
+async def measure_control_point(bluez, application, timeout, requests=20):
+    """
+    Round trip of Cycling Power Control Point requests, from the write to the indicated response, and the two
+    writes that must fail: without indications enabled and while a procedure is in progress.
+
+    """
+    paths = [path for path in application.characteristics('indicate') if application.uuid(path).upper().startswith(
+        '00002A66')]
+    if not paths:
+        return {}
+    path = paths[0]
+    results = {}
+
+    async def write_error(value):
+        try:
+            await bluez.write_value(application, path, value)
+        except Exception as error:
+            return str(error)
+        return None
+
+    results['unsubscribed_error'] = await write_error(b'\x05')
+
+    responses = asyncio.Queue()
+    await bluez.start_notify(application, path, lambda device, chrc_path, value: responses.put_nowait(bytes(value)))
+    confirmed = bluez.confirmed
+    try:
+        for name, request in (('request_crank_length', b'\x05'), ('set_crank_length', b'\x04\x5a\x01'),
+                              ('request_supported_sensor_locations', b'\x03'),
+                              ('update_sensor_location', b'\x02\x07'), ('op_code_not_supported', b'\x0e')):
+            round_trips = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                await bluez.write_value(application, path, request)
+                response = await asyncio.wait_for(responses.get(), timeout)
+                round_trips.append((time.perf_counter() - start) * 1e3)
+            results[name] = {
+                'round_trip_p50_ms': percentile(round_trips, 50),
+                'round_trip_p99_ms': percentile(round_trips, 99),
+                'result': response[2],
+            }
+
+        start = time.perf_counter()
+        await bluez.write_value(application, path, b'\x0c')
+        results['busy_error'] = await write_error(b'\x05')
+        response = await asyncio.wait_for(responses.get(), timeout)
+        results['offset_compensation'] = {
+            'round_trip_ms': (time.perf_counter() - start) * 1e3,
+            'result': response[2],
+        }
+        results['confirmed'] = bluez.confirmed - confirmed
+    finally:
+        await bluez.stop_notify(application, path)
+    return results
+
+
+async def measure_adapters(bluez, applications, pid, duration, acquire):
+    """
+    Notify on every characteristic of every adapter at once, the sample source and encoding are shared so the
+    aggregate rate shows how the server scales with connections.
+
+    """
+    subscriptions = []
+    for application in applications:
+        for path in application.characteristics('notify'):
+            if acquire and 'NotifyAcquired' in application.properties(path):
+                await bluez.acquire_notify(application, path)
+                subscriptions.append((application, path, True))
+            else:
+                await bluez.start_notify(application, path)
+                subscriptions.append((application, path, False))
+
+    before = sum(bluez.notifications.values())
+    cpu_before = process_cpu_time(pid)
+    await asyncio.sleep(duration)
+    count = sum(bluez.notifications.values()) - before
+    cpu = process_cpu_time(pid) - cpu_before
+
+    for application, path, acquired in subscriptions:
+        if acquired:
+            bluez.release_notify(application, path)
+        else:
+            await bluez.stop_notify(application, path)
+
+    return {
+        'adapters': len(applications),
+        'subscriptions': len(subscriptions),
+        'notifications_per_s': count / duration,
+        'cpu_per_notification_us': cpu / count * 1e6 if count else None,
+    }
+
+
+async def measure_devices(bluez, application, duration, devices, acquire):
+    """
+    Subscribe several devices to every notify characteristic, then disconnect the first one: the others must keep
+    receiving notifications at the same rate.
+
+    """
+    clients = [application.device('00:00:00:00:01:%02X' % index) for index in range(devices)]
+    paths = application.characteristics('notify')
+    for client in clients:
+        for path in paths:
+            if acquire and 'NotifyAcquired' in application.properties(path):
+                await bluez.acquire_notify(client, path)
+            else:
+                await bluez.start_notify(client, path)
+
+    def device_rates(before):
+        return [sum(bluez.notifications[(client.device_path, path)] - before.get((client.device_path, path), 0)
+                    for path in paths) / duration for client in clients[1:]]
+
+    before = dict(bluez.notifications)
+    await asyncio.sleep(duration)
+    connected = device_rates(before)
+
+    await bluez.disconnect(clients[0])
+    before = dict(bluez.notifications)
+    await asyncio.sleep(duration)
+    after_disconnect = device_rates(before)
+
+    for client in clients[1:]:
+        await bluez.disconnect(client)
+
+    return {
+        'devices': devices,
+        'notifications_per_s_per_device': sum(connected) / len(connected),
+        'after_disconnect_notifications_per_s_per_device': sum(after_disconnect) / len(after_disconnect),
+    }
+
+
+async def measure_shutdown(bluez, daemons, timeout):
+    """
+    SIGTERM each daemon in turn and time it until it exited. Registrations it did not unregister itself are
+    reaped by the fake once the process left the bus.
+
+    """
+    results = {}
+    for name, process in daemons:
+        unregistered, reaped = bluez.unregistered, bluez.reaped
+        start = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        while process.poll() is None and time.monotonic() - start < timeout:
+            await asyncio.sleep(0.002)
+        exit_ms = (time.monotonic() - start) * 1e3
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        # Let the fake see the process leave the bus
+        await asyncio.sleep(0.1)
+        results[name] = {
+            'sigterm_to_exit_ms': exit_ms,
+            'exit_code': process.returncode,
+            'unregistered': bluez.unregistered - unregistered,
+            'reaped': bluez.reaped - reaped,
+        }
+    return results
+
+
+async def measure_hotplug(bluez, timeout):
+    """
+    Time from an adapter appearing to the application being registered on it.
+
+    """
+    start = time.monotonic()
+    adapter_path = bluez.add_adapter()
+    application = await bluez.wait_application(timeout, adapter_path)
+    bluez.remove_adapter(adapter_path)
+    return {
+        'added_to_registered_ms': (application.registered_time - start) * 1e3,
+    }
+
+
+async def measure_recovery(bluez, address, args):
+    """
+    Power cycle the first adapter, then restart the fake BlueZ on a new connection the way bluetoothd restarts,
+    and time both until the daemons registered everything again. Returns the new fake with its bus and the
+    results.
+
+    """
+    adapter_path = next(iter(bluez.adapters))
+    bluez.set_powered(adapter_path, False)
+    await asyncio.sleep(0.1)
+    start = time.monotonic()
+    bluez.set_powered(adapter_path, True)
+    advertisement = await bluez.wait_advertisement(args.timeout, adapter_path)
+    results = {
+        'power_on_to_advertised_ms': (advertisement.registered_time - start) * 1e3,
+    }
+
+    objects = len(next(iter(bluez.applications.values())).objects)
+    bluez.close()
+    bluez.bus.close()
+    await asyncio.sleep(0.1)
+    start = time.monotonic()
+    bus = await gatt_aio_bus.AsyncioBus(address).connect()
+    bluez = await gatt_fake_bluez.FakeBluez(bus, adapters=args.adapters, mtu=args.mtu).start()
+    applications = await bluez.wait_applications(args.adapters, args.timeout)
+    advertisements = await bluez.wait_advertisements(args.adapters, args.timeout)
+    results['restart_to_application_ms'] = (max(app.registered_time for app in applications) - start) * 1e3
+    results['restart_to_advertised_ms'] = (max(adv.registered_time for adv in advertisements) - start) * 1e3
+    # Same exported objects as before the restart, and still serving reads
+    results['objects_kept'] = len(applications[0].objects) == objects
+    await bluez.read_value(applications[0], applications[0].characteristics('read')[0])
+    return bluez, bus, results
+
+
+async def scrape_metrics(socket_path):
+    """
+    Samples of the Prometheus text a daemon serves on socket_path, as (name, labels, value) tuples.
+
+    """
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    text = (await reader.read()).decode('utf-8')
+    writer.close()
+
+    samples = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, _, labels = series.partition('{')
+        labels = dict(label.split('=', 1) for label in labels.rstrip('}').split(',') if label)
+        samples.append((name, dict((key, value.strip('"')) for key, value in labels.items()), float(value)))
+    return samples
+
+
+async def measure_metrics(socket_path):
+    """
+    Dispatch time per D-Bus method from the server's own metrics, the mean and the p50 estimated from the
+    histogram buckets, the errors it returned, the signals it emitted and what the instrumentation costs per call.
+
+    """
+    samples = await scrape_metrics(socket_path)
+    calls, seconds, buckets = {}, {}, {}
+    for name, labels, value in samples:
+        if name == 'gatt_dbus_method_duration_seconds_count':
+            calls[labels['method']] = calls.get(labels['method'], 0) + value
+        elif name == 'gatt_dbus_method_duration_seconds_sum':
+            seconds[labels['method']] = seconds.get(labels['method'], 0.0) + value
+        elif name == 'gatt_dbus_method_duration_seconds_bucket':
+            # Summed over the objects
+            method_buckets = buckets.setdefault(labels['method'], {})
+            bound = float(labels['le'])
+            method_buckets[bound] = method_buckets.get(bound, 0) + value
+    return {
+        'methods': dict((method, {'calls': int(count), 'mean_us': seconds[method] / count * 1e6,
+                                  'p50_us': histogram_quantile(buckets[method].items(), 0.5) * 1e6})
+                        for method, count in calls.items() if count),
+        'errors': int(sum(value for name, labels, value in samples if name == 'gatt_dbus_method_errors_total')),
+        'properties_changed': int(sum(value for name, labels, value in samples
+                                      if name == 'gatt_properties_changed_total')),
+        'overhead_us': sum(value for name, labels, value in samples
+                           if name == 'gatt_metrics_overhead_seconds') * 1e6,
+        'series': len(samples),
+    }
+
+
+async def run_benchmarks(args, address, work_dir):
+    bus = await gatt_aio_bus.AsyncioBus(address).connect()
+    bluez = await gatt_fake_bluez.FakeBluez(bus, adapters=args.adapters, mtu=args.mtu).start()
+    results = {}
+    processes = []
+
+    try:
+        server_args = ['-b', args.backend]
+        ring_path = None
+        if args.sample_rate:
+            ring_path = os.path.join(work_dir, 'samples.ring')
+            processes.append(subprocess.Popen([sys.executable, '-m', 'gatt_example.Sampleproducer', ring_path,
+                                               '-r', str(args.sample_rate)], cwd=PACKAGE_ROOT))
+            # The ring must exist before the server opens it
+            while not os.path.exists(ring_path):
+                await asyncio.sleep(0.01)
+            server_args += ['-s', ring_path]
+        if not args.acquire:
+            server_args.append('--no-acquire')
+        adapter_args = ['-a'] if args.adapters > 1 else []
+
+        advertiser_args = []
+        if args.rotate:
+            advertiser_args += ['-r', str(args.rotate)]
+        if args.broadcast:
+            advertiser_args += ['--broadcast', str(args.broadcast)]
+
+        if args.startup:
+            if args.supervisor:
+                daemons = [('gatt_example.Gattsupervisor', server_args + adapter_args + advertiser_args)]
+            else:
+                daemons = [('gatt_example.Gattserver', server_args + adapter_args),
+                           ('gatt_example.Gattadvertiser', ['-b', args.backend] + adapter_args + advertiser_args)]
+            results['startup'] = {}
+            for module, module_args in daemons:
+                results['startup'][module.rsplit('.', 1)[1]] = await measure_startup(
+                    bluez, module, module_args, address, work_dir, args.startup, args.timeout)
+
+        if args.backends:
+            results['backends'] = await measure_backends(bluez, server_args[2:], address, work_dir, args)
+
+        metrics_path = os.path.join(work_dir, 'server.metrics')
+        start = time.monotonic()
+        if args.supervisor:
+            server = advertiser = spawn('gatt_example.Gattsupervisor', server_args + adapter_args + advertiser_args +
+                                        ['--metrics-socket', metrics_path], address, work_dir)
+            processes.append(server)
+            applications = await bluez.wait_applications(args.adapters, args.timeout)
+        else:
+            server = spawn('gatt_example.Gattserver', server_args + adapter_args + ['--metrics-socket', metrics_path],
+                           address, work_dir)
+            processes.append(server)
+            applications = await bluez.wait_applications(args.adapters, args.timeout)
+            # Only advertise once the services are there, as the supervisor does
+            advertiser_args = ['-b', args.backend] + adapter_args + advertiser_args
+            if args.broadcast and ring_path:
+                advertiser_args += ['-s', ring_path]
+            advertiser = spawn('gatt_example.Gattadvertiser', advertiser_args, address, work_dir)
+            processes.append(advertiser)
+        advertisements = await bluez.wait_advertisements(args.adapters, args.timeout)
+        application = applications[0]
+        results['server'] = {
+            'startup_to_registered_ms': (max(app.registered_time for app in applications) - start) * 1e3,
+            'objects': len(application.objects),
+        }
+        results['advertiser'] = {
+            'startup_to_registered_ms': (max(adv.registered_time for adv in advertisements) - start) * 1e3,
+        }
+        results['processes'] = {
+            'mode': 'supervisor' if args.supervisor else 'separate',
+            'count': 1 if args.supervisor else 2,
+            'rss_kb': sum(process_rss_kb(pid) for pid in {server.pid, advertiser.pid}),
+        }
+
+        results['reads'] = await measure_reads(bluez, application, args.reads)
+        results['notifications'] = await measure_notifications(bluez, application, server.pid, args.duration,
+                                                               args.acquire)
+        results['transport'] = await measure_transport(bluez, application, args.message_size, args.messages,
+                                                       args.timeout)
+        results['control_point'] = await measure_control_point(bluez, application, args.timeout)
+        if args.devices > 1:
+            results['devices'] = await measure_devices(bluez, application, args.duration, args.devices,
+                                                       args.acquire)
+        if args.adapters > 1:
+            results['adapters'] = await measure_adapters(bluez, applications, server.pid, args.duration,
+                                                         args.acquire)
+            results['adapters']['hotplug'] = await measure_hotplug(bluez, args.timeout)
+
+        if args.rotate or args.broadcast:
+            updates = sum(adv.updates for adv in advertisements)
+            cpu_before = process_cpu_time(advertiser.pid)
+            await asyncio.sleep(args.duration)
+            updates = sum(adv.updates for adv in advertisements) - updates
+            cpu = process_cpu_time(advertiser.pid) - cpu_before
+            results['advertiser']['updates_per_s'] = updates / args.duration / len(advertisements)
+            results['advertiser']['cpu_per_update_us'] = cpu / updates * 1e6 if updates else None
+
+        results['metrics'] = await measure_metrics(metrics_path)
+
+        if args.recovery:
+            bluez, bus, results['recovery'] = await measure_recovery(bluez, address, args)
+
+        if args.supervisor:
+            daemons = [('Gattsupervisor', server)]
+        else:
+            daemons = [('Gattadvertiser', advertiser), ('Gattserver', server)]
+        results['shutdown'] = await measure_shutdown(bluez, daemons, args.timeout)
+    finally:
+        bluez.close()
+        bus.close()
+        for process in reversed(processes):
+            stop(process)
+
+    return results
+
+
+def run_micro_benchmarks(args, work_dir):
+    """
+    The in process measurements that need neither dbus-python, the fake BlueZ nor a server.
+
+    """
+    results = {}
+    if args.encoding_frames:
+        results['measurement_encoding'] = measure_measurement_encoding(args.encoding_frames)
+    if args.sweep_mtus:
+        results['transport_sweep'] = measure_transport_sweep(args.sweep_mtus, args.sweep_windows,
+                                                              repeats=args.sweep_repeats)
+    if args.vector_samples:
+        results['vector_packing'] = measure_vector_packing(args.vector_samples)
+    if args.revolution_events:
+        results['revolution_tracking'] = measure_revolution_tracking(args.revolution_events)
+    if args.log_records:
+        results['logging'] = measure_logging(args.log_records, work_dir)
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + '/' + key if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(previous, current):
+    before = flatten(previous['results'])
+    for name, value in sorted(flatten(current['results']).items()):
+        if before.get(name):
+            print('%-90s %14.2f %+8.1f%%' % (name, value, (value - before[name]) / before[name] * 100.0))
+        else:
+            print('%-90s %14.2f' % (name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmarks of the GATT server against a fake BlueZ')
+    parser.add_argument("-b", "--backend", choices=['glib', 'asyncio'], default='glib')
+    parser.add_argument("-o", "--output", default='gatt_benchmark.json', help="JSON file the results are saved to")
+    parser.add_argument("-c", "--compare", default=None, help="Results of a previous run to compare with")
+    parser.add_argument("--mtu", type=int, default=gatt_fake_bluez.DEFAULT_MTU)
+    parser.add_argument("--adapters", type=int, default=1,
+                        help="Adapters of the fake BlueZ, more than one runs the server with --all-adapters")
+    parser.add_argument("--devices", type=int, default=1,
+                        help="Devices connected to the first adapter, more than one measures per device fan-out")
+    parser.add_argument("--supervisor", action="store_true",
+                        help="Run the server and the advertiser in one process with Gattsupervisor")
+    parser.add_argument("--startup", type=int, default=5, metavar="RUNS",
+                        help="Cold starts of each daemon timed to its READY=1, 0 to skip")
+    parser.add_argument("--backends", action="store_true",
+                        help="Also run the read and notification workload on a server with each backend in turn")
+    parser.add_argument("--no-recovery", dest='recovery', action="store_false",
+                        help="Skip the adapter power cycle and the BlueZ restart")
+    parser.add_argument("--rotate", type=int, default=None, metavar="MS",
+                        help="Run the advertiser with advertisement set rotation every MS milliseconds")
+    parser.add_argument("--broadcast", type=int, default=None, metavar="MS",
+                        help="Run the advertiser broadcasting the live power every MS milliseconds")
+    parser.add_argument("--reads", type=int, default=1000, help="Reads per characteristic")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of notifications per characteristic")
+    parser.add_argument("--message-size", type=int, default=4096)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--sample-rate", type=float, default=100.0,
+                        help="Sample ring producer rate, 0 to run without a sample ring")
+    parser.add_argument("--no-acquire", dest='acquire', action="store_false",
+                        help="Subscribe with StartNotify instead of AcquireNotify")
+    parser.add_argument("--managed-objects", type=int, default=500, metavar="ATTRIBUTES",
+                        help="Attributes of the application GetManagedObjects is timed with, 0 to skip")
+    parser.add_argument("--encoding-frames", type=int, default=100000, metavar="COUNT",
+                        help="Cycling Power Measurement frames encoded per encoder and flags, 0 to skip")
+    parser.add_argument("--sweep-mtus", type=int, nargs='*', default=[23, 185, 517], metavar="MTU",
+                        help="MTUs of the in process custom transport sweep, none to skip")
+    parser.add_argument("--sweep-windows", type=int, nargs='+', default=[1, 8, 32], metavar="FRAMES",
+                        help="Windows of the in process custom transport sweep")
+    parser.add_argument("--sweep-repeats", type=int, default=5, metavar="COUNT",
+                        help="Timed runs of each configuration of the transport sweep after a warm-up, the median "
+                             "is reported")
+    parser.add_argument("--log-records", type=int, default=20000, metavar="COUNT",
+                        help="Log calls timed per way of logging, 0 to skip")
+    parser.add_argument("--vector-samples", type=int, nargs='*', default=[64, 1024, 16384], metavar="COUNT",
+                        help="Magnitudes per Cycling Power Vector the packing throughput is measured at, none to skip")
+    parser.add_argument("--revolution-events", type=int, default=300000, metavar="COUNT",
+                        help="Edges of the synthetic crank and wheel streams of the revolution tracking, 0 to skip")
+    parser.add_argument("--micro-only", action="store_true",
+                        help="Only run the in process measurements, without the bus, the fake BlueZ and the daemons")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    # The in process measurements first, they are saved even when the end to end run fails, which is raised after
+    failure = None
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_micro_benchmarks(args, work_dir)
+        if not args.micro_only:
+            daemon, address = start_private_bus()
+            try:
+                results.update(asyncio.run(run_benchmarks(args, address, work_dir)))
+                if args.managed_objects:
+                    results['managed_objects'] = measure_managed_objects(address, args.managed_objects, args.reads)
+            except Exception as error:
+                failure = error
+            finally:
+                daemon.terminate()
+                daemon.wait()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'arguments': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(json.load(previous), report)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if failure is not None:
+        raise failure
+
+
+if __name__ == '__main__':
+    main()
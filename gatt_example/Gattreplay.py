@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import inspect
+import argparse
+import platform
+import tempfile
+import subprocess
+import collections
+
+import gatt_example.Gattbenchmark as gatt_bench
+import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+import gatt_example.gatt_base.gatt_lib_recorder as gatt_recorder
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_testing.gatt_lib_fake_bluez as gatt_fake_bluez
+
+
+class MissingObject(Exception):
+    """
+    The object of a recorded call does not exist in the build replayed against.
+
+    """
+
+
+def method_summary(latencies, errors):
+    """
+    Count, mean, p50/p99 in microseconds and errors per method, from latencies in seconds.
+
+    """
+    summary = {}
+    for name in sorted(set(latencies) | set(errors)):
+        values = [latency * 1e6 for latency in latencies.get(name, ())]
+        summary[name] = {
+            'calls': len(values),
+            'mean_us': sum(values) / len(values) if values else None,
+            'p50_us': gatt_bench.percentile(values, 50),
+            'p99_us': gatt_bench.percentile(values, 99),
+            'errors': sum(errors.get(name, {}).values()),
+        }
+    return summary
+
+
+def summarize_recording(events):
+    latencies = collections.defaultdict(list)
+    errors = collections.defaultdict(collections.Counter)
+    properties_changed = 0
+    for event in events:
+        if event.event == gatt_recorder.EVENT_PROPERTIES_CHANGED:
+            properties_changed += 1
+            continue
+        name = gatt_recorder.EVENT_NAMES[event.event]
+        latencies[name].append(event.duration)
+        if event.error:
+            errors[name][event.error] += 1
+
+    calls = [event for event in events if event.event != gatt_recorder.EVENT_PROPERTIES_CHANGED]
+    span = events[-1].time - events[0].time if events else 0.0
+    return {
+        'duration_s': span,
+        'calls': len(calls),
+        'calls_per_s': len(calls) / span if span else None,
+        'properties_changed': properties_changed,
+        # Time the server spent dispatching each call, not the round trip seen by BlueZ
+        'dispatch': method_summary(latencies, errors),
+    }
+
+
+class Replay(object):
+    """
+    Issues the calls of a recording at their recorded times divided by speed, each as a task of its own so a slow
+    call delays none of the following ones, or back to back waiting for each reply when speed is 0. call(event) is
+    the coroutine making one call, latencies are what it took from the replayer's side.
+
+    """
+
+    def __init__(self, events, speed):
+        self.calls = [event for event in events if event.event != gatt_recorder.EVENT_PROPERTIES_CHANGED]
+        self.speed = speed
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(collections.Counter)
+        self.lateness = []
+        self.missing = 0
+        self.duration = None
+
+    async def _timed(self, call, event):
+        name = gatt_recorder.EVENT_NAMES[event.event]
+        start = time.perf_counter()
+        try:
+            await call(event)
+        except MissingObject:
+            self.missing += 1
+            return
+        except Exception as error:
+            self.errors[name][getattr(error, '_dbus_error_name', None) or type(error).__name__] += 1
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def run(self, call):
+        if not self.calls:
+            self.duration = 0.0
+            return
+        origin = self.calls[0].time
+        start = time.monotonic()
+        tasks = []
+        for event in self.calls:
+            if not self.speed:
+                await self._timed(call, event)
+                continue
+            delay = (event.time - origin) / self.speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.lateness.append(max(0.0, -delay))
+            tasks.append(asyncio.ensure_future(self._timed(call, event)))
+        await asyncio.gather(*tasks)
+        self.duration = time.monotonic() - start
+
+    def results(self, notifications):
+        calls = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'duration_s': self.duration,
+            'calls': calls,
+            'calls_per_s': calls / self.duration if self.duration else None,
+            'missing': self.missing,
+            'lateness_p99_ms': gatt_bench.percentile(self.lateness, 99) * 1e3 if self.lateness else None,
+            'properties_changed': notifications,
+            'round_trip': method_summary(self.latencies, self.errors),
+        }
+
+
+def server_options(root):
+    """
+    Options of the Gattserver of the build at root, from its --help. Builds before the asyncio backend have no -b
+    nor -l, and the metrics socket came later still.
+
+    """
+    env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    usage = subprocess.run([sys.executable, '-m', 'gatt_example.Gattserver', '--help'], env=env, cwd=root,
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    return set(re.findall(r'(?<![\w-])--?[\w-]+', usage))
+
+
+async def replay_bus(events, args, address, work_dir, options):
+    """
+    Replay against a server of the build at args.build, spawned on a private bus with the fake BlueZ as the
+    client, the way bluetoothd would have made the calls. options are the server_options() of the build, without
+    its metrics socket the dispatch times are left out and only the round trips are measured.
+
+    """
+    bus = await gatt_aio_bus.AsyncioBus(address).connect()
+    bluez = await gatt_fake_bluez.FakeBluez(bus).start()
+    metrics_path = os.path.join(work_dir, 'server.metrics') if '--metrics-socket' in options else None
+    server_args = ['-b', args.backend] if '--backend' in options else []
+    if metrics_path is not None:
+        server_args += ['--metrics-socket', metrics_path]
+    server = gatt_bench.spawn('gatt_example.Gattserver', server_args, address, work_dir,
+                              root=os.path.abspath(args.build), log='--log-file' in options)
+    try:
+        application = await bluez.wait_application(args.timeout)
+        clients = {}
+        notifications = collections.Counter()
+
+        def properties_changed(message):
+            interface, changed = message.body[0], message.body[1]
+            if interface == gatt_var.GATT_CHRC_IFACE and 'Value' in changed:
+                notifications[message.path] += 1
+
+        receiver = bus.add_signal_receiver(properties_changed, sender=application.sender,
+                                           interface=gatt_var.DBUS_PROP_IFACE, member='PropertiesChanged')
+        # Make sure the match rule is in place before the first notification can be sent
+        await bus.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus.Peer', 'Ping')
+
+        def client(device):
+            if device is None:
+                return application
+            if device not in clients:
+                clients[device] = application.device(device.rsplit('/dev_', 1)[-1].replace('_', ':'))
+            return clients[device]
+
+        async def call(event):
+            if event.path not in application.objects:
+                raise MissingObject(event.path)
+            if event.event == gatt_recorder.EVENT_READ:
+                await bluez.read_value(client(event.device), event.path, event.offset)
+            elif event.event == gatt_recorder.EVENT_WRITE:
+                await bluez.write_value(client(event.device), event.path, event.value, event.write_type, event.offset)
+            else:
+                # StartNotify and StopNotify as bluetoothd issued them, without the fake's per adapter bookkeeping
+                await bus.call(application.sender, event.path, gatt_var.GATT_CHRC_IFACE,
+                               gatt_recorder.EVENT_NAMES[event.event])
+
+        replay = Replay(events, args.speed)
+        await replay.run(call)
+        bus.remove_signal_receiver(receiver)
+        results = replay.results(sum(notifications.values()))
+        if metrics_path is not None:
+            results['dispatch'] = (await gatt_bench.measure_metrics(metrics_path))['methods']
+        return results
+    finally:
+        bluez.close()
+        bus.close()
+        gatt_bench.stop(server)
+
+
+def replay_direct(events, args, address):
+    """
+    Replay into an application of this build created in this process, calling the methods of its objects without
+    a D-Bus round trip. Its objects are still exported on the private bus, the signals they emit go there.
+
+    """
+    import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+    import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+
+    backend = gatt_backend.set_backend(gatt_backend.AsyncioBackend())
+    bus = backend.connect_system_bus(address)
+
+    # Only now, the application objects pick the backend when created
+    import gatt_example.Gattserver as gatt_server
+
+    application = gatt_server.Application(bus)
+    application.sessions.start()
+    objects = {}
+    for service in application.services:
+        objects[service.path] = service
+        for chrc in service.get_characteristics():
+            objects[chrc.path] = chrc
+            for desc in chrc.get_descriptors():
+                objects[desc.path] = desc
+
+    def properties_changed():
+        return sum(series.value for series in gatt_metrics.PROPERTIES_CHANGED.series.values())
+
+    async def call(event):
+        if event.path not in objects:
+            raise MissingObject(event.path)
+        handler, exported = gatt_aio_bus.find_method(objects[event.path], gatt_recorder.EVENT_NAMES[event.event])
+        options = {'offset': event.offset}
+        if event.device is not None:
+            options['device'] = event.device
+        if event.mtu:
+            options['mtu'] = event.mtu
+        if event.event == gatt_recorder.EVENT_READ:
+            result = handler(options)
+        elif event.event == gatt_recorder.EVENT_WRITE:
+            options['type'] = event.write_type
+            result = handler(event.value, options)
+        else:
+            result = handler()
+        if inspect.isawaitable(result):
+            await result
+
+    replay = Replay(events, args.speed)
+    before = properties_changed()
+    try:
+        backend.loop.run_until_complete(replay.run(call))
+    finally:
+        application.stop_notifications()
+        application.sessions.stop()
+        bus.close()
+    results = replay.results(properties_changed() - before)
+    # The round trip is the dispatch time here
+    results['dispatch'] = dict((name, summary) for name, summary in results['round_trip'].items()
+                               if summary['calls'])
+    return results
+
+
+def print_differences(recorded, replayed):
+    # The dispatch times on both sides, p50 against p50 and mean against mean. A build without the metrics socket
+    # has no dispatch times, only its calls and errors are shown.
+    dispatch = replayed.get('dispatch')
+    if dispatch is None:
+        print('No dispatch times, the server replayed against has no --metrics-socket')
+
+    def us(summary, key):
+        return '%12.1f' % summary[key] if summary.get(key) is not None else '%12s' % '-'
+
+    print('%-20s %10s %10s %12s %12s %12s %12s %8s %8s' % ('method', 'recorded', 'replayed', 'rec p50 us',
+                                                          'replay p50', 'rec mean us', 'replay mean', 'rec err',
+                                                          'err'))
+    for name in sorted(set(recorded['dispatch']) | set(replayed['round_trip'])):
+        before = recorded['dispatch'].get(name, {})
+        after = (dispatch or {}).get(name, {})
+        round_trip = replayed['round_trip'].get(name, {})
+        print('%-20s %10s %10s %s %s %s %s %8s %8s' % (
+            name, before.get('calls', 0), round_trip.get('calls', 0), us(before, 'p50_us'), us(after, 'p50_us'),
+            us(before, 'mean_us'), us(after, 'mean_us'), before.get('errors', 0), round_trip.get('errors', 0)))
+    print('calls per second %.1f recorded, %.1f replayed; notifications %d recorded, %d replayed' % (
+        recorded['calls_per_s'] or 0.0, replayed['calls_per_s'] or 0.0, recorded['properties_changed'],
+        replayed['properties_changed']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a GATT traffic recording made with --record against a '
+                                                 'server and report its latency and throughput')
+    parser.add_argument("recording", help="File written by Gattserver or Gattsupervisor --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Pace relative to the recording, 2 replays twice as fast, 0 back to back")
+    parser.add_argument("--mode", choices=['bus', 'direct'], default='bus',
+                        help="Through a spawned server on a private bus, or into an application in this process")
+    parser.add_argument("--build", default=gatt_bench.PACKAGE_ROOT,
+                        help="Tree whose Gattserver is replayed against in bus mode, this one by default")
+    parser.add_argument("-b", "--backend", choices=['glib', 'asyncio'], default='glib',
+                        help="D-Bus backend of the spawned server in bus mode")
+    parser.add_argument("-o", "--output", default='gatt_replay.json', help="JSON file the results are saved to")
+    parser.add_argument("-c", "--compare", default=None,
+                        help="Results of a previous replay, of another build, to compare with")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    if args.mode == 'direct' and os.path.abspath(args.build) != gatt_bench.PACKAGE_ROOT:
+        parser.error('--build needs --mode bus, direct mode replays the tree it runs from')
+    if args.speed < 0:
+        parser.error('--speed must not be negative')
+    if args.mode == 'bus':
+        options = server_options(os.path.abspath(args.build))
+        if not options:
+            parser.error('the Gattserver of %s does not start, see its --help' % args.build)
+        if args.backend != 'glib' and '--backend' not in options:
+            parser.error('the Gattserver of %s only runs on glib' % args.build)
+
+    events = list(gatt_recorder.read_events(args.recording))
+    recorded = summarize_recording(events)
+
+    daemon, address = gatt_bench.start_private_bus()
+    try:
+        if args.mode == 'direct':
+            replayed = replay_direct(events, args, address)
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                replayed = asyncio.run(replay_bus(events, args, address, work_dir, options))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'arguments': vars(args),
+        'results': {'recorded': recorded, 'replayed': replayed},
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            gatt_bench.compare(json.load(previous), report)
+    else:
+        print_differences(recorded, replayed)
+
+
+if __name__ == '__main__':
+    main()
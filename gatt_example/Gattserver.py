@@ -1,173 +1,227 @@
 #!/usr/bin/python3
 
-import dbus
-import dbus.exceptions
-import dbus.mainloop.glib
-import dbus.service
-import time
+# Imported first, the time from the process start to this import is the interpreter startup phase
+import gatt_example.gatt_base.gatt_lib_startup as gatt_startup
+
 import logging
 import argparse
-import threading
-
-from signal import signal, SIGTERM
-from sys import exit
-from logging.handlers import RotatingFileHandler
-
-try:
-    from gi.repository import GObject
-except ImportError:
-    import gobject as GObject
 
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_registration as gatt_registration
+import gatt_example.gatt_base.gatt_lib_scheduler as gatt_sched
+import gatt_example.gatt_base.gatt_lib_sessions as gatt_sessions
+import gatt_example.gatt_base.gatt_lib_shutdown as gatt_shutdown
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_profiler as gatt_profiler
+import gatt_example.gatt_base.gatt_lib_recorder as gatt_recorder
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
 import gatt_example.gatt_implementations.gatt_lib_cycling_power_service as gatt_cycl_pow
+import gatt_example.gatt_implementations.gatt_lib_cycling_speed_cadence_service as gatt_csc
+import gatt_example.gatt_implementations.gatt_lib_revolutions as gatt_revolutions
 import gatt_example.gatt_implementations.gatt_lib_device_information_service as gatt_dev
 import gatt_example.gatt_implementations.gatt_lib_custom_service as gatt_cust_srv
 import gatt_example.configuration.gatt_lib_config as gatt_config
 
-mainloop = None
+logger = gatt_log.get_logger('server')
 
 
-class Application(dbus.service.Object):
+class Application(gatt_dbus.Object):
     """
     org.bluez.GattApplication1 interface implementation
     
     """
 
     def __init__(self, bus):
-        logger = logging.getLogger("rotating.logger")
         self.path = '/'
         self.services = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self._managed_objects = None
+        self.scheduler = gatt_sched.NotificationScheduler()
+        self.sessions = gatt_sessions.SessionManager(bus)
+        # Crank and wheel revolutions shared by the Cycling Power and the Cycling Speed and Cadence services
+        self.revolutions = gatt_revolutions.RevolutionIngest(gatt_cycl_pow.open_sample_reader)
+        gatt_backend.get_backend().export_object(self, bus, self.path)
 
         self.add_service(gatt_dev.DeviceInformationService(bus, 0))
-        logger.debug('[%s] Adding Device Information service', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[SERVER] Adding Device Information service')
 
         self.add_service(gatt_cycl_pow.CyclingPowerService(bus, 1))
-        logger.debug('[%s] Adding Cycling power service', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[SERVER] Adding Cycling power service')
 
         self.add_service(gatt_cust_srv.CustomGattService(bus, 2))
-        logger.debug('[%s] Adding Custom service', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[SERVER] Adding Custom service')
+
+        self.add_service(gatt_csc.CyclingSpeedCadenceService(bus, 3))
+        logger.debug('[SERVER] Adding Cycling speed and cadence service')
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return gatt_dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
-
-    @dbus.service.method(gatt_var.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+        service.application = self
+        self.invalidate_managed_objects()
+
+    def stop_notifications(self):
+        self.scheduler.stop()
+
+    def subscriptions_lost(self, adapter, everything):
+        """
+        The registration with adapter was lost, with everything when no adapter is left: the devices of adapter
+        are gone and, once no adapter is left, so are the StartNotify subscriptions, which are not per adapter.
+
+        """
+        for device, session in list(self.sessions.sessions.items()):
+            if everything or session.adapter == adapter:
+                self.sessions.close(device)
+        if everything:
+            for service in self.services:
+                for chrc in service.get_characteristics():
+                    chrc.reset_notify()
+
+    def in_flight(self):
+        return any(chrc.in_flight() for service in self.services for chrc in service.get_characteristics())
+
+    def invalidate_managed_objects(self):
+        self._managed_objects = None
+
+    def get_managed_objects(self):
+        """
+        Snapshot of the object tree, rebuilt only after add_service, add_characteristic or add_descriptor.
+        The snapshot is handed out as is, it must not be mutated.
+
+        """
+        if self._managed_objects is None:
+            response = {}
+
+            for service in self.services:
+                response[service.get_path()] = service.get_properties()
+                chrcs = service.get_characteristics()
+                for chrc in chrcs:
+                    response[chrc.get_path()] = chrc.get_properties()
+                    descs = chrc.get_descriptors()
+                    for desc in descs:
+                        response[desc.get_path()] = desc.get_properties()
+            self._managed_objects = response
+        return self._managed_objects
+
+    @gatt_dbus.method(gatt_var.DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Get Managed Objects', time.strftime('%d/%m %H:%M:%S'))
-        response = {}
-
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-        return response
+        logger.debug('[SERVER] Get Managed Objects')
+        return self.get_managed_objects()
 
 
 def register_app_cb():
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] GATT application registered', time.strftime('%d/%m %H:%M:%S'))
+    logger.info('[SERVER] GATT application registered')
+    gatt_startup.done('application')
 
 
-def register_app_error_cb(error):
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] Failed to register application: %s', time.strftime('%d/%m %H:%M:%S'), str(error))
-
-    global mainloop
-    mainloop.quit()
-
-
-def find_adapter(bus):
-    remote_om = dbus.Interface(bus.get_object(gatt_var.BLUEZ_SERVICE_NAME, '/'),
-                               gatt_var.DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+def add_application(registrar, app):
+    """
+    Keep app registered through registrar. The one application, and so its shared notification sources and
+    encoded values, serves every adapter and outlives adapters and bluetoothd going away.
 
-    for o, props in objects.items():
-        if gatt_var.GATT_MANAGER_IFACE in props.keys():
-            return o
-    return None
+    """
+    registrar.add('GATT application', gatt_var.GATT_MANAGER_IFACE, 'RegisterApplication', 'UnregisterApplication',
+                  app.get_path(), register_app_cb, app.subscriptions_lost)
 
 
 def run_gatt_peripheral():
-    logger = logging.getLogger("rotating.logger")
-
-    global mainloop
 
-    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    backend = gatt_backend.get_backend()
 
-    bus = dbus.SystemBus()
-
-    adapter = find_adapter(bus)
-    if not adapter:
-        logger.debug('[%s] GattManager1 interface not found', time.strftime('%d/%m %H:%M:%S'))
-        return
-
-    service_manager = dbus.Interface(
-        bus.get_object(gatt_var.BLUEZ_SERVICE_NAME, adapter),
-        gatt_var.GATT_MANAGER_IFACE)
+    bus = backend.connect_system_bus()
+    gatt_startup.mark('bus')
+    shutdown = gatt_shutdown.GracefulShutdown(bus).install()
+    exporter = gatt_metrics.start_exporter('server')
+    if exporter is not None:
+        shutdown.on_stop(exporter.stop)
+    profiler = gatt_profiler.install('server', bus)
+    shutdown.on_stop(profiler.stop)
+    recorder = gatt_recorder.start_recording()
+    if recorder is not None:
+        shutdown.on_stop(recorder.stop)
 
     app = Application(bus)
+    app.sessions.start()
+    gatt_startup.mark('export')
 
-    mainloop = GObject.MainLoop()
-
-    logger.debug('[%s] Registering GATT application', time.strftime('%d/%m %H:%M:%S'))
-
-    service_manager.RegisterApplication(app.get_path(), {},
-                                        reply_handler=register_app_cb,
-                                        error_handler=register_app_error_cb)
-    logger.debug('[%s] Registering services', time.strftime('%d/%m %H:%M:%S'))
-
-    mainloop.run()
-
+    registrar = gatt_registration.Registrar(bus, shutdown, gatt_config.all_adapters)
+    add_application(registrar, app)
+    registrar.start()
+    gatt_startup.mark('adapter')
+    logger.debug('[SERVER] Registering services')
 
-def signal_handle(signum, frame):
-    logger = logging.getLogger("rotating.logger")
-    logger.debug('[%s] SIGTERM Received, exiting', time.strftime('%d/%m %H:%M:%S'))
-    gatt_var.sigterm_thread_exit = True
-
-    global mainloop
-    mainloop.quit()
-    sleepTime = 5
-    time.sleep(sleepTime)
-    exit(0)
+    shutdown.on_stop(app.stop_notifications)
+    shutdown.on_stop(app.sessions.stop)
+    shutdown.on_drain(app.in_flight)
+    backend.run()
 
 
 def main():
-    GObject.threads_init()
-
-    # Catch SIGTERM and do a normal exit
-    signal(SIGTERM, signal_handle)
-
-    logger = logging.getLogger("rotating.logger")
-    log_file_bytes = 1048576 * 5
-    log_files = 3
-    logging_file = '/var/log/GattLogs/Gattperipheral.log'
-    logger.setLevel(logging.DEBUG)
-    rotating_handler = RotatingFileHandler(logging_file, maxBytes=log_file_bytes, backupCount=log_files)
-    logger.addHandler(rotating_handler)
-    logger.debug('[%s] ----NEW RUN----', time.strftime('%d/%m %H:%M:%S'))
+    gatt_startup.mark('imports')
 
     parser = argparse.ArgumentParser()
     parser.add_argument("-D", action="store_true")
+    parser.add_argument("-l", "--log-file", default='/var/log/GattLogs/Gattperipheral.log')
+    parser.add_argument("-L", "--log-level", action="append", default=[], type=gatt_log.level_override,
+                        metavar="SUBSYSTEM=LEVEL",
+                        help="Log level of a single subsystem, may be repeated")
+    parser.add_argument("-s", "--sample-ring", default=None, help="Shared memory sample ring written by a producer")
+    parser.add_argument("-b", "--backend", choices=sorted(gatt_backend.BACKENDS), default='glib',
+                        help="D-Bus backend, dbus-python on GLib or the wire protocol on asyncio")
+    parser.add_argument("-a", "--all-adapters", action="store_true",
+                        help="Serve on every adapter, including adapters plugged in later")
+    parser.add_argument("--no-acquire", action="store_true",
+                        help="Do not offer the AcquireNotify/AcquireWrite socket fast path to BlueZ")
+    parser.add_argument("--profile-rate", type=int, default=None, metavar="HZ",
+                        help="Samples per second of the profiler started by SIGUSR1 and stopped by SIGUSR2")
+    parser.add_argument("--profile-dir", default=None, help="Directory the profiler writes its collapsed stacks to")
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="Record the GATT traffic to this file until shutdown, for Gattreplay")
+    parser.add_argument("--metrics-socket", default=None, metavar="PATH",
+                        help="Serve the metrics in the Prometheus text format on this Unix socket")
+    parser.add_argument("--metrics-textfile", default=None, metavar="PATH",
+                        help="Write the metrics in the Prometheus text format to this file, for the textfile collector")
     args = parser.parse_args()
+    backend = gatt_backend.set_backend(gatt_backend.BACKENDS[args.backend]())
+    if args.backend == 'glib':
+        backend.GObject.threads_init()
+    gatt_startup.mark('backend')
     if args.D:
-        logger.debug('[%s] Full Debugging enabled', time.strftime('%d/%m %H:%M:%S'))
-        gatt_config.debug_log = True
-
-    global mainloop
+        gatt_config.log_level = logging.DEBUG
+    gatt_config.log_levels.update(gatt_log.parse_level_overrides(args.log_level))
+    if args.no_acquire:
+        gatt_config.acquire_fd = False
+    if args.all_adapters:
+        gatt_config.all_adapters = True
+    if args.record:
+        gatt_config.record_path = args.record
+    if args.metrics_socket:
+        gatt_config.metrics_socket_path = args.metrics_socket
+    if args.metrics_textfile:
+        gatt_config.metrics_textfile_path = args.metrics_textfile
+    if args.profile_rate:
+        gatt_config.profiler_rate_hz = args.profile_rate
+    if args.profile_dir:
+        gatt_config.profiler_dir = args.profile_dir
+
+    gatt_log.setup_logging(args.log_file)
+    logger.info('[SERVER] ----NEW RUN----')
+    gatt_startup.begin('server', 'application')
+    if args.D:
+        logger.info('[SERVER] Full Debugging enabled')
 
-    logger.debug('[%s] Initialising Gatt Peripheral service', time.strftime('%d/%m %H:%M:%S'))
-    gatt_server_thread = threading.Thread(target=run_gatt_peripheral)
-    gatt_server_thread.start()
+    if args.sample_ring:
+        logger.info('[SERVER] Reading samples from %s', args.sample_ring)
+        gatt_config.sample_ring_path = args.sample_ring
 
-    gatt_server_thread.join()
+    logger.info('[SERVER] Using the %s D-Bus backend', backend.name)
+    logger.info('[SERVER] Initialising Gatt Peripheral service')
+    # On the main thread, the shutdown runs on the main loop from SIGTERM and SIGINT
+    run_gatt_peripheral()
+    gatt_log.flush_logging()
 
 
 if __name__ == '__main__':
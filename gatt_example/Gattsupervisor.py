@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+# Imported first, the time from the process start to this import is the interpreter startup phase
+import gatt_example.gatt_base.gatt_lib_startup as gatt_startup
+
+import logging
+import argparse
+
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_registration as gatt_registration
+import gatt_example.gatt_base.gatt_lib_shutdown as gatt_shutdown
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_profiler as gatt_profiler
+import gatt_example.gatt_base.gatt_lib_recorder as gatt_recorder
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+import gatt_example.Gattserver as gatt_server
+import gatt_example.Gattadvertiser as gatt_advertiser
+
+logger = gatt_log.get_logger('supervisor')
+
+
+class Supervisor(object):
+    """
+    Hosts the GATT application and the advertisement on one bus connection and one main loop.
+
+    Registration is ordered per adapter: the advertisement is registered once the application is, so a central
+    never finds the device advertised without its services. The shutdown unregisters them the other way around.
+
+    """
+
+    def __init__(self, bus, shutdown):
+        self.bus = bus
+        self.shutdown = shutdown
+        self.app = None
+        self.advertisement = None
+        self.registrar = None
+
+    def start(self):
+        self.advertisement = gatt_advertiser.create_advertisement(self.bus)
+        if not gatt_advertiser.prepare_advertisement(self.advertisement):
+            gatt_startup.status('Advertisement does not fit')
+            return False
+
+        self.app = gatt_server.Application(self.bus)
+        self.app.sessions.start()
+        gatt_startup.mark('export')
+
+        self.shutdown.on_stop(self.advertisement.stop_updates)
+        self.shutdown.on_stop(self.app.stop_notifications)
+        self.shutdown.on_stop(self.app.sessions.stop)
+        self.shutdown.on_drain(self.app.in_flight)
+
+        # Only adapters with both GattManager1 and LEAdvertisingManager1 are served
+        self.registrar = gatt_registration.Registrar(self.bus, self.shutdown, gatt_config.all_adapters)
+        gatt_server.add_application(self.registrar, self.app)
+        gatt_advertiser.add_advertisement(self.registrar, self.advertisement)
+        self.registrar.start()
+        gatt_startup.mark('adapter')
+        return True
+
+
+def run_supervisor():
+    backend = gatt_backend.get_backend()
+
+    bus = backend.connect_system_bus()
+    gatt_startup.mark('bus')
+
+    shutdown = gatt_shutdown.GracefulShutdown(bus).install()
+    exporter = gatt_metrics.start_exporter('supervisor')
+    if exporter is not None:
+        shutdown.on_stop(exporter.stop)
+    profiler = gatt_profiler.install('supervisor', bus)
+    shutdown.on_stop(profiler.stop)
+    recorder = gatt_recorder.start_recording()
+    if recorder is not None:
+        shutdown.on_stop(recorder.stop)
+    supervisor = Supervisor(bus, shutdown)
+    if supervisor.start():
+        logger.debug('[SUPERVISOR] Mainloop started')
+        backend.run()
+    gatt_log.flush_logging()
+
+
+def main():
+    gatt_startup.mark('imports')
+    parser = argparse.ArgumentParser(description='GATT server and advertiser in one process')
+    parser.add_argument("-D", action="store_true")
+    parser.add_argument("-l", "--log-file", default='/var/log/GattLogs/Gattsupervisor.log')
+    parser.add_argument("-L", "--log-level", action="append", default=[], type=gatt_log.level_override,
+                        metavar="SUBSYSTEM=LEVEL",
+                        help="Log level of a single subsystem, may be repeated")
+    parser.add_argument("-s", "--sample-ring", default=None, help="Shared memory sample ring written by a producer")
+    parser.add_argument("-b", "--backend", choices=sorted(gatt_backend.BACKENDS), default='glib',
+                        help="D-Bus backend, dbus-python on GLib or the wire protocol on asyncio")
+    parser.add_argument("-a", "--all-adapters", action="store_true",
+                        help="Serve and advertise on every adapter, including adapters plugged in later")
+    parser.add_argument("--no-acquire", action="store_true",
+                        help="Do not offer the AcquireNotify/AcquireWrite socket fast path to BlueZ")
+    advertising_mode = parser.add_mutually_exclusive_group()
+    advertising_mode.add_argument("-r", "--rotate", type=int, default=None, metavar="MS",
+                                  help="Rotate between the advertisement sets every MS milliseconds")
+    advertising_mode.add_argument("--broadcast", type=int, default=None, metavar="MS",
+                                  help="Broadcast the live power in the service data, updated every MS milliseconds")
+    parser.add_argument("--profile-rate", type=int, default=None, metavar="HZ",
+                        help="Samples per second of the profiler started by SIGUSR1 and stopped by SIGUSR2")
+    parser.add_argument("--profile-dir", default=None, help="Directory the profiler writes its collapsed stacks to")
+    parser.add_argument("--record", default=None, metavar="PATH",
+                        help="Record the GATT traffic to this file until shutdown, for Gattreplay")
+    parser.add_argument("--metrics-socket", default=None, metavar="PATH",
+                        help="Serve the metrics in the Prometheus text format on this Unix socket")
+    parser.add_argument("--metrics-textfile", default=None, metavar="PATH",
+                        help="Write the metrics in the Prometheus text format to this file, for the textfile collector")
+    args = parser.parse_args()
+    backend = gatt_backend.set_backend(gatt_backend.BACKENDS[args.backend]())
+    if args.backend == 'glib':
+        backend.GObject.threads_init()
+    gatt_startup.mark('backend')
+    if args.D:
+        gatt_config.log_level = logging.DEBUG
+    gatt_config.log_levels.update(gatt_log.parse_level_overrides(args.log_level))
+    if args.no_acquire:
+        gatt_config.acquire_fd = False
+    if args.all_adapters:
+        gatt_config.all_adapters = True
+    if args.rotate:
+        gatt_config.advertising_rotation_ms = args.rotate
+    if args.broadcast:
+        gatt_config.broadcast_ms = args.broadcast
+    if args.sample_ring:
+        gatt_config.sample_ring_path = args.sample_ring
+    if args.record:
+        gatt_config.record_path = args.record
+    if args.metrics_socket:
+        gatt_config.metrics_socket_path = args.metrics_socket
+    if args.metrics_textfile:
+        gatt_config.metrics_textfile_path = args.metrics_textfile
+    if args.profile_rate:
+        gatt_config.profiler_rate_hz = args.profile_rate
+    if args.profile_dir:
+        gatt_config.profiler_dir = args.profile_dir
+
+    gatt_log.setup_logging(args.log_file)
+    logger.info('[SUPERVISOR] ----NEW RUN----')
+    gatt_startup.begin('supervisor', 'application', 'advertisement')
+    if args.D:
+        logger.info('[SUPERVISOR] Full Debugging enabled')
+
+    logger.info('[SUPERVISOR] Using the %s D-Bus backend', backend.name)
+    run_supervisor()
+
+
+if __name__ == '__main__':
+    main()
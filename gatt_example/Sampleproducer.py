@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+import math
+import time
+import argparse
+
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+
+
+def run_sample_producer(path, rate, capacity, duration, cadence=90.0, wheel_rpm=240.0):
+    """
+    Reference producer, writes a synthetic power curve into the sample ring at the requested rate, with the pedal
+    force and crank angle of a rider pedalling at cadence rpm and the count of a wheel turning at wheel_rpm.
+
+    """
+    writer = gatt_ring.SampleRingWriter(path, capacity=capacity)
+    period = 1.0 / rate
+    values = [0.0] * writer.channels
+
+    start = time.monotonic()
+    deadline = start
+    written = 0
+    try:
+        while duration is None or deadline - start < duration:
+            now = time.monotonic()
+            if now < deadline:
+                time.sleep(deadline - now)
+            values[gatt_ring.CHANNEL_POWER] = 200.0 + 50.0 * math.sin(deadline - start)
+            angle = (deadline - start) * cadence * 6.0 % 360.0
+            # Most of the force on the down stroke, a little pull on the up stroke
+            values[gatt_ring.CHANNEL_FORCE] = 150.0 + 250.0 * math.sin(math.radians(angle))
+            values[gatt_ring.CHANNEL_CRANK_ANGLE] = angle
+            values[gatt_ring.CHANNEL_WHEEL_REVOLUTIONS] = float(int((deadline - start) * wheel_rpm / 60.0))
+            writer.write(values, deadline)
+            written += 1
+            deadline += period
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+
+    elapsed = time.monotonic() - start
+    print('Wrote %d samples in %.2f s (%.0f samples/s)' % (written, elapsed, written / elapsed if elapsed else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="Sample ring file, e.g. /dev/shm/gatt_samples")
+    parser.add_argument("-r", "--rate", type=float, default=1000.0, help="Samples per second")
+    parser.add_argument("-c", "--capacity", type=int, default=4096, help="Ring capacity in samples")
+    parser.add_argument("-d", "--duration", type=float, default=None, help="Seconds to run, forever if omitted")
+    parser.add_argument("--cadence", type=float, default=90.0, help="Crank revolutions per minute")
+    parser.add_argument("--wheel-rpm", type=float, default=240.0, help="Wheel revolutions per minute")
+    args = parser.parse_args()
+
+    run_sample_producer(args.path, args.rate, args.capacity, args.duration, args.cadence, args.wheel_rpm)
+
+
+if __name__ == '__main__':
+    main()
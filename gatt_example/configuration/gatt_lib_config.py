@@ -1 +1,49 @@
-debug_log = False
+import logging
+
+# Default level of every logging subsystem, -D on the command line lowers it to DEBUG
+log_level = logging.INFO
+# Per subsystem overrides, e.g. {'cycling_power': logging.DEBUG}
+log_levels = {}
+
+sample_ring_path = None
+
+# Offer BlueZ the AcquireNotify/AcquireWrite socket fast path on the characteristics that support it
+acquire_fd = True
+
+# Register on every adapter, including adapters plugged in later, instead of the first one found
+all_adapters = False
+
+# Per connected device cap of notifications per second, None for no cap, and the burst allowed above it
+session_notify_rate = None
+session_notify_burst = 4
+
+# Period of the rotation between the advertisement sets of the advertiser, None to always advertise the first one
+advertising_rotation_ms = None
+
+# Period of the live power broadcast in the advertisement's service data, None to not broadcast
+broadcast_ms = None
+
+# Graceful shutdown: how long notifications in flight may delay the unregistration, and the bound on the whole
+# shutdown from the signal to the main loop quitting
+shutdown_drain_ms = 500
+shutdown_deadline_ms = 2000
+
+# Backoff of the adapter discovery and of the registrations with BlueZ, after a failure or a bluetoothd restart:
+# the first retry delay, doubled on each failure up to the maximum
+registration_retry_ms = 250
+registration_retry_max_ms = 30000
+
+# Metrics in the Prometheus text format: served on a Unix socket and/or written to a node_exporter textfile
+# collector file every metrics_textfile_ms, None to not export
+metrics_socket_path = None
+metrics_textfile_path = None
+metrics_textfile_ms = 10000
+
+# Sampling profiler started by SIGUSR1 and stopped by SIGUSR2: samples per second of the main loop stack, and where
+# the collapsed stacks are written
+profiler_rate_hz = 100
+profiler_dir = '/var/log/GattLogs'
+
+# GATT traffic recorded for Gattreplay: the memory mapped file, None to not record, and its size
+record_path = None
+record_size_mb = 64
@@ -0,0 +1,152 @@
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('ad_compiler')
+
+# Advertising data payload of legacy and of extended advertising PDUs
+LEGACY_PAYLOAD_SIZE = 31
+EXTENDED_PAYLOAD_SIZE = 251
+
+# Every AD structure is a length byte and a type byte followed by its data
+AD_HEADER_SIZE = 2
+FLAGS_SIZE = 1
+TX_POWER_SIZE = 1
+MANUFACTURER_ID_SIZE = 2
+
+BASE_UUID_SUFFIX = '-0000-1000-8000-00805f9b34fb'
+UUID_SIZES = {4: 2, 8: 4, 36: 16}
+
+# What to do with a local name that does not fit: cut it (BlueZ sends it as a shortened name), leave it out or
+# refuse to compile
+NAME_SHORTEN = 'shorten'
+NAME_DROP = 'drop'
+NAME_STRICT = 'strict'
+
+
+def shortest_uuid(uuid):
+    """
+    The 16 or 32 bit form of a UUID based on the Bluetooth base UUID, any other UUID as 128 bit, lower case.
+
+    """
+    uuid = str(uuid).lower()
+    if len(uuid) == 36 and uuid.endswith(BASE_UUID_SUFFIX):
+        uuid = uuid[:8]
+    if len(uuid) == 8 and uuid.startswith('0000'):
+        uuid = uuid[4:]
+
+    digits = uuid.replace('-', '')
+    if len(uuid) not in UUID_SIZES or len(digits) * 4 != UUID_SIZES[len(uuid)] * 8 or \
+            digits.strip('0123456789abcdef'):
+        raise ValueError('Invalid UUID %s' % uuid)
+    return uuid
+
+
+def uuid_size(uuid):
+    return UUID_SIZES[len(uuid)]
+
+
+def uuid_list_size(uuids):
+    # One AD structure per UUID width present in the list
+    widths = {}
+    for uuid in uuids:
+        widths[uuid_size(uuid)] = widths.get(uuid_size(uuid), 0) + uuid_size(uuid)
+    return sum(AD_HEADER_SIZE + size for size in widths.values())
+
+
+def truncate_utf8(text, size):
+    """
+    The longest prefix of text that is at most size bytes of UTF-8, without cutting a character.
+
+    """
+    return text.encode('utf-8')[:max(0, size)].decode('utf-8', 'ignore')
+
+
+class CompiledAdvertisement(object):
+    """
+    The LEAdvertisement1 properties of an advertisement and the on-air size of the AD structures BlueZ builds
+    from them. properties is shared with every GetAll, it must not be mutated.
+
+    """
+
+    def __init__(self, ad_type, payload_size, properties, sections):
+        self.ad_type = ad_type
+        self.payload_size = payload_size
+        self.properties = properties
+        self.sections = sections
+        self.size = sum(size for name, size in sections)
+
+    def describe(self):
+        return '%d/%d B (%s)' % (self.size, self.payload_size,
+                                 ', '.join('%s %d' % (name, size) for name, size in self.sections))
+
+
+def compile_advertisement(data, ad_type, payload_size=LEGACY_PAYLOAD_SIZE):
+    """
+    Compile AdvertisementData into LEAdvertisement1 properties that fit payload_size bytes of advertising data,
+    raise ValueError when they cannot. UUIDs are sent in their shortest form and the local name goes last,
+    applying data.name_policy to whatever space is left.
+
+    """
+    properties = {'Type': ad_type}
+    sections = []
+
+    # BlueZ adds the Flags structure (LE General Discoverable, BR/EDR not supported) to connectable advertisements
+    if ad_type == 'peripheral':
+        sections.append(('flags', AD_HEADER_SIZE + FLAGS_SIZE))
+
+    if data.service_uuids:
+        uuids = [shortest_uuid(uuid) for uuid in data.service_uuids]
+        properties['ServiceUUIDs'] = gatt_dbus.Array(uuids, signature='s')
+        sections.append(('service uuids', uuid_list_size(uuids)))
+
+    if data.solicit_uuids:
+        uuids = [shortest_uuid(uuid) for uuid in data.solicit_uuids]
+        properties['SolicitUUIDs'] = gatt_dbus.Array(uuids, signature='s')
+        sections.append(('solicit uuids', uuid_list_size(uuids)))
+
+    if data.manufacturer_data:
+        manufacturer_data = gatt_dbus.Dictionary({}, signature='qv')
+        size = 0
+        for manufacturer_id, value in sorted(data.manufacturer_data.items()):
+            manufacturer_data[gatt_dbus.UInt16(manufacturer_id)] = gatt_dbus.Array(value, signature='y')
+            size += AD_HEADER_SIZE + MANUFACTURER_ID_SIZE + len(value)
+        properties['ManufacturerData'] = manufacturer_data
+        sections.append(('manufacturer data', size))
+
+    if data.service_data:
+        service_data = gatt_dbus.Dictionary({}, signature='sv')
+        size = 0
+        for uuid, value in sorted(data.service_data.items()):
+            uuid = shortest_uuid(uuid)
+            service_data[uuid] = gatt_dbus.Array(value, signature='y')
+            size += AD_HEADER_SIZE + uuid_size(uuid) + len(value)
+        properties['ServiceData'] = service_data
+        sections.append(('service data', size))
+
+    if data.include_tx_power:
+        properties['IncludeTxPower'] = gatt_dbus.Boolean(True)
+        sections.append(('tx power', AD_HEADER_SIZE + TX_POWER_SIZE))
+
+    if payload_size > LEGACY_PAYLOAD_SIZE:
+        # Makes BlueZ use extended advertising PDUs
+        properties['SecondaryChannel'] = gatt_dbus.String('1M')
+
+    used = sum(size for name, size in sections)
+    if used > payload_size:
+        raise ValueError('Advertisement needs %d B without the local name, %d B available' % (used, payload_size))
+
+    if data.local_name:
+        name = data.local_name
+        available = payload_size - used - AD_HEADER_SIZE
+        if len(name.encode('utf-8')) > available:
+            if data.name_policy == NAME_STRICT:
+                raise ValueError('Local name of %d B does not fit the %d B left' % (len(name.encode('utf-8')),
+                                                                                    max(0, available)))
+            name = truncate_utf8(name, available) if data.name_policy == NAME_SHORTEN else ''
+            logger.warning('[AD-COMPILER] Local name %r does not fit, %s', data.local_name,
+                           'shortened to %r' % name if name else 'left out')
+        if name:
+            properties['LocalName'] = gatt_dbus.String(name)
+            sections.append(('local name', AD_HEADER_SIZE + len(name.encode('utf-8'))))
+
+    return CompiledAdvertisement(ad_type, payload_size, properties, sections)
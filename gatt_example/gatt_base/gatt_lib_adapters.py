@@ -0,0 +1,180 @@
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('adapters')
+
+DBUS_SERVICE_NAME = 'org.freedesktop.DBus'
+
+
+def retry_delay_ms(attempt):
+    """
+    Exponential backoff from registration_retry_ms, doubling up to registration_retry_max_ms.
+
+    """
+    return min(gatt_config.registration_retry_max_ms, gatt_config.registration_retry_ms * 2 ** min(attempt, 16))
+
+
+class AdapterManager(object):
+    """
+    Tracks every usable adapter exposing interface (GattManager1, LEAdvertisingManager1, or a tuple of them that
+    must all be there) through the BlueZ ObjectManager.
+
+    An adapter becomes usable once found and powered, on_added(path) is then called. on_removed(path) is called when
+    it stops being usable: removed, powered off or gone with bluetoothd, and with it every application or
+    advertisement registered on it. When bluetoothd comes back on the bus its adapters are discovered again,
+    retrying with backoff until GetManagedObjects answers.
+
+    """
+
+    def __init__(self, bus, interface, on_added=None, on_removed=None, power=True):
+        self.bus = bus
+        self.interfaces = (interface,) if isinstance(interface, str) else tuple(interface)
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.power = power
+        self.adapters = {}
+        self.ready = set()
+        self.bluez_restarts = 0
+        self._receivers = []
+        self._discovery_attempt = 0
+        self._discovery_source = None
+
+    def start(self):
+        backend = gatt_backend.get_backend()
+
+        # Subscribe first, an adapter appearing in between is then seen twice instead of never
+        for member, handler in (('InterfacesAdded', self._interfaces_added),
+                                ('InterfacesRemoved', self._interfaces_removed)):
+            self._receivers.append(backend.add_signal_receiver(self.bus, handler, gatt_var.BLUEZ_SERVICE_NAME,
+                                                               gatt_var.DBUS_OM_IFACE, member))
+        self._receivers.append(backend.add_signal_receiver(self.bus, self._properties_changed,
+                                                           gatt_var.BLUEZ_SERVICE_NAME, gatt_var.DBUS_PROP_IFACE,
+                                                           'PropertiesChanged', path_keyword='path'))
+        self._receivers.append(backend.add_signal_receiver(self.bus, self._name_owner_changed, DBUS_SERVICE_NAME,
+                                                           DBUS_SERVICE_NAME, 'NameOwnerChanged'))
+
+        try:
+            objects = backend.call_method_sync(self.bus, gatt_var.BLUEZ_SERVICE_NAME, '/', gatt_var.DBUS_OM_IFACE,
+                                               'GetManagedObjects')
+        except Exception as error:
+            logger.warning('[ADAPTERS] BlueZ not available yet: %s', error)
+            self._schedule_discovery()
+            return self
+        self._objects_discovered(objects)
+        return self
+
+    def stop(self):
+        backend = gatt_backend.get_backend()
+        for receiver in self._receivers:
+            backend.remove_signal_receiver(self.bus, receiver)
+        self._receivers = []
+        if self._discovery_source is not None:
+            backend.source_remove(self._discovery_source)
+            self._discovery_source = None
+
+    def _discover(self):
+        self._discovery_source = None
+        gatt_backend.get_backend().call_method(self.bus, gatt_var.BLUEZ_SERVICE_NAME, '/', gatt_var.DBUS_OM_IFACE,
+                                               'GetManagedObjects', reply_handler=self._objects_discovered,
+                                               error_handler=self._discovery_failed)
+        return False
+
+    def _schedule_discovery(self):
+        if self._discovery_source is not None:
+            return
+        delay_ms = retry_delay_ms(self._discovery_attempt)
+        self._discovery_attempt += 1
+        self._discovery_source = gatt_backend.get_backend().timeout_add(delay_ms, self._discover)
+
+    def _discovery_failed(self, error):
+        logger.warning('[ADAPTERS] Adapter discovery failed, retrying: %s', error)
+        self._schedule_discovery()
+
+    def _objects_discovered(self, objects):
+        self._discovery_attempt = 0
+        for path, interfaces in sorted(objects.items()):
+            self._interfaces_added(path, interfaces)
+
+    def _name_owner_changed(self, name, old_owner, new_owner):
+        if name != gatt_var.BLUEZ_SERVICE_NAME:
+            return
+
+        if old_owner:
+            logger.warning('[ADAPTERS] BlueZ left the bus, %d adapters lost', len(self.adapters))
+            # All gone at once, none is offered as a replacement for another
+            lost = sorted(self.ready)
+            self.adapters.clear()
+            self.ready.clear()
+            for path in lost:
+                if self.on_removed is not None:
+                    self.on_removed(path)
+        if new_owner:
+            self.bluez_restarts += 1
+            logger.info('[ADAPTERS] BlueZ is on the bus as %s, discovering adapters', new_owner)
+            self._discovery_attempt = 0
+            if self._discovery_source is not None:
+                gatt_backend.get_backend().source_remove(self._discovery_source)
+                self._discovery_source = None
+            self._discover()
+
+    def _interfaces_added(self, path, interfaces):
+        path = str(path)
+        if any(interface not in interfaces for interface in self.interfaces) or path in self.adapters:
+            return
+
+        properties = dict(interfaces.get(gatt_var.ADAPTER_IFACE, {}))
+        self.adapters[path] = properties
+        logger.info('[ADAPTERS] Adapter %s (%s) found', path, properties.get('Address', 'unknown address'))
+
+        if self.power and not properties.get('Powered', False):
+            self._power(path)
+        else:
+            self._adapter_ready(path)
+
+    def _power(self, path):
+        gatt_backend.get_backend().call_method(
+            self.bus, gatt_var.BLUEZ_SERVICE_NAME, path, gatt_var.DBUS_PROP_IFACE, 'Set', 'ssv',
+            [gatt_var.ADAPTER_IFACE, 'Powered', gatt_dbus.Boolean(True)],
+            reply_handler=lambda *reply: self._adapter_ready(path),
+            error_handler=lambda error: logger.error('[ADAPTERS] Could not power %s: %s', path, error))
+
+    def _adapter_ready(self, path):
+        if path not in self.adapters or path in self.ready:
+            return
+
+        self.adapters[path]['Powered'] = True
+        self.ready.add(path)
+        if self.on_added is not None:
+            self.on_added(path)
+
+    def _adapter_lost(self, path):
+        if path not in self.ready:
+            return
+
+        self.ready.discard(path)
+        if self.on_removed is not None:
+            self.on_removed(path)
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        path = str(path)
+        if interface != gatt_var.ADAPTER_IFACE or 'Powered' not in changed or path not in self.adapters:
+            return
+
+        self.adapters[path]['Powered'] = bool(changed['Powered'])
+        if changed['Powered']:
+            self._adapter_ready(path)
+        else:
+            logger.warning('[ADAPTERS] Adapter %s powered off', path)
+            self._adapter_lost(path)
+
+    def _interfaces_removed(self, path, interfaces):
+        path = str(path)
+        if not any(interface in interfaces for interface in self.interfaces) or path not in self.adapters:
+            return
+
+        del self.adapters[path]
+        logger.info('[ADAPTERS] Adapter %s removed', path)
+        self._adapter_lost(path)
@@ -1,87 +1,245 @@
-import dbus
-import dbus.service
-import time
-import logging
-
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
 import gatt_example.gatt_base.gatt_lib_variables as gatt_vars
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_ad_compiler as gatt_ad_comp
 
+logger = gatt_log.get_logger('advertisement')
 
-class Advertisement(dbus.service.Object):
-    PATH_BASE = '/org/bluez/example/advertisement'
 
-    def __init__(self, bus, index, advertising_type):
-        self.path = self.PATH_BASE + str(index)
-        self.bus = bus
-        self.ad_type = advertising_type
+class AdvertisementData(object):
+    """
+    Content of an advertisement. It is compiled once into the LEAdvertisement1 properties, which stay frozen until
+    one of the mutators changes the content.
+
+    """
+
+    def __init__(self, name_policy=gatt_ad_comp.NAME_SHORTEN):
         self.service_uuids = None
         self.manufacturer_data = None
         self.solicit_uuids = None
         self.service_data = None
         self.local_name = None
         self.include_tx_power = None
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.name_policy = name_policy
+        self._compiled = None
 
-    def get_properties(self):
-        properties = dict()
-        properties['Type'] = self.ad_type
-        if self.service_uuids is not None:
-            properties['ServiceUUIDs'] = dbus.Array(self.service_uuids,
-                                                    signature='s')
-        if self.solicit_uuids is not None:
-            properties['SolicitUUIDs'] = dbus.Array(self.solicit_uuids,
-                                                    signature='s')
-        if self.manufacturer_data is not None:
-            properties['ManufacturerData'] = dbus.Dictionary(
-                self.manufacturer_data, signature='qv')
-        if self.service_data is not None:
-            properties['ServiceData'] = dbus.Dictionary(self.service_data,
-                                                        signature='sv')
-        if self.local_name is not None:
-            properties['LocalName'] = dbus.String(self.local_name)
-        if self.include_tx_power is not None:
-            properties['IncludeTxPower'] = dbus.Boolean(self.include_tx_power)
-        return {gatt_vars.LE_ADVERTISEMENT_IFACE: properties}
+    def invalidate(self):
+        self._compiled = None
 
-    def get_path(self):
-        return dbus.ObjectPath(self.path)
+    def compile(self, ad_type, payload_size=gatt_ad_comp.LEGACY_PAYLOAD_SIZE):
+        compiled = self._compiled
+        if compiled is None or compiled.ad_type != ad_type or compiled.payload_size != payload_size:
+            compiled = self._compiled = gatt_ad_comp.compile_advertisement(self, ad_type, payload_size)
+        return compiled
 
     def add_service_uuid(self, uuid):
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
+        self.invalidate()
 
     def add_solicit_uuid(self, uuid):
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
+        self.invalidate()
 
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
-            self.manufacturer_data = dbus.Dictionary({}, signature='qv')
-        self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
+            self.manufacturer_data = {}
+        self.manufacturer_data[manuf_code] = bytes(data)
+        self.invalidate()
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
-            self.service_data = dbus.Dictionary({}, signature='sv')
-        self.service_data[uuid] = dbus.Array(data, signature='y')
+            self.service_data = {}
+        self.service_data[uuid] = bytes(data)
+        self.invalidate()
 
     def add_local_name(self, name):
-        if not self.local_name:
-            self.local_name = ""
-        self.local_name = dbus.String(name)
+        self.local_name = str(name)
+        self.invalidate()
+
+    def set_include_tx_power(self, include):
+        self.include_tx_power = include
+        self.invalidate()
+
+    def update_service_data(self, uuid, data):
+        """
+        Replace the service data of uuid, return the name of the changed property or None when the value is the
+        same. A value of the same length cannot change the size, it replaces the property in a copy of the compiled
+        properties instead of compiling them all again.
+
+        """
+        return self._update_data('service_data', 'ServiceData', uuid, gatt_ad_comp.shortest_uuid(uuid), data)
+
+    def update_manufacturer_data(self, manuf_code, data):
+        return self._update_data('manufacturer_data', 'ManufacturerData', manuf_code, manuf_code, data)
+
+    def _update_data(self, attribute, name, key, compiled_key, data):
+        data = bytes(data)
+        values = getattr(self, attribute)
+        previous = values.get(key) if values else None
+        if previous == data:
+            return None
 
-    @dbus.service.method(gatt_vars.DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
+        if previous is None or len(previous) != len(data) or self._compiled is None:
+            if not values:
+                values = {}
+                setattr(self, attribute, values)
+            values[key] = data
+            self.invalidate()
+        else:
+            values[key] = data
+            # The compiled properties may still be referenced by a GetAll reply, they are copied, never patched
+            compiled = self._compiled
+            properties = dict(compiled.properties)
+            properties[name] = gatt_dbus.Dictionary(properties[name], signature=properties[name].signature)
+            properties[name][compiled_key] = gatt_dbus.Array(data, signature='y')
+            self._compiled = gatt_ad_comp.CompiledAdvertisement(compiled.ad_type, compiled.payload_size, properties,
+                                                                compiled.sections)
+        return name
+
+
+@gatt_metrics.instrumented('advertisement')
+class Advertisement(gatt_dbus.Object):
+    """
+    org.bluez.LEAdvertisement1 interface implementation
+
+    The properties are compiled from data, checked against payload_size bytes of advertising data (legacy by
+    default, up to gatt_lib_ad_compiler.EXTENDED_PAYLOAD_SIZE for extended advertising). start_rotation()
+    advertises several AdvertisementData in turn and update_service_data()/update_manufacturer_data() publish live
+    values, BlueZ updates the advertising data on PropertiesChanged without registering the advertisement again.
+
+    """
+    PATH_BASE = '/org/bluez/example/advertisement'
+
+    def __init__(self, bus, index, advertising_type, payload_size=gatt_ad_comp.LEGACY_PAYLOAD_SIZE):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.ad_type = advertising_type
+        self.payload_size = payload_size
+        self.data = AdvertisementData()
+        self._rotation = None
+        self._rotation_index = 0
+        self._rotation_source = None
+        self._properties_changed = gatt_metrics.PROPERTIES_CHANGED.labels(self.path)
+        gatt_backend.get_backend().export_object(self, bus, self.path)
+
+    def compile(self):
+        """
+        Compile the current data, raise ValueError when it does not fit the payload.
+
+        """
+        return self.data.compile(self.ad_type, self.payload_size)
+
+    def get_properties(self):
+        return {gatt_vars.LE_ADVERTISEMENT_IFACE: self.compile().properties}
+
+    def get_path(self):
+        return gatt_dbus.ObjectPath(self.path)
+
+    def add_service_uuid(self, uuid):
+        self.data.add_service_uuid(uuid)
+
+    def add_solicit_uuid(self, uuid):
+        self.data.add_solicit_uuid(uuid)
+
+    def add_manufacturer_data(self, manuf_code, data):
+        self.data.add_manufacturer_data(manuf_code, data)
+
+    def add_service_data(self, uuid, data):
+        self.data.add_service_data(uuid, data)
+
+    def add_local_name(self, name):
+        self.data.add_local_name(name)
+
+    def set_include_tx_power(self, include):
+        self.data.set_include_tx_power(include)
+
+    def update_service_data(self, uuid, data):
+        """
+        Publish new service data through PropertiesChanged, return False when the value did not change.
+
+        """
+        name = self.data.update_service_data(uuid, data)
+        if name is None:
+            return False
+        self._emit_properties_changed({name: self.compile().properties[name]}, [])
+        return True
+
+    def update_manufacturer_data(self, manuf_code, data):
+        name = self.data.update_manufacturer_data(manuf_code, data)
+        if name is None:
+            return False
+        self._emit_properties_changed({name: self.compile().properties[name]}, [])
+        return True
+
+    def start_rotation(self, sets, period_ms):
+        """
+        Advertise each AdvertisementData of sets for period_ms in turn. They are all compiled, and so validated,
+        up front.
+
+        """
+        for data in sets:
+            data.compile(self.ad_type, self.payload_size)
+
+        self.stop_rotation()
+        self._rotation = list(sets)
+        self._rotation_index = 0
+        self._switch_data(self._rotation[0])
+        self._rotation_source = gatt_backend.get_backend().timeout_add(period_ms, self._rotate)
+        logger.info('[ADVERTISEMENT] %s: Rotating %d advertisement sets every %d ms', self.path, len(sets),
+                    period_ms)
+
+    def stop_rotation(self):
+        if self._rotation_source is not None:
+            gatt_backend.get_backend().source_remove(self._rotation_source)
+            self._rotation_source = None
+        self._rotation = None
+
+    def _rotate(self):
+        self._rotation_index = (self._rotation_index + 1) % len(self._rotation)
+        self._switch_data(self._rotation[self._rotation_index])
+        return True
+
+    def _switch_data(self, data):
+        previous = self.compile().properties
+        self.data = data
+        current = self.compile().properties
+        if current is previous:
+            return
+
+        changed = dict((name, value) for name, value in current.items() if previous.get(name) != value)
+        invalidated = [name for name in previous if name not in current]
+        logger.debug('[ADVERTISEMENT] %s: Advertising set %d, %s', self.path, self._rotation_index,
+                     self.compile().describe())
+        self._emit_properties_changed(changed, invalidated)
+
+    def _emit_properties_changed(self, changed, invalidated):
+        self._properties_changed.inc()
+        gatt_backend.get_backend().emit_signal(self, gatt_vars.DBUS_PROP_IFACE, 'PropertiesChanged', 'sa{sv}as',
+                                               [gatt_vars.LE_ADVERTISEMENT_IFACE, changed,
+                                                gatt_dbus.Array(invalidated, signature='s')])
+
+    @gatt_dbus.method(gatt_vars.DBUS_PROP_IFACE,
+                      in_signature='s',
+                      out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != gatt_vars.LE_ADVERTISEMENT_IFACE:
             raise gatt_except.InvalidArgsException()
         return self.get_properties()[gatt_vars.LE_ADVERTISEMENT_IFACE]
 
-    @dbus.service.method(gatt_vars.LE_ADVERTISEMENT_IFACE,
-                         in_signature='',
-                         out_signature='')
+    @gatt_dbus.method(gatt_vars.LE_ADVERTISEMENT_IFACE,
+                      in_signature='',
+                      out_signature='')
     def Release(self):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] %s: Released', time.strftime('%d/%m %H:%M:%S'), self.path)
+        logger.info('[ADVERTISEMENT] %s: Released', self.path)
+
+    @gatt_dbus.signal(gatt_vars.DBUS_PROP_IFACE,
+                      signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
@@ -0,0 +1,395 @@
+import os
+import array
+import socket
+import asyncio
+import inspect
+import itertools
+import collections
+
+import gatt_example.gatt_base.gatt_lib_dbus_wire as gatt_wire
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('asyncio_bus')
+
+DBUS_SERVICE_NAME = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+DBUS_INTROSPECTABLE_IFACE = 'org.freedesktop.DBus.Introspectable'
+DBUS_PEER_IFACE = 'org.freedesktop.DBus.Peer'
+
+SYSTEM_BUS_DEFAULT_ADDRESS = 'unix:path=/var/run/dbus/system_bus_socket'
+MAX_FDS_PER_READ = 32
+
+
+def system_bus_address():
+    return os.environ.get('DBUS_SYSTEM_BUS_ADDRESS', SYSTEM_BUS_DEFAULT_ADDRESS)
+
+
+def session_bus_address():
+    return os.environ['DBUS_SESSION_BUS_ADDRESS']
+
+
+def parse_address(address):
+    """
+    First unix transport of a D-Bus address as a socket address, abstract names get their leading NUL byte.
+
+    """
+    for transport in address.split(';'):
+        kind, _, params = transport.partition(':')
+        if kind != 'unix':
+            continue
+        options = {}
+        for option in params.split(','):
+            key, _, value = option.partition('=')
+            options[key] = _unescape(value)
+        if 'path' in options:
+            return options['path']
+        if 'abstract' in options:
+            return '\0' + options['abstract']
+    raise ValueError('No supported transport in D-Bus address %r' % address)
+
+
+def _unescape(value):
+    parts = value.split('%')
+    result = parts[0]
+    for part in parts[1:]:
+        result += chr(int(part[:2], 16)) + part[2:]
+    return result
+
+
+class AsyncioBus(object):
+    """
+    D-Bus connection speaking the wire protocol directly on an asyncio event loop.
+
+    Exported objects are dispatched through the same _dbus_* attributes dbus.service.method (or
+    gatt_lib_dbus_wire.method) sets, so the gatt_base object model is exported unchanged. Methods may return an
+    awaitable, the reply is sent once it completes.
+
+    """
+
+    def __init__(self, address=None, loop=None):
+        self.address = address or system_bus_address()
+        self.loop = loop or asyncio.get_event_loop()
+        self.unique_name = None
+        self._sock = None
+        self._serials = itertools.count(1)
+        self._pending = {}
+        self._objects = {}
+        self._signal_receivers = []
+        self._read_buffer = bytearray()
+        self._read_fds = []
+        self._write_queue = collections.deque()
+        self._closed = False
+
+    async def connect(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        await self.loop.sock_connect(self._sock, parse_address(self.address))
+
+        await self.loop.sock_sendall(self._sock, b'\0AUTH EXTERNAL ' + str(os.getuid()).encode().hex().encode() +
+                                     b'\r\n')
+        reply = await self._read_auth_line()
+        if not reply.startswith(b'OK'):
+            raise gatt_wire.DBusError('org.freedesktop.DBus.Error.AuthFailed', reply.decode(errors='replace'))
+
+        await self.loop.sock_sendall(self._sock, b'NEGOTIATE_UNIX_FD\r\n')
+        self.unix_fd_support = (await self._read_auth_line()).startswith(b'AGREE_UNIX_FD')
+        await self.loop.sock_sendall(self._sock, b'BEGIN\r\n')
+
+        self.loop.add_reader(self._sock.fileno(), self._on_readable)
+        self.unique_name = (await self.call(DBUS_SERVICE_NAME, DBUS_PATH, DBUS_SERVICE_NAME, 'Hello'))[0]
+        return self
+
+    async def _read_auth_line(self):
+        while b'\r\n' not in self._read_buffer:
+            data = await self.loop.sock_recv(self._sock, 4096)
+            if not data:
+                raise ConnectionError('D-Bus connection closed during authentication')
+            self._read_buffer.extend(data)
+        line, _, rest = bytes(self._read_buffer).partition(b'\r\n')
+        self._read_buffer = bytearray(rest)
+        return line
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._sock is not None:
+            self.loop.remove_reader(self._sock.fileno())
+            self.loop.remove_writer(self._sock.fileno())
+            self._sock.close()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('D-Bus connection closed'))
+        self._pending.clear()
+
+    # Outgoing messages
+
+    def send_message(self, message):
+        serial = next(self._serials)
+        data, fds, owned_fds = message.encode(serial)
+        self._write_queue.append([memoryview(data), fds, owned_fds])
+        if len(self._write_queue) == 1:
+            self._flush()
+        return serial
+
+    def _flush(self):
+        while self._write_queue:
+            entry = self._write_queue[0]
+            data, fds, owned_fds = entry
+            ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+            try:
+                sent = self._sock.sendmsg([data], ancillary)
+            except BlockingIOError:
+                self.loop.add_writer(self._sock.fileno(), self._flush)
+                return
+            except OSError as error:
+                logger.error('[ASYNCIO-BUS] Write failed: %s', error)
+                self._connection_lost()
+                return
+
+            # Descriptors travel with the first byte of the message
+            for fd in owned_fds:
+                os.close(fd)
+            entry[1] = []
+            entry[2] = []
+            if sent < len(data):
+                entry[0] = data[sent:]
+                continue
+            self._write_queue.popleft()
+        self.loop.remove_writer(self._sock.fileno())
+
+    async def call(self, destination, path, interface, member, signature='', args=(), timeout=25.0):
+        """
+        Call a remote method and return its reply body as a list, error replies raise DBusError.
+
+        """
+        future = self.loop.create_future()
+        serial = self.send_message(gatt_wire.Message(gatt_wire.METHOD_CALL, path=path, interface=interface,
+                                                     member=member, destination=destination,
+                                                     signature=signature, body=args))
+        self._pending[serial] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(serial, None)
+
+    def call_async(self, destination, path, interface, member, signature='', args=(),
+                   reply_handler=None, error_handler=None, timeout=25.0):
+        """
+        dbus-python style non blocking call, reply_handler gets the reply body as arguments.
+
+        """
+        async def run():
+            try:
+                body = await self.call(destination, path, interface, member, signature, args, timeout)
+            except Exception as error:
+                if error_handler is not None:
+                    error_handler(error)
+                return
+            if reply_handler is not None:
+                reply_handler(*body)
+        return asyncio.ensure_future(run(), loop=self.loop)
+
+    def emit_signal(self, path, interface, member, signature='', args=(), destination=None):
+        self.send_message(gatt_wire.Message(gatt_wire.SIGNAL, path=path, interface=interface, member=member,
+                                            destination=destination, signature=signature, body=args))
+
+    async def request_name(self, name, flags=0x4):
+        return (await self.call(DBUS_SERVICE_NAME, DBUS_PATH, DBUS_SERVICE_NAME, 'RequestName', 'su',
+                                [name, flags]))[0]
+
+    def add_signal_receiver(self, handler, sender=None, interface=None, member=None, path=None):
+        """
+        Call handler(message) for every matching signal. The match rule is added to the bus asynchronously.
+
+        """
+        receiver = (handler, interface, member, path)
+        self._signal_receivers.append(receiver)
+        rule = ','.join("%s='%s'" % (key, value) for key, value in (('type', 'signal'), ('sender', sender),
+                                                                    ('interface', interface), ('member', member),
+                                                                    ('path', path)) if value is not None)
+        self.call_async(DBUS_SERVICE_NAME, DBUS_PATH, DBUS_SERVICE_NAME, 'AddMatch', 's', [rule],
+                        error_handler=lambda error: logger.error('[ASYNCIO-BUS] AddMatch failed: %s', error))
+        return receiver
+
+    def remove_signal_receiver(self, receiver):
+        if receiver in self._signal_receivers:
+            self._signal_receivers.remove(receiver)
+
+    # Exported objects
+
+    def export(self, path, obj):
+        self._objects[str(path)] = obj
+
+    def unexport(self, path):
+        self._objects.pop(str(path), None)
+
+    # Incoming messages
+
+    def _on_readable(self):
+        try:
+            data, ancillary, _, _ = self._sock.recvmsg(65536, socket.CMSG_SPACE(MAX_FDS_PER_READ * 4))
+        except BlockingIOError:
+            return
+        except OSError as error:
+            logger.error('[ASYNCIO-BUS] Read failed: %s', error)
+            self._connection_lost()
+            return
+        if not data:
+            self._connection_lost()
+            return
+
+        for level, kind, fd_data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = array.array('i')
+                fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+                self._read_fds.extend(fds)
+
+        self._read_buffer.extend(data)
+        while len(self._read_buffer) >= gatt_wire.FIXED_HEADER_SIZE:
+            size = gatt_wire.message_size(self._read_buffer)
+            if len(self._read_buffer) < size:
+                break
+            message = gatt_wire.decode_message(bytes(self._read_buffer[:size]), self._read_fds)
+            del self._read_buffer[:size]
+            try:
+                self._dispatch(message)
+            except Exception:
+                logger.exception('[ASYNCIO-BUS] Failed to dispatch %s', message.member)
+
+    def _connection_lost(self):
+        logger.error('[ASYNCIO-BUS] Connection to the bus lost')
+        self.close()
+
+    def _dispatch(self, message):
+        if message.message_type in (gatt_wire.METHOD_RETURN, gatt_wire.ERROR):
+            future = self._pending.get(message.reply_serial)
+            if future is None or future.done():
+                return
+            if message.message_type == gatt_wire.ERROR:
+                text = message.body[0] if message.body and isinstance(message.body[0], str) else ''
+                future.set_exception(gatt_wire.DBusError(message.error_name, text))
+            else:
+                future.set_result(message.body)
+        elif message.message_type == gatt_wire.SIGNAL:
+            for receiver in list(self._signal_receivers):
+                handler, interface, member, path = receiver
+                if ((interface is None or interface == message.interface) and
+                        (member is None or member == message.member) and
+                        (path is None or path == message.path)):
+                    handler(message)
+        elif message.message_type == gatt_wire.METHOD_CALL:
+            self._handle_method_call(message)
+
+    def _handle_method_call(self, message):
+        if message.interface == DBUS_PEER_IFACE and message.member == 'Ping':
+            self._send_reply(message, '', None)
+            return
+        if message.interface == DBUS_INTROSPECTABLE_IFACE and message.member == 'Introspect':
+            self._send_reply(message, 's', self._introspect(message.path))
+            return
+
+        obj = self._objects.get(message.path)
+        if obj is None:
+            self._send_error(message, 'org.freedesktop.DBus.Error.UnknownObject', message.path)
+            return
+
+        handler, exported = find_method(obj, message.member, message.interface)
+        if handler is None:
+            self._send_error(message, 'org.freedesktop.DBus.Error.UnknownMethod',
+                             '%s.%s' % (message.interface, message.member))
+            return
+
+        out_signature = exported._dbus_out_signature
+        kwargs = {}
+        sender_keyword = getattr(exported, '_dbus_sender_keyword', None)
+        if sender_keyword:
+            kwargs[sender_keyword] = message.sender
+
+        try:
+            result = handler(*message.body, **kwargs)
+        except Exception as error:
+            self._send_exception(message, error)
+            return
+
+        if inspect.isawaitable(result):
+            asyncio.ensure_future(self._complete_method_call(message, result, out_signature), loop=self.loop)
+        else:
+            self._send_reply(message, out_signature, result)
+
+    async def _complete_method_call(self, message, awaitable, out_signature):
+        try:
+            result = await awaitable
+        except Exception as error:
+            self._send_exception(message, error)
+            return
+        self._send_reply(message, out_signature, result)
+
+    def _send_reply(self, message, out_signature, result):
+        if message.flags & gatt_wire.NO_REPLY_EXPECTED:
+            return
+        out_signature = out_signature or ''
+        out_types = gatt_wire.split_signature(out_signature)
+        if not out_types:
+            body = ()
+        elif len(out_types) == 1:
+            body = (result,)
+        else:
+            body = tuple(result)
+        self.send_message(gatt_wire.Message(gatt_wire.METHOD_RETURN, reply_serial=message.serial,
+                                            destination=message.sender, signature=out_signature, body=body))
+
+    def _send_exception(self, message, error):
+        name = getattr(error, '_dbus_error_name', None)
+        if name is None:
+            logger.exception('[ASYNCIO-BUS] %s.%s raised', message.interface, message.member)
+            name = 'org.freedesktop.DBus.Python.' + type(error).__name__
+        self._send_error(message, name, str(error))
+
+    def _send_error(self, message, name, text):
+        if message.flags & gatt_wire.NO_REPLY_EXPECTED:
+            return
+        self.send_message(gatt_wire.Message(gatt_wire.ERROR, error_name=name, reply_serial=message.serial,
+                                            destination=message.sender, signature='s', body=(text,)))
+
+    def _introspect(self, path):
+        prefix = path.rstrip('/') + '/'
+        children = sorted(set(child[len(prefix):].split('/')[0] for child in self._objects
+                              if child.startswith(prefix) and child != path))
+        interfaces = collections.defaultdict(list)
+        obj = self._objects.get(path)
+        if obj is not None:
+            for name, func in exported_methods(obj):
+                interfaces[func._dbus_interface].append('<method name="%s"/>' % name)
+
+        xml = ['<node>']
+        for interface, methods in sorted(interfaces.items()):
+            xml.append('<interface name="%s">%s</interface>' % (interface, ''.join(methods)))
+        xml.extend('<node name="%s"/>' % child for child in children)
+        xml.append('</node>')
+        return ''.join(xml)
+
+
+def exported_methods(obj):
+    seen = set()
+    for cls in type(obj).__mro__:
+        for name, func in vars(cls).items():
+            if name not in seen and getattr(func, '_dbus_is_method', False):
+                seen.add(name)
+                yield name, func
+
+
+def find_method(obj, member, interface=None):
+    """
+    Bound method of member and the decorated function it is exported through. Overrides without a decorator
+    inherit the exported signature of the decorated method they override, as with dbus-python.
+
+    """
+    for cls in type(obj).__mro__:
+        func = vars(cls).get(member)
+        if func is None or not getattr(func, '_dbus_is_method', False):
+            continue
+        if interface is not None and func._dbus_interface != interface:
+            continue
+        return getattr(obj, member), func
+    return None, None
@@ -0,0 +1,291 @@
+import time
+import signal
+import itertools
+
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+
+logger = gatt_log.get_logger('backend')
+
+_backend = None
+
+
+def get_backend():
+    """
+    Backend the gatt_base objects are exported and notified through, GLib unless set_backend() was called.
+
+    """
+    global _backend
+
+    if _backend is None:
+        _backend = GLibBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Select the backend, must be called before the bus connection and the application objects are created.
+
+    """
+    global _backend
+
+    _backend = backend
+    return backend
+
+
+class GLibBackend(object):
+    """
+    dbus-python on the GLib main loop, the historical behaviour of the gatt_base object model.
+
+    """
+    name = 'glib'
+
+    def __init__(self):
+        try:
+            from gi.repository import GObject
+        except ImportError:
+            import gobject as GObject
+        import dbus
+        import dbus.service
+
+        self.GObject = GObject
+        self.dbus = dbus
+        self.mainloop = None
+
+    def connect_system_bus(self):
+        import dbus.mainloop.glib
+
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        return self.dbus.SystemBus()
+
+    def export_object(self, obj, bus, path):
+        self.dbus.service.Object.__init__(obj, bus, path)
+
+    def emit_signal(self, obj, interface, member, signature, args):
+        # The dbus.service.signal decorated method of obj emits on every connection it is exported on
+        getattr(obj, member)(*args)
+
+    def call_method(self, bus, destination, path, interface, member, signature='', args=(), reply_handler=None,
+                    error_handler=None):
+        method = self.dbus.Interface(bus.get_object(destination, path), interface).get_dbus_method(member)
+        method(*args, signature=signature, reply_handler=reply_handler or (lambda *reply: None),
+               error_handler=error_handler or (lambda error: None))
+
+    def call_method_sync(self, bus, destination, path, interface, member, signature='', args=()):
+        method = self.dbus.Interface(bus.get_object(destination, path), interface).get_dbus_method(member)
+        return method(*args, signature=signature)
+
+    def add_signal_receiver(self, bus, handler, sender=None, interface=None, member=None, path=None,
+                            path_keyword=None):
+        return bus.add_signal_receiver(handler, signal_name=member, dbus_interface=interface, bus_name=sender,
+                                       path=path, path_keyword=path_keyword)
+
+    def remove_signal_receiver(self, bus, receiver):
+        receiver.remove()
+
+    def timeout_add(self, interval_ms, callback, *args):
+        return self.GObject.timeout_add(interval_ms, self._timed_timeout(interval_ms, callback), *args)
+
+    @staticmethod
+    def _timed_timeout(interval_ms, callback):
+        # GLib sets the next expiration from the dispatch time, records how late each one is
+        lateness = gatt_metrics.timeout_lateness(callback)
+        interval = interval_ms / 1000.0
+        due = [time.monotonic() + interval]
+
+        def timeout(*args):
+            now = time.monotonic()
+            lateness.observe(max(0.0, now - due[0]))
+            due[0] = now + interval
+            return callback(*args)
+        return timeout
+
+    def idle_add(self, callback, *args):
+        return self.GObject.idle_add(callback, *args)
+
+    def watch_fd(self, fd, callback):
+        condition = self.GObject.IO_IN | self.GObject.IO_HUP | self.GObject.IO_ERR
+        return self.GObject.io_add_watch(fd, condition, self._watch_cb, callback)
+
+    @staticmethod
+    def _watch_cb(source, events, callback):
+        return callback()
+
+    def source_remove(self, source_id):
+        self.GObject.source_remove(source_id)
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Call callback() from the main loop every time signum is received.
+
+        """
+        try:
+            from gi.repository import GLib
+        except ImportError:
+            # Python handlers only run once the main loop hands control back to the interpreter
+            signal.signal(signum, lambda received, frame: callback())
+            return
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, self._signal_cb, callback)
+
+    @staticmethod
+    def _signal_cb(callback):
+        callback()
+        return True
+
+    def run(self):
+        self.mainloop = self.GObject.MainLoop()
+        self.mainloop.run()
+
+    def quit(self):
+        if self.mainloop is not None:
+            self.mainloop.quit()
+
+
+class AsyncioBackend(object):
+    """
+    The wire protocol spoken directly on an asyncio event loop through gatt_lib_asyncio_bus, no GLib involved.
+
+    The gatt_base objects take their base class, types and decorators from gatt_lib_dbus_types, dbus-python's when
+    it is installed, but they are never exported on a dbus-python connection. Their decorated methods are dispatched
+    by the AsyncioBus instead, so the service implementations run unchanged, with or without dbus-python. Pass the
+    loop of an existing asyncio application to share it.
+
+    """
+    name = 'asyncio'
+
+    def __init__(self, loop=None):
+        # Only imported with this backend, asyncio is half of the import time of the GLib daemons
+        import asyncio
+
+        self.loop = loop or asyncio.new_event_loop()
+        self._sources = {}
+        self._lateness = {}
+        self._source_ids = itertools.count(1)
+
+    def connect_system_bus(self, address=None):
+        import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+
+        return self._run_sync(gatt_aio_bus.AsyncioBus(address, self.loop).connect())
+
+    def export_object(self, obj, bus, path):
+        gatt_dbus.Object.__init__(obj)
+        bus.export(path, obj)
+
+    def emit_signal(self, obj, interface, member, signature, args):
+        obj.bus.emit_signal(obj.path, interface, member, signature, args)
+
+    def call_method(self, bus, destination, path, interface, member, signature='', args=(), reply_handler=None,
+                    error_handler=None):
+        bus.call_async(destination, path, interface, member, signature, args, reply_handler=reply_handler,
+                       error_handler=error_handler)
+
+    def call_method_sync(self, bus, destination, path, interface, member, signature='', args=()):
+        body = self._run_sync(bus.call(destination, path, interface, member, signature, args))
+        return body[0] if len(body) == 1 else tuple(body) if body else None
+
+    def add_signal_receiver(self, bus, handler, sender=None, interface=None, member=None, path=None,
+                            path_keyword=None):
+        if path_keyword is not None:
+            return bus.add_signal_receiver(lambda message: handler(*message.body, **{path_keyword: message.path}),
+                                           sender, interface, member, path)
+        return bus.add_signal_receiver(lambda message: handler(*message.body), sender, interface, member, path)
+
+    def remove_signal_receiver(self, bus, receiver):
+        bus.remove_signal_receiver(receiver)
+
+    def _run_sync(self, coroutine):
+        if self.loop.is_running():
+            coroutine.close()
+            raise RuntimeError('Blocking D-Bus call from inside the running event loop')
+        return self.loop.run_until_complete(coroutine)
+
+    # GLib source semantics: the callback is called again as long as it returns True, watch_fd calls it when the
+    # descriptor is readable or hung up
+
+    def timeout_add(self, interval_ms, callback, *args):
+        source_id = next(self._source_ids)
+        self._lateness[source_id] = gatt_metrics.timeout_lateness(callback)
+        self._schedule(source_id, interval_ms / 1000.0, callback, args)
+        return source_id
+
+    def idle_add(self, callback, *args):
+        source_id = next(self._source_ids)
+        self._schedule(source_id, None, callback, args)
+        return source_id
+
+    def watch_fd(self, fd, callback):
+        source_id = next(self._source_ids)
+        self._sources[source_id] = _ReaderHandle(self.loop, fd)
+        self.loop.add_reader(fd, self._dispatch_fd, source_id, callback)
+        return source_id
+
+    def source_remove(self, source_id):
+        handle = self._sources.pop(source_id, None)
+        self._lateness.pop(source_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def add_signal_handler(self, signum, callback):
+        self.loop.add_signal_handler(signum, callback)
+
+    def _dispatch_fd(self, source_id, callback):
+        try:
+            again = callback()
+        except Exception:
+            logger.exception('[BACKEND] Source %d callback failed', source_id)
+            again = False
+
+        if not again:
+            self.source_remove(source_id)
+
+    def _schedule(self, source_id, interval, callback, args):
+        if interval is None:
+            self._sources[source_id] = self.loop.call_soon(self._dispatch, source_id, interval, callback, args)
+        else:
+            self._sources[source_id] = self.loop.call_later(interval, self._dispatch, source_id, interval,
+                                                            callback, args)
+
+    def _dispatch(self, source_id, interval, callback, args):
+        lateness = self._lateness.get(source_id)
+        if lateness is not None:
+            lateness.observe(max(0.0, self.loop.time() - self._sources[source_id].when()))
+        try:
+            again = callback(*args)
+        except Exception:
+            logger.exception('[BACKEND] Source %d callback failed', source_id)
+            again = False
+
+        # The callback may have removed its own source
+        if source_id not in self._sources:
+            return
+        if again:
+            self._schedule(source_id, interval, callback, args)
+        else:
+            del self._sources[source_id]
+            self._lateness.pop(source_id, None)
+
+    def run(self):
+        import asyncio
+
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def quit(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class _ReaderHandle(object):
+
+    def __init__(self, loop, fd):
+        self.loop = loop
+        self.fd = fd
+
+    def cancel(self):
+        self.loop.remove_reader(self.fd)
+
+
+BACKENDS = {
+    GLibBackend.name: GLibBackend,
+    AsyncioBackend.name: AsyncioBackend,
+}
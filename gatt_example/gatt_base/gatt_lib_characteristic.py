@@ -1,17 +1,38 @@
-import dbus
-import dbus.service
 import time
-import logging
+import socket
+import struct
 
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 import gatt_example.gatt_base.gatt_lib_variables as gatt_var
 import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_recorder as gatt_recorder
+import gatt_example.configuration.gatt_lib_config as gatt_config
 
+logger = gatt_log.get_logger('characteristic')
 
-class Characteristic(dbus.service.Object):
+
+@gatt_metrics.instrumented('characteristic')
+class Characteristic(gatt_dbus.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
     """
 
+    # Notification policy applied by notify_value(). With notify_on_change only values that differ from the last
+    # one sent are emitted, numeric fields may be given a deadband and notify_max_interval (seconds) forces a
+    # heartbeat emission even when nothing changed.
+    notify_on_change = False
+    notify_max_interval = None
+    notify_deadband = None
+    # AcquireNotify/AcquireWrite fast path. Notifications are sent on a socket BlueZ hands to the remote device and
+    # writes without response are read from one, instead of a PropertiesChanged signal or a WriteValue call per
+    # packet. Packets of an acquired write go to WriteValue, so subclasses only opt in. Sockets are acquired per
+    # device, each notification is sent on all of them within the rate cap of the device's session.
+    acquire_notify = False
+    acquire_write = False
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
@@ -19,25 +40,54 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self._properties = None
+        self._notify_job = None
+        self._last_value = None
+        self._last_fields = None
+        self._last_notify_time = 0.0
+        self.notify_sent = 0
+        self.notify_suppressed = 0
+        self._notifications_sent = gatt_metrics.NOTIFICATIONS_SENT.labels(self.path)
+        self._notifications_suppressed = gatt_metrics.NOTIFICATIONS_SUPPRESSED.labels(self.path)
+        self.mtu = gatt_var.ATT_DEFAULT_MTU
+        # Subscribers, StartNotify calls not matched by a StopNotify yet (BlueZ makes one per GATT database, that
+        # is per adapter, and does not say for which device) and acquired notify sockets by device.
+        # notify_started() runs for the first subscriber and notify_stopped() once the last one left.
+        self.notifying = False
+        self._signal_subscribers = 0
+        self.subscribers = {}
+        self._write_socks = {}
+        self.notify_dropped = 0
+        self._properties_changed = gatt_metrics.PROPERTIES_CHANGED.labels(self.path)
+        gatt_backend.get_backend().export_object(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            gatt_var.GATT_CHRC_IFACE: {
-                'Service': self.service.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.get_descriptor_paths(),
-                    signature='o')
+        # The snapshot is shared with GetAll and the application's GetManagedObjects, it must not be mutated.
+        if self._properties is None:
+            self._properties = {
+                gatt_var.GATT_CHRC_IFACE: {
+                    'Service': self.service.get_path(),
+                    'UUID': self.uuid,
+                    'Flags': gatt_dbus.Array(self.flags, signature='s'),
+                    'Descriptors': gatt_dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
+                }
             }
-        }
+            # BlueZ only calls AcquireNotify/AcquireWrite when the property exists
+            if gatt_config.acquire_fd and self.acquire_notify:
+                self._properties[gatt_var.GATT_CHRC_IFACE]['NotifyAcquired'] = gatt_dbus.Boolean(False)
+            if gatt_config.acquire_fd and self.acquire_write:
+                self._properties[gatt_var.GATT_CHRC_IFACE]['WriteAcquired'] = gatt_dbus.Boolean(False)
+        return self._properties
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return gatt_dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self._properties = None
+        self.service.invalidate_managed_objects()
 
     def get_descriptor_paths(self):
         result = []
@@ -48,42 +98,517 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
-    @dbus.service.method(gatt_var.DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
+    def start_periodic_notify(self, period_ms, callback):
+        """
+        Run callback every period_ms on the application's notification scheduler, at most once per characteristic.
+
+        """
+        if self._notify_job is None:
+            self._notify_job = self.service.application.scheduler.add(period_ms, callback, self.path)
+
+    def stop_periodic_notify(self):
+        if self._notify_job is not None:
+            self.service.application.scheduler.cancel(self._notify_job)
+            self._notify_job = None
+
+    def notify_value(self, value, fields=None):
+        """
+        Emit value as a notification subject to the notification policy, return True when it was sent.
+        fields are the numeric values the encoded value was built from, when given (and a deadband is configured)
+        they decide whether the value changed instead of the encoded bytes, so they must cover every field that can
+        change on its own.
+
+        """
+        value = bytes(value)
+        now = time.monotonic()
+        if self.notify_on_change and self._last_value is not None:
+            heartbeat_due = (self.notify_max_interval is not None and
+                             now - self._last_notify_time >= self.notify_max_interval)
+            if not heartbeat_due and not self._value_changed(value, fields):
+                self.notify_suppressed += 1
+                self._notifications_suppressed.inc()
+                return False
+
+        self._last_value = value
+        self._last_fields = dict(fields) if fields is not None else None
+        self._last_notify_time = now
+        self.count_sent(1)
+        self._emit_value(value)
+        return True
+
+    def count_sent(self, notifications):
+        self.notify_sent += notifications
+        self._notifications_sent.inc(notifications)
+
+    def _value_changed(self, value, fields):
+        if fields is None or self.notify_deadband is None or self._last_fields is None:
+            return value != self._last_value
+
+        for key, current in fields.items():
+            if abs(current - self._last_fields.get(key, current)) > self.notify_deadband.get(key, 0):
+                return True
+        return False
+
+    def update_mtu(self, options):
+        """
+        Track the MTU BlueZ reports in the options of ReadValue, WriteValue and AcquireNotify.
+
+        """
+        if 'mtu' in options:
+            self.mtu = int(options['mtu'])
+
+    def client_session(self, options):
+        """
+        Track the MTU and return the ClientSession of the device the request options come from, None when unknown.
+
+        """
+        self.update_mtu(options)
+        if self.service.application is None:
+            return None
+        return self.service.application.sessions.session(options)
+
+    def session_closed(self, session):
+        """
+        The device of session disconnected, drop what the characteristic holds for it.
+
+        """
+        self._release_notify(session.device)
+        self._release_socket(self._write_socks, session.device)
+
+    def in_flight(self):
+        """
+        True while notifications sent are still awaiting something from the device, polled during shutdown.
+
+        """
+        return False
+
+    def notify_started(self):
+        pass
+
+    def notify_stopped(self):
+        pass
+
+    def reset_notify(self):
+        """
+        Drop every subscriber, after BlueZ lost the application without calling StopNotify or closing the acquired
+        sockets. notify_stopped() runs if notifications were on.
+
+        """
+        if self._signal_subscribers:
+            logger.info('[CHARACTERISTIC] %s: Dropping %d StartNotify subscribers', self.path,
+                        self._signal_subscribers)
+            self._signal_subscribers = 0
+            self.notify_released(None)
+        for key in list(self.subscribers):
+            self._release_notify(key)
+        for key in list(self._write_socks):
+            self._release_socket(self._write_socks, key)
+        self._update_notifying()
+
+    def notify_acquired(self, key):
+        """
+        The device key (or the socket, without a device) acquired a notify socket, a new one replaces its previous.
+        key is None for the first StartNotify subscriber, notify_released(None) follows once the last one left.
+
+        """
+        pass
+
+    def notify_released(self, key):
+        pass
+
+    def _update_notifying(self):
+        notifying = bool(self._signal_subscribers or self.subscribers)
+        if notifying == self.notifying:
+            return
+
+        self.notifying = notifying
+        logger.info('[CHARACTERISTIC] %s: %s notifications', self.path, 'Starting' if notifying else 'Stopping')
+        if notifying:
+            self.notify_started()
+        else:
+            self.notify_stopped()
+
+    def _emit_value(self, value):
+        # A notification carries at most MTU - 3 bytes, longer values go out as consecutive chunks
+        chunk_size = self.mtu - gatt_var.ATT_HEADER_SIZE
+        if len(value) > chunk_size:
+            view = memoryview(value)
+            for start in range(0, len(value), chunk_size):
+                self._emit_chunk(view[start:start + chunk_size])
+        else:
+            self._emit_chunk(value)
+
+    def _emit_chunk(self, value, capped=True):
+        # Acquired subscribers get the packet within the rate cap of their session unless capped is False. The
+        # PropertiesChanged signal reaches every device subscribed through StartNotify, it cannot be capped.
+        if self.subscribers or self._signal_subscribers:
+            self._record_notification(value)
+        if self.subscribers:
+            now = time.monotonic()
+            for key in list(self.subscribers):
+                self._send_acquired(key, value, now, capped)
+
+        if self._signal_subscribers:
+            self._emit_signal(value)
+
+    def _record_notification(self, value):
+        # Once per notification whichever way it goes out, before the fan-out to the subscribers
+        if gatt_recorder.recorder is not None:
+            gatt_recorder.recorder.properties_changed(self.path, value)
+
+    def _emit_signal(self, value):
+        self._properties_changed.inc()
+        gatt_backend.get_backend().emit_signal(self, gatt_var.DBUS_PROP_IFACE, 'PropertiesChanged', 'sa{sv}as',
+                                               [gatt_var.GATT_CHRC_IFACE,
+                                                {'Value': gatt_dbus.Array(value, signature='y')}, []])
+
+    def _send_acquired(self, key, value, now, capped=True):
+        """
+        Send value on the acquired notify socket of key only, return True when it was sent.
+
+        """
+        sock, watch, session = self.subscribers[key]
+        if capped and session is not None and not session.allow_notify(now):
+            return False
+        try:
+            sock.send(value)
+        except BlockingIOError:
+            # The link is behind, a stale notification is not worth queueing
+            self.notify_dropped += 1
+            if session is not None:
+                session.notify_dropped += 1
+            return False
+        except OSError as error:
+            logger.warning('[CHARACTERISTIC] %s: Acquired notify socket of %s failed: %s', self.path, key, error)
+            self._release_notify(key)
+            return False
+        if session is not None:
+            session.notify_sent += 1
+        return True
+
+    def get_notify_stats(self):
+        return {'sent': self.notify_sent, 'suppressed': self.notify_suppressed, 'dropped': self.notify_dropped,
+                'signal_subscribers': self._signal_subscribers, 'acquired': len(self.subscribers)}
+
+    def _acquire_socket(self, socks, options, callback):
+        """
+        Create the socket pair of AcquireNotify/AcquireWrite and watch the local end, return the key it is stored
+        under in socks, the session, the local socket, the watch and the remote end to hand to BlueZ.
+
+        """
+        session = self.client_session(options)
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        # UnixFd holds its own duplicate of the descriptor
+        fd = gatt_dbus.UnixFd(remote.fileno())
+        remote.close()
+
+        # By device, one that acquires again replaces its previous socket. Without a device the socket is the key.
+        key = session.device if session is not None else local
+        self._release_socket(socks, key)
+        watch = gatt_backend.get_backend().watch_fd(local.fileno(), lambda: callback(key))
+        if session is not None:
+            session.characteristics[self.path] = self
+        return key, session, local, watch, fd
+
+    def _release_socket(self, socks, key, watch_fired=False):
+        entry = socks.pop(key, None)
+        if entry is None:
+            return False
+
+        sock, watch, session = entry[0], entry[1], entry[2]
+        if not watch_fired:
+            gatt_backend.get_backend().source_remove(watch)
+        sock.close()
+        if session is not None and key not in self.subscribers and key not in self._write_socks:
+            session.characteristics.pop(self.path, None)
+        return True
+
+    def _release_notify(self, key, watch_fired=False):
+        if not self._release_socket(self.subscribers, key, watch_fired):
+            return
+        logger.info('[CHARACTERISTIC] %s: Acquired notify of %s released, %d left', self.path, key,
+                    len(self.subscribers))
+        self.notify_released(key)
+        self._update_notifying()
+
+    def _notify_sock_cb(self, key):
+        # Nothing is ever read from a notify socket, it only wakes up when BlueZ closes its end
+        sock = self.subscribers[key][0]
+        try:
+            if sock.recv(1, socket.MSG_PEEK):
+                sock.recv(self.mtu)
+                return True
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        self._release_notify(key, watch_fired=True)
+        return False
+
+    def _write_sock_cb(self, key):
+        sock, watch, session, options = self._write_socks[key]
+        while True:
+            try:
+                value = sock.recv(self.mtu)
+            except BlockingIOError:
+                return True
+            except OSError as error:
+                logger.warning('[CHARACTERISTIC] %s: Acquired write socket failed: %s', self.path, error)
+                value = b''
+
+            if not value:
+                self._release_socket(self._write_socks, key, watch_fired=True)
+                logger.info('[CHARACTERISTIC] %s: Acquired write of %s released', self.path, key)
+                return False
+
+            try:
+                self.WriteValue(value, options)
+            except gatt_dbus.DBusException as error:
+                # Writes without response have no way to report an error
+                logger.debug('[CHARACTERISTIC] %s: Acquired write rejected: %s', self.path, error)
+
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE,
+                      in_signature='a{sv}',
+                      out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            raise gatt_except.NotSupportedException()
+
+        try:
+            key, session, sock, watch, fd = self._acquire_socket(self.subscribers, options, self._notify_sock_cb)
+        except OSError as error:
+            # BlueZ falls back to StartNotify and the PropertiesChanged signal
+            logger.warning('[CHARACTERISTIC] %s: AcquireNotify failed: %s', self.path, error)
+            raise gatt_except.FailedException()
+
+        self.subscribers[key] = (sock, watch, session)
+        # Whatever the notification policy the next value is sent, the new subscriber has none yet
+        self._last_value = None
+        logger.info('[CHARACTERISTIC] %s: Notify acquired by %s, MTU %d, %d acquired', self.path, key, self.mtu,
+                    len(self.subscribers))
+        self._update_notifying()
+        self.notify_acquired(key)
+        return fd, gatt_dbus.UInt16(self.mtu)
+
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE,
+                      in_signature='a{sv}',
+                      out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.acquire_write:
+            raise gatt_except.NotSupportedException()
+
+        try:
+            key, session, sock, watch, fd = self._acquire_socket(self._write_socks, options, self._write_sock_cb)
+        except OSError as error:
+            # BlueZ keeps calling WriteValue
+            logger.warning('[CHARACTERISTIC] %s: AcquireWrite failed: %s', self.path, error)
+            raise gatt_except.FailedException()
+
+        write_options = {'type': 'command', 'offset': 0, 'mtu': self.mtu}
+        if 'device' in options:
+            write_options['device'] = options['device']
+        self._write_socks[key] = (sock, watch, session, write_options)
+        logger.info('[CHARACTERISTIC] %s: Write acquired by %s, MTU %d', self.path, key, self.mtu)
+        return fd, gatt_dbus.UInt16(self.mtu)
+
+    @gatt_dbus.method(gatt_var.DBUS_PROP_IFACE,
+                      in_signature='s',
+                      out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != gatt_var.GATT_CHRC_IFACE:
             raise gatt_except.InvalidArgsException()
 
         return self.get_properties()[gatt_var.GATT_CHRC_IFACE]
 
-    @dbus.service.method(gatt_var.GATT_CHRC_IFACE,
-                         in_signature='a{sv}',
-                         out_signature='ay')
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE,
+                      in_signature='a{sv}',
+                      out_signature='ay')
     def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default ReadValue called, returning error', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[CHARACTERISTIC] Default ReadValue called, returning error')
         raise gatt_except.NotSupportedException()
 
-    @dbus.service.method(gatt_var.GATT_CHRC_IFACE, in_signature='aya{sv}')
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default WriteValue called, returning error', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[CHARACTERISTIC] Default WriteValue called, returning error')
         raise gatt_except.NotSupportedException()
 
-    @dbus.service.method(gatt_var.GATT_CHRC_IFACE)
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE)
     def StartNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default StartNotify called, returning error', time.strftime('%d/%m %H:%M:%S'))
-        raise gatt_except.NotSupportedException()
+        if 'notify' not in self.flags and 'indicate' not in self.flags:
+            logger.debug('[CHARACTERISTIC] Default StartNotify called, returning error')
+            raise gatt_except.NotSupportedException()
+
+        self._signal_subscribers += 1
+        self._last_value = None
+        self._update_notifying()
+        if self._signal_subscribers == 1:
+            self.notify_acquired(None)
 
-    @dbus.service.method(gatt_var.GATT_CHRC_IFACE)
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE)
     def StopNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default StopNotify called, returning error', time.strftime('%d/%m %H:%M:%S'))
-        raise gatt_except.NotSupportedException()
+        if 'notify' not in self.flags and 'indicate' not in self.flags:
+            logger.debug('[CHARACTERISTIC] Default StopNotify called, returning error')
+            raise gatt_except.NotSupportedException()
+
+        if not self._signal_subscribers:
+            logger.debug('[CHARACTERISTIC] %s: Not notifying, nothing to do', self.path)
+            return
+        self._signal_subscribers -= 1
+        if not self._signal_subscribers:
+            self.notify_released(None)
+        self._update_notifying()
 
-    @dbus.service.signal(gatt_var.DBUS_PROP_IFACE,
-                         signature='sa{sv}as')
+    @gatt_dbus.signal(gatt_var.DBUS_PROP_IFACE,
+                      signature='sa{sv}as')
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
+
+
+class StaticCharacteristic(Characteristic):
+    """
+    Read only characteristic with a value encoded once, at construction or when set_value() replaces it.
+
+    Reads are answered from a memoryview of the immutable value, at the offset BlueZ requests for long reads and
+    cut to the ATT payload of the negotiated MTU. A read at offset 0 that fits returns the value itself.
+
+    """
+
+    def __init__(self, bus, index, uuid, value, service, flags=None):
+        Characteristic.__init__(self, bus, index, uuid, flags or ['read'], service)
+        self.set_value(value)
+
+    def set_value(self, value):
+        self.value = value.encode('utf-8') if isinstance(value, str) else bytes(value)
+        self._view = memoryview(self.value)
+
+    def read_value(self, offset=0, mtu=None):
+        if offset < 0 or offset > len(self.value):
+            raise gatt_except.InvalidOffsetException()
+
+        end = len(self.value) if mtu is None else min(len(self.value), offset + mtu - 1)
+        if offset == 0 and end == len(self.value):
+            return self.value
+        return self._view[offset:end]
+
+    def ReadValue(self, options):
+        offset = int(options.get('offset', 0))
+        mtu = int(options['mtu']) if 'mtu' in options else None
+        session = self.client_session(options)
+        if session is not None:
+            session.reads += 1
+        logger.debug('[CHARACTERISTIC] %s: Static read, offset %d', self.path, offset)
+        return self.read_value(offset, mtu)
+
+
+class ControlPointCharacteristic(Characteristic):
+    """
+    Write and indicate control point of the profiles: a request is written as an op code and its parameter, the
+    result is indicated as RESPONSE_CODE, the op code, a result code and a response parameter once the write
+    response is out.
+
+    One procedure at a time: from the write, through procedures that take a while, to BlueZ confirming the
+    indication with Confirm(), a new write fails with Procedure Already In Progress. A write without indications
+    enabled fails with Client Characteristic Configuration Descriptor Improperly Configured. Subclasses map op codes
+    to their procedures in handlers, each procedure ends with respond().
+
+    """
+
+    RESPONSE_CODE = None
+
+    SUCCESS = 0x01
+    OP_CODE_NOT_SUPPORTED = 0x02
+    INVALID_PARAMETER = 0x03
+    OPERATION_FAILED = 0x04
+
+    STATE_IDLE = 'idle'
+    STATE_RUNNING = 'running'
+    STATE_INDICATING = 'indicating'
+
+    # The ATT transaction timeout, a confirmation later than that never comes
+    confirm_timeout_ms = 30000
+
+    def __init__(self, bus, index, uuid, service):
+        Characteristic.__init__(self, bus, index, uuid, ['write', 'indicate'], service)
+        self.state = self.STATE_IDLE
+        self.stats = {'requests': 0, 'rejected': 0, 'confirmed': 0, 'timeouts': 0}
+        self.handlers = {}
+        self._timer = None
+
+    def WriteValue(self, value, options):
+        self.client_session(options)
+        if not self.notifying:
+            raise gatt_except.CccdImproperlyConfiguredException()
+        if self.state != self.STATE_IDLE:
+            self.stats['rejected'] += 1
+            raise gatt_except.ProcedureAlreadyInProgressException()
+        if not value:
+            raise gatt_except.InvalidValueLengthException()
+
+        value = bytes(value)
+        self.stats['requests'] += 1
+        self.state = self.STATE_RUNNING
+        handler = self.handlers.get(value[0])
+        logger.info('[CONTROL-POINT] %s: Request 0x%02x, %d B of parameter', self.path, value[0], len(value) - 1)
+        if handler is None:
+            self.respond(value[0], self.OP_CODE_NOT_SUPPORTED)
+        else:
+            handler(value[0], value[1:])
+
+    @gatt_dbus.method(gatt_var.GATT_CHRC_IFACE)
+    def Confirm(self):
+        if self.state != self.STATE_INDICATING:
+            return
+        self.cancel_timer()
+        self.state = self.STATE_IDLE
+        self.stats['confirmed'] += 1
+
+    def start_timer(self, interval_ms, callback, *args):
+        """
+        Timeout of a procedure that takes a while, cancelled if the client goes away before it fires.
+
+        """
+        self.cancel_timer()
+        self._timer = gatt_backend.get_backend().timeout_add(interval_ms, self._procedure_timeout, callback, args)
+
+    def _procedure_timeout(self, callback, args):
+        self._timer = None
+        callback(*args)
+        return False
+
+    def cancel_timer(self):
+        if self._timer is not None:
+            gatt_backend.get_backend().source_remove(self._timer)
+            self._timer = None
+
+    def respond(self, op_code, result, parameter=b''):
+        # Called from WriteValue the reply is only sent once it returns, the indication must come after it
+        self.cancel_timer()
+        self._timer = gatt_backend.get_backend().idle_add(
+            self._indicate, struct.pack('<BBB', self.RESPONSE_CODE, op_code, result) + parameter)
+
+    def _indicate(self, response):
+        self._timer = None
+        if not self.notifying:
+            self.state = self.STATE_IDLE
+            return False
+
+        self.state = self.STATE_INDICATING
+        self._emit_chunk(response, capped=False)
+        self.count_sent(1)
+        self._timer = gatt_backend.get_backend().timeout_add(self.confirm_timeout_ms, self._confirm_timeout)
+        return False
+
+    def _confirm_timeout(self):
+        self._timer = None
+        self.stats['timeouts'] += 1
+        logger.warning('[CONTROL-POINT] %s: Response not confirmed within %d ms', self.path, self.confirm_timeout_ms)
+        self.state = self.STATE_IDLE
+        return False
+
+    def in_flight(self):
+        return self.state != self.STATE_IDLE
+
+    def notify_stopped(self):
+        self.cancel_timer()
+        self.state = self.STATE_IDLE
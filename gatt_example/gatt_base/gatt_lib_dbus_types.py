@@ -0,0 +1,43 @@
+# The D-Bus types, base class and decorators of the gatt_base objects. dbus-python's when it is installed, the GLib
+# backend needs them, otherwise the stand-ins of gatt_lib_dbus_wire so the asyncio backend runs without it. The wire
+# format marshals either kind.
+try:
+    import dbus
+    import dbus.types
+    import dbus.service
+    import dbus.exceptions
+except ImportError:
+    dbus = None
+
+import gatt_example.gatt_base.gatt_lib_dbus_wire as gatt_wire
+
+HAVE_DBUS_PYTHON = dbus is not None
+
+if HAVE_DBUS_PYTHON:
+    Array = dbus.Array
+    Dictionary = dbus.Dictionary
+    Byte = dbus.Byte
+    Boolean = dbus.Boolean
+    UInt16 = dbus.UInt16
+    UInt32 = dbus.UInt32
+    String = dbus.String
+    ObjectPath = dbus.ObjectPath
+    UnixFd = dbus.types.UnixFd
+    DBusException = dbus.exceptions.DBusException
+    Object = dbus.service.Object
+    method = dbus.service.method
+    signal = dbus.service.signal
+else:
+    Array = gatt_wire.Array
+    Dictionary = gatt_wire.Dictionary
+    Byte = gatt_wire.Byte
+    Boolean = gatt_wire.Boolean
+    UInt16 = gatt_wire.UInt16
+    UInt32 = gatt_wire.UInt32
+    String = gatt_wire.String
+    ObjectPath = gatt_wire.ObjectPath
+    UnixFd = gatt_wire.UnixFd
+    DBusException = gatt_wire.DBusException
+    Object = gatt_wire.Object
+    method = gatt_wire.method
+    signal = gatt_wire.signal
@@ -0,0 +1,489 @@
+import os
+import struct
+import functools
+
+# D-Bus wire format, as used by the asyncio backend.
+# https://dbus.freedesktop.org/doc/dbus-specification.html#message-protocol
+#
+# Values are marshalled from plain Python types as well as dbus-python's types (dbus.Byte, dbus.Array, ...), the
+# latter are recognised by name so this module does not depend on dbus-python.
+
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+NO_REPLY_EXPECTED = 0x1
+
+HEADER_PATH = 1
+HEADER_INTERFACE = 2
+HEADER_MEMBER = 3
+HEADER_ERROR_NAME = 4
+HEADER_REPLY_SERIAL = 5
+HEADER_DESTINATION = 6
+HEADER_SENDER = 7
+HEADER_SIGNATURE = 8
+HEADER_UNIX_FDS = 9
+
+PROTOCOL_VERSION = 1
+FIXED_HEADER_SIZE = 16
+
+ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8, 'd': 8, 'h': 4,
+             's': 4, 'o': 4, 'g': 1, 'v': 1, 'a': 4, '(': 8, '{': 8}
+FIXED_FORMATS = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+# dbus-python (and local) type names and the signature they stand for
+TYPE_NAME_SIGNATURES = {
+    'Byte': 'y', 'Boolean': 'b', 'Int16': 'n', 'UInt16': 'q', 'Int32': 'i', 'UInt32': 'u', 'Int64': 'x',
+    'UInt64': 't', 'Double': 'd', 'String': 's', 'ObjectPath': 'o', 'Signature': 'g', 'UnixFd': 'h',
+}
+
+
+class ObjectPath(str):
+    pass
+
+
+class Signature(str):
+    pass
+
+
+class UnixFd(object):
+    """
+    File descriptor to pass in an 'h' argument. Like dbus.types.UnixFd it holds a duplicate of the descriptor, which
+    the connection closes once the message has been sent.
+
+    """
+
+    def __init__(self, fd):
+        self.fd = os.dup(fd if isinstance(fd, int) else fd.fileno())
+
+    def take(self):
+        fd, self.fd = self.fd, -1
+        return fd
+
+
+class Variant(object):
+    __slots__ = ('signature', 'value')
+
+    def __init__(self, signature, value):
+        self.signature = signature
+        self.value = value
+
+
+class Array(list):
+    """
+    Stand-in for dbus.Array, a list with the signature of its elements.
+
+    """
+
+    def __init__(self, items=(), signature=None):
+        list.__init__(self, items)
+        self.signature = signature
+
+
+class Dictionary(dict):
+    """
+    Stand-in for dbus.Dictionary, a dict with the signature of its entries.
+
+    """
+
+    def __init__(self, items=(), signature=None):
+        dict.__init__(self, items)
+        self.signature = signature
+
+
+class Byte(int):
+    pass
+
+
+class Boolean(int):
+    pass
+
+
+class UInt16(int):
+    pass
+
+
+class UInt32(int):
+    pass
+
+
+class String(str):
+    pass
+
+
+class DBusException(Exception):
+    """
+    Stand-in for dbus.exceptions.DBusException, subclasses set the error name as _dbus_error_name.
+
+    """
+    _dbus_error_name = None
+
+    def __init__(self, *args, **kwargs):
+        name = kwargs.pop('name', None)
+        Exception.__init__(self, *args)
+        if name is not None:
+            self._dbus_error_name = name
+
+    def get_dbus_name(self):
+        return self._dbus_error_name
+
+
+class DBusError(DBusException):
+    """
+    Error reply received from, or to be sent to, a peer.
+
+    """
+
+    def __init__(self, name, message=''):
+        DBusException.__init__(self, message, name=name)
+
+
+class Object(object):
+    """
+    Stand-in for dbus.service.Object, the backend exports the object and dispatches its decorated methods.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+def method(interface, in_signature=None, out_signature=None, sender_keyword=None):
+    """
+    Export a method, with the same attributes dbus.service.method sets, so both kinds dispatch the same way.
+
+    """
+    def decorator(func):
+        func._dbus_is_method = True
+        func._dbus_interface = interface
+        func._dbus_in_signature = in_signature
+        func._dbus_out_signature = out_signature
+        func._dbus_sender_keyword = sender_keyword
+        return func
+    return decorator
+
+
+def signal(interface, signature=None):
+    """
+    Mark a signal like dbus.service.signal does, calling it emits nothing, signals are sent through the backend.
+
+    """
+    def decorator(func):
+        func._dbus_is_signal = True
+        func._dbus_interface = interface
+        func._dbus_signature = signature
+        return func
+    return decorator
+
+
+@functools.lru_cache(maxsize=256)
+def split_signature(signature):
+    """
+    Split a signature into its complete types, 'sa{sv}as' -> ('s', 'a{sv}', 'as').
+
+    """
+    types = []
+    index = 0
+    while index < len(signature):
+        end = _complete_type_end(signature, index)
+        types.append(signature[index:end])
+        index = end
+    return tuple(types)
+
+
+def _complete_type_end(signature, index):
+    code = signature[index]
+    if code == 'a':
+        return _complete_type_end(signature, index + 1)
+    if code in '({':
+        closing = ')' if code == '(' else '}'
+        index += 1
+        while signature[index] != closing:
+            index = _complete_type_end(signature, index)
+        return index + 1
+    return index + 1
+
+
+def guess_signature(value):
+    signature = TYPE_NAME_SIGNATURES.get(type(value).__name__)
+    if signature is not None:
+        return signature
+    if isinstance(value, Variant):
+        return 'v'
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, int):
+        return 'i'
+    if isinstance(value, float):
+        return 'd'
+    if isinstance(value, str):
+        return 's'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return 'ay'
+
+    contained = getattr(value, 'signature', None)
+    if isinstance(value, dict):
+        if contained:
+            return 'a{%s}' % contained
+        key = next(iter(value), '')
+        return 'a{%sv}' % guess_signature(key)
+    if isinstance(value, tuple):
+        return '(%s)' % (contained or ''.join(guess_signature(item) for item in value))
+    if isinstance(value, list):
+        if contained:
+            return 'a' + contained
+        return 'a' + guess_signature(value[0]) if value else 'av'
+    raise TypeError('Cannot guess the D-Bus signature of %r' % (value,))
+
+
+class Marshaller(object):
+
+    def __init__(self, fds=None, endian='<'):
+        self.buf = bytearray()
+        self.fds = fds if fds is not None else []
+        # Descriptors taken from UnixFd values, to be closed once sent
+        self.owned_fds = []
+        self.endian = endian
+
+    def align(self, alignment):
+        padding = -len(self.buf) % alignment
+        if padding:
+            self.buf.extend(b'\0' * padding)
+
+    def write_all(self, signature, values):
+        for type_signature, value in zip(split_signature(signature), values):
+            self.write(type_signature, value)
+
+    def write(self, signature, value):
+        code = signature[0]
+        if code in FIXED_FORMATS:
+            if code == 'h':
+                value = self._fd_index(value)
+            elif code == 'b':
+                value = 1 if value else 0
+            self.align(ALIGNMENT[code])
+            self.buf.extend(struct.pack(self.endian + FIXED_FORMATS[code], value))
+        elif code in 'so':
+            data = value.encode('utf-8')
+            self.align(4)
+            self.buf.extend(struct.pack(self.endian + 'I', len(data)))
+            self.buf.extend(data)
+            self.buf.append(0)
+        elif code == 'g':
+            data = value.encode('ascii')
+            self.buf.append(len(data))
+            self.buf.extend(data)
+            self.buf.append(0)
+        elif code == 'v':
+            if isinstance(value, Variant):
+                variant_signature, value = value.signature, value.value
+            else:
+                variant_signature = guess_signature(value)
+            self.write('g', variant_signature)
+            self.write(variant_signature, value)
+        elif code == 'a':
+            self._write_array(signature[1:], value)
+        elif code == '(':
+            self.align(8)
+            self.write_all(signature[1:-1], value)
+        else:
+            raise TypeError('Unsupported D-Bus type %r' % signature)
+
+    def _write_array(self, element, value):
+        self.align(4)
+        length_offset = len(self.buf)
+        self.buf.extend(b'\0\0\0\0')
+        self.align(ALIGNMENT[element[0]])
+        start = len(self.buf)
+
+        if element == 'y':
+            self.buf.extend(value.encode('utf-8') if isinstance(value, str) else value)
+        elif element[0] == '{':
+            key_signature, value_signature = split_signature(element[1:-1])
+            for key, item in value.items():
+                self.align(8)
+                self.write(key_signature, key)
+                self.write(value_signature, item)
+        else:
+            for item in value:
+                self.write(element, item)
+        struct.pack_into(self.endian + 'I', self.buf, length_offset, len(self.buf) - start)
+
+    def _fd_index(self, value):
+        if hasattr(value, 'take'):
+            fd = value.take()
+            self.owned_fds.append(fd)
+        elif hasattr(value, 'fileno'):
+            fd = value.fileno()
+        else:
+            fd = value
+        self.fds.append(fd)
+        return len(self.fds) - 1
+
+
+class Unmarshaller(object):
+
+    def __init__(self, data, offset=0, fds=(), endian='<'):
+        self.data = data
+        self.offset = offset
+        self.fds = fds
+        self.endian = endian
+
+    def align(self, alignment):
+        self.offset += -self.offset % alignment
+
+    def read_all(self, signature):
+        return [self.read(type_signature) for type_signature in split_signature(signature)]
+
+    def read(self, signature):
+        code = signature[0]
+        if code in FIXED_FORMATS:
+            self.align(ALIGNMENT[code])
+            fmt = self.endian + FIXED_FORMATS[code]
+            value = struct.unpack_from(fmt, self.data, self.offset)[0]
+            self.offset += struct.calcsize(fmt)
+            if code == 'b':
+                return bool(value)
+            if code == 'h':
+                return self.fds[value]
+            return value
+        if code in 'so':
+            self.align(4)
+            length = struct.unpack_from(self.endian + 'I', self.data, self.offset)[0]
+            self.offset += 4
+            value = bytes(self.data[self.offset:self.offset + length]).decode('utf-8')
+            self.offset += length + 1
+            return ObjectPath(value) if code == 'o' else value
+        if code == 'g':
+            length = self.data[self.offset]
+            value = bytes(self.data[self.offset + 1:self.offset + 1 + length]).decode('ascii')
+            self.offset += length + 2
+            return Signature(value)
+        if code == 'v':
+            return self.read(self.read('g'))
+        if code == 'a':
+            return self._read_array(signature[1:])
+        if code == '(':
+            self.align(8)
+            return tuple(self.read_all(signature[1:-1]))
+        raise TypeError('Unsupported D-Bus type %r' % signature)
+
+    def _read_array(self, element):
+        self.align(4)
+        length = struct.unpack_from(self.endian + 'I', self.data, self.offset)[0]
+        self.offset += 4
+        self.align(ALIGNMENT[element[0]])
+        end = self.offset + length
+
+        if element == 'y':
+            value = bytes(self.data[self.offset:end])
+            self.offset = end
+            return value
+        if element[0] == '{':
+            key_signature, value_signature = split_signature(element[1:-1])
+            result = {}
+            while self.offset < end:
+                self.align(8)
+                key = self.read(key_signature)
+                result[key] = self.read(value_signature)
+            return result
+        result = []
+        while self.offset < end:
+            result.append(self.read(element))
+        return result
+
+
+class Message(object):
+
+    def __init__(self, message_type, path=None, interface=None, member=None, error_name=None,
+                 reply_serial=None, destination=None, sender=None, signature='', body=(), flags=0):
+        self.message_type = message_type
+        self.path = path
+        self.interface = interface
+        self.member = member
+        self.error_name = error_name
+        self.reply_serial = reply_serial
+        self.destination = destination
+        self.sender = sender
+        self.signature = signature
+        self.body = body
+        self.flags = flags
+        self.serial = 0
+        self.unix_fds = []
+
+    def encode(self, serial):
+        """
+        Return the wire bytes, the file descriptors that must travel with them and the subset of those the sender
+        owns and must close after sending.
+
+        """
+        self.serial = serial
+        body = Marshaller()
+        body.write_all(self.signature, self.body)
+
+        fields = []
+        for code, field_signature, value in ((HEADER_PATH, 'o', self.path),
+                                             (HEADER_INTERFACE, 's', self.interface),
+                                             (HEADER_MEMBER, 's', self.member),
+                                             (HEADER_ERROR_NAME, 's', self.error_name),
+                                             (HEADER_REPLY_SERIAL, 'u', self.reply_serial),
+                                             (HEADER_DESTINATION, 's', self.destination),
+                                             (HEADER_SENDER, 's', self.sender)):
+            if value is not None:
+                fields.append((code, Variant(field_signature, value)))
+        if self.signature:
+            fields.append((HEADER_SIGNATURE, Variant('g', self.signature)))
+        if body.fds:
+            fields.append((HEADER_UNIX_FDS, Variant('u', len(body.fds))))
+
+        header = Marshaller()
+        header.buf.extend(struct.pack('<cBBBII', b'l', self.message_type, self.flags, PROTOCOL_VERSION,
+                                      len(body.buf), serial))
+        header.write('a(yv)', fields)
+        header.align(8)
+        return bytes(header.buf + body.buf), body.fds, body.owned_fds
+
+
+def message_size(data):
+    """
+    Total size of the message starting at data, which must hold at least FIXED_HEADER_SIZE bytes.
+
+    """
+    endian = '<' if data[0:1] == b'l' else '>'
+    body_length, = struct.unpack_from(endian + 'I', data, 4)
+    fields_length, = struct.unpack_from(endian + 'I', data, 12)
+    header_length = FIXED_HEADER_SIZE + fields_length
+    return header_length + (-header_length % 8) + body_length
+
+
+def decode_message(data, fds):
+    """
+    Decode one complete message, taking the file descriptors it announces from the front of fds.
+
+    """
+    endian = '<' if data[0:1] == b'l' else '>'
+    _, message_type, flags, _, _, serial = struct.unpack_from(endian + 'cBBBII', data, 0)
+    header = Unmarshaller(data, 12, endian=endian)
+    fields = dict(header.read('a(yv)'))
+    header.align(8)
+
+    fd_count = fields.get(HEADER_UNIX_FDS, 0)
+    message_fds = fds[:fd_count]
+    del fds[:fd_count]
+
+    message = Message(message_type,
+                      path=fields.get(HEADER_PATH),
+                      interface=fields.get(HEADER_INTERFACE),
+                      member=fields.get(HEADER_MEMBER),
+                      error_name=fields.get(HEADER_ERROR_NAME),
+                      reply_serial=fields.get(HEADER_REPLY_SERIAL),
+                      destination=fields.get(HEADER_DESTINATION),
+                      sender=fields.get(HEADER_SENDER),
+                      signature=fields.get(HEADER_SIGNATURE, ''),
+                      flags=flags)
+    message.serial = serial
+    message.unix_fds = message_fds
+    body = Unmarshaller(data, header.offset, message_fds, endian)
+    message.body = body.read_all(message.signature)
+    return message
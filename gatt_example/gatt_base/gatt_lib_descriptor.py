@@ -1,13 +1,15 @@
-import dbus
-import dbus.service
-import time
-import logging
-
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 import gatt_example.gatt_base.gatt_lib_variables as gatt_var
 import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+
+logger = gatt_log.get_logger('descriptor')
 
 
-class Descriptor(dbus.service.Object):
+@gatt_metrics.instrumented('descriptor')
+class Descriptor(gatt_dbus.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
     """
@@ -18,39 +20,41 @@ class Descriptor(dbus.service.Object):
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
-        dbus.service.Object.__init__(self, bus, self.path)
+        self._properties = None
+        gatt_backend.get_backend().export_object(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            gatt_var.GATT_DESC_IFACE: {
-                'Characteristic': self.chrc.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
+        # The snapshot is shared with GetAll and the application's GetManagedObjects, it must not be mutated.
+        if self._properties is None:
+            self._properties = {
+                gatt_var.GATT_DESC_IFACE: {
+                    'Characteristic': self.chrc.get_path(),
+                    'UUID': self.uuid,
+                    'Flags': gatt_dbus.Array(self.flags, signature='s'),
+                }
             }
-        }
+        return self._properties
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return gatt_dbus.ObjectPath(self.path)
 
-    @dbus.service.method(gatt_var.DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
+    @gatt_dbus.method(gatt_var.DBUS_PROP_IFACE,
+                      in_signature='s',
+                      out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != gatt_var.GATT_DESC_IFACE:
             raise gatt_except.InvalidArgsException()
 
         return self.get_properties()[gatt_var.GATT_DESC_IFACE]
 
-    @dbus.service.method(gatt_var.GATT_DESC_IFACE,
-                         in_signature='a{sv}',
-                         out_signature='ay')
+    @gatt_dbus.method(gatt_var.GATT_DESC_IFACE,
+                      in_signature='a{sv}',
+                      out_signature='ay')
     def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default ReadValue called, returning error', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[DESCRIPTOR] Default ReadValue called, returning error')
         raise gatt_except.NotSupportedException()
 
-    @dbus.service.method(gatt_var.GATT_DESC_IFACE, in_signature='aya{sv}')
+    @gatt_dbus.method(gatt_var.GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s] Default WriteValue called, returning error', time.strftime('%d/%m %H:%M:%S'))
+        logger.debug('[DESCRIPTOR] Default WriteValue called, returning error')
         raise gatt_except.NotSupportedException()
@@ -1,22 +1,46 @@
-import dbus
-import dbus.exceptions
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 
 
-class InvalidArgsException(dbus.exceptions.DBusException):
+class InvalidArgsException(gatt_dbus.DBusException):
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
 
 
-class NotSupportedException(dbus.exceptions.DBusException):
+class NotSupportedException(gatt_dbus.DBusException):
     _dbus_error_name = 'org.bluez.Error.NotSupported'
 
 
-class NotPermittedException(dbus.exceptions.DBusException):
+class NotPermittedException(gatt_dbus.DBusException):
     _dbus_error_name = 'org.bluez.Error.NotPermitted'
 
 
-class InvalidValueLengthException(dbus.exceptions.DBusException):
+class InvalidValueLengthException(gatt_dbus.DBusException):
     _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
 
 
-class FailedException(dbus.exceptions.DBusException):
+class FailedException(gatt_dbus.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
+
+
+class InvalidOffsetException(gatt_dbus.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
+class ProcedureAlreadyInProgressException(FailedException):
+    """
+    ATT error 0xFE, a Control Point procedure is already running. BlueZ answers the write with the ATT error code
+    carried in the message of org.bluez.Error.Failed.
+
+    """
+
+    def __init__(self):
+        FailedException.__init__(self, '0xfe')
+
+
+class CccdImproperlyConfiguredException(FailedException):
+    """
+    ATT error 0xFD, a Control Point was written without indications enabled to send the response.
+
+    """
+
+    def __init__(self):
+        FailedException.__init__(self, '0xfd')
@@ -0,0 +1,109 @@
+import queue
+import atexit
+import logging
+import argparse
+import logging.handlers
+
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+ROOT_LOGGER_NAME = 'rotating.logger'
+# The timestamp is only rendered by the writer thread, for records that pass the level checks
+LOG_FORMAT = '[%(asctime)s]%(message)s'
+LOG_DATE_FORMAT = '%d/%m %H:%M:%S'
+
+_listener = None
+# Subsystems of the loggers get_logger made, what -L accepts
+_subsystems = set()
+
+
+def get_logger(subsystem):
+    """
+    Module level logger of a subsystem, its level can be set on its own through gatt_config.log_levels.
+
+    """
+    _subsystems.add(subsystem)
+    return logging.getLogger(ROOT_LOGGER_NAME + '.' + subsystem)
+
+
+def configure_levels(default_level=None, levels=None):
+    """
+    Apply the default level to every subsystem and the per subsystem overrides on top of it.
+
+    """
+    if default_level is None:
+        default_level = gatt_config.log_level
+    if levels is None:
+        levels = gatt_config.log_levels
+
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(default_level)
+    for subsystem, level in levels.items():
+        get_logger(subsystem).setLevel(level)
+
+
+def setup_logging(logging_file, log_file_bytes=1048576 * 5, log_files=3):
+    """
+    Log to a rotating file from a background thread. The callers only enqueue records, so the GLib main loop never
+    blocks on disk writes.
+
+    """
+    global _listener
+
+    rotating_handler = logging.handlers.RotatingFileHandler(logging_file, maxBytes=log_file_bytes,
+                                                            backupCount=log_files)
+    rotating_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.propagate = False
+    configure_levels()
+
+    _listener = logging.handlers.QueueListener(log_queue, rotating_handler)
+    _listener.start()
+    atexit.register(flush_logging)
+    return _listener
+
+
+def flush_logging():
+    """
+    Stop the writer thread once every queued record has been written.
+
+    """
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def level_override(override):
+    """
+    argparse type of -L: 'cycling_power=DEBUG' to a (subsystem, level) pair, anything else is a usage error
+    instead of a ValueError from setLevel once the daemon is starting. The subsystem must be one of the loggers of
+    the modules imported by then, a misspelt one would otherwise be silently ignored.
+
+    """
+    subsystem, separator, level = override.partition('=')
+    if not subsystem or not separator:
+        raise argparse.ArgumentTypeError('%r is not SUBSYSTEM=LEVEL' % override)
+    if subsystem not in _subsystems:
+        raise argparse.ArgumentTypeError('Unknown subsystem %r, one of %s' % (subsystem, ', '.join(sorted(_subsystems))))
+    number = logging.getLevelName(level.upper())
+    if not isinstance(number, int):
+        raise argparse.ArgumentTypeError('Unknown log level %r, one of %s' % (level, ', '.join(
+            logging.getLevelName(known) for known in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR,
+                                                      logging.CRITICAL))))
+    return subsystem, number
+
+
+def parse_level_overrides(overrides):
+    """
+    Turn the -L overrides, ['cycling_power=DEBUG', ...] or the pairs of level_override, into a {subsystem: level}
+    dict.
+
+    """
+    levels = {}
+    for override in overrides or []:
+        subsystem, level = level_override(override) if isinstance(override, str) else override
+        levels[subsystem] = level
+    return levels
@@ -0,0 +1,406 @@
+import os
+import time
+import bisect
+import functools
+
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('metrics')
+
+# The overhead is measured once the daemon is up, not on the way to its registration
+CALIBRATION_DELAY_MS = 1000
+
+# Upper bounds in seconds, from a fast cached read to a main loop stall
+LATENCY_BUCKETS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3, 100e-3, 250e-3, 1.0)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """
+    Fixed buckets, observe() is one bisect and two additions whatever the number of observations.
+
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', format_value(bound)),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, total
+
+
+class MetricFamily(object):
+    """
+    A metric and its series, one per combination of label values. labels() returns the same series every time, the
+    hot paths look it up once and keep it.
+
+    """
+
+    def __init__(self, name, help_text, metric_type, label_names=(), buckets=None):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.label_names = tuple(label_names)
+        self.buckets = buckets
+        self.series = {}
+
+    def labels(self, *values):
+        series = self.series.get(values)
+        if series is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('%s takes the labels %s' % (self.name, ', '.join(self.label_names)))
+            if self.type == 'histogram':
+                series = Histogram(self.buckets)
+            elif self.type == 'gauge':
+                series = Gauge()
+            else:
+                series = Counter()
+            self.series[values] = series
+        return series
+
+    def render(self, lines, constant_labels=()):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+        for values, series in sorted(self.series.items()):
+            labels = constant_labels + tuple(zip(self.label_names, values))
+            for name, sample_labels, value in series.samples(self.name, labels):
+                lines.append('%s%s %s' % (name, format_labels(sample_labels), format_value(value)))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for name, value in labels)
+
+
+class Registry(object):
+    """
+    The metric families of the process. Series are only updated from the main loop thread, so plain integer and
+    float additions need no lock.
+
+    """
+
+    def __init__(self):
+        self.families = {}
+
+    def _family(self, name, help_text, metric_type, label_names, buckets=None):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(name, help_text, metric_type, label_names, buckets)
+        elif family.type != metric_type or family.label_names != tuple(label_names):
+            raise ValueError('%s is already registered as a %s with the labels %s' % (name, family.type,
+                                                                                    family.label_names))
+        return family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._family(name, help_text, 'counter', label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._family(name, help_text, 'gauge', label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._family(name, help_text, 'histogram', label_names, tuple(buckets))
+
+    def render(self, constant_labels=()):
+        """
+        Every family in the Prometheus text exposition format.
+
+        """
+        lines = []
+        for name in sorted(self.families):
+            self.families[name].render(lines, constant_labels)
+        lines.append('')
+        return '\n'.join(lines)
+
+
+_registry = Registry()
+
+
+def get_registry():
+    return _registry
+
+
+def counter(name, help_text, label_names=()):
+    return _registry.counter(name, help_text, label_names)
+
+
+def gauge(name, help_text, label_names=()):
+    return _registry.gauge(name, help_text, label_names)
+
+
+def histogram(name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+    return _registry.histogram(name, help_text, label_names, buckets)
+
+
+METHOD_DURATION = histogram('gatt_dbus_method_duration_seconds', 'Time spent in a D-Bus method of a GATT object',
+                            ('object', 'method', 'path'))
+METHOD_ERRORS = counter('gatt_dbus_method_errors_total', 'D-Bus errors returned by a method of a GATT object',
+                        ('object', 'method', 'path', 'error'))
+PROPERTIES_CHANGED = counter('gatt_properties_changed_total', 'PropertiesChanged signals emitted', ('path',))
+NOTIFICATIONS_SENT = counter('gatt_notifications_sent_total', 'Notifications and indications sent by a characteristic',
+                             ('path',))
+NOTIFICATIONS_SUPPRESSED = counter('gatt_notifications_suppressed_total',
+                                   'Notifications not sent by notify_on_change as the value did not change', ('path',))
+TIMEOUT_LATENESS = histogram('gatt_timeout_lateness_seconds', 'How late timeout callbacks fire', ('source',))
+OVERHEAD = gauge('gatt_metrics_overhead_seconds', 'Cost the dispatch metrics add to one method call')
+
+# Called with every timed method call once it returned, see set_call_observer()
+_call_observer = None
+
+
+def set_call_observer(observer):
+    """
+    observer(kind, name, path, args, duration, error) is called after every timed method call, error is None when
+    it returned. None removes it.
+
+    """
+    global _call_observer
+    _call_observer = observer
+
+
+def instrumented(kind):
+    """
+    Class decorator timing the D-Bus methods of the class and of every subclass, overrides included, and counting
+    the errors they raise, under the object label kind.
+
+    """
+    def decorate(cls):
+        def init_subclass(subclass, **kwargs):
+            super(cls, subclass).__init_subclass__(**kwargs)
+            instrument(subclass, kind)
+
+        cls.__init_subclass__ = classmethod(init_subclass)
+        instrument(cls, kind)
+        return cls
+    return decorate
+
+
+def instrument(cls, kind):
+    exported = set(name for klass in cls.__mro__ for name, func in vars(klass).items()
+                   if getattr(func, '_dbus_is_method', False))
+    for name in exported:
+        func = vars(cls).get(name)
+        if callable(func) and not getattr(func, '_metrics_timed', False):
+            setattr(cls, name, timed_method(func, kind, name))
+
+
+def timed_method(func, kind, name, durations=METHOD_DURATION, errors=METHOD_ERRORS):
+    # The wrapper keeps the _dbus_* attributes of func, both dispatchers export it as they did func
+    series = {}
+
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        histogram_series = series.get(self.path)
+        if histogram_series is None:
+            histogram_series = series[self.path] = durations.labels(kind, name, self.path)
+        start = time.perf_counter()
+        failure = None
+        try:
+            return func(self, *args, **kwargs)
+        except Exception as error:
+            failure = error
+            errors.labels(kind, name, self.path,
+                          getattr(error, '_dbus_error_name', None) or type(error).__name__).inc()
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            histogram_series.observe(duration)
+            if _call_observer is not None:
+                _call_observer(kind, name, self.path, args, duration, failure)
+
+    timed._metrics_timed = True
+    return timed
+
+
+def timeout_lateness(callback):
+    """
+    The series the lateness of the timeouts running callback goes to.
+
+    """
+    return TIMEOUT_LATENESS.labels(getattr(callback, '__qualname__', type(callback).__name__))
+
+
+def calibrate(iterations=5000):
+    """
+    Measure what timed_method adds to a call on this machine, in seconds, through series outside the registry.
+
+    """
+    class Probe(object):
+        path = '/probe'
+
+        def method(self):
+            return None
+
+    durations = MetricFamily('probe', '', 'histogram', ('object', 'method', 'path'), LATENCY_BUCKETS)
+    errors = MetricFamily('probe_errors', '', 'counter', ('object', 'method', 'path', 'error'))
+    probe = Probe()
+    timed = timed_method(Probe.method, 'probe', 'method', durations, errors)
+
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            Probe.method(probe)
+        bare = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(iterations):
+            timed(probe)
+        overhead = max(0.0, (time.perf_counter() - start - bare) / iterations)
+        best = overhead if best is None else min(best, overhead)
+
+    OVERHEAD.labels().set(best)
+    return best
+
+
+class MetricsExporter(object):
+    """
+    Serves the registry in the Prometheus text format to every client connecting to socket_path, e.g.
+    socat - UNIX-CONNECT:path, and rewrites textfile_path every textfile_ms for the node_exporter textfile
+    collector. Every series carries the process label.
+
+    """
+
+    def __init__(self, process, socket_path=None, textfile_path=None, textfile_ms=None, registry=None):
+        self.process = process
+        self.socket_path = socket_path
+        self.textfile_path = textfile_path
+        self.textfile_ms = textfile_ms or gatt_config.metrics_textfile_ms
+        self.registry = registry or _registry
+        self.scrapes = 0
+        self._sock = None
+        self._watch = None
+        self._timer = None
+        self._calibration = None
+
+    def render(self):
+        return self.registry.render((('process', self.process),))
+
+    def start(self):
+        import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+
+        backend = gatt_backend.get_backend()
+        self._calibration = backend.timeout_add(CALIBRATION_DELAY_MS, self._calibrate)
+
+        if self.socket_path:
+            import socket
+
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+            self._sock.bind(self.socket_path)
+            self._sock.listen(8)
+            self._sock.setblocking(False)
+            self._watch = backend.watch_fd(self._sock.fileno(), self._accept)
+            logger.info('[METRICS] Serving on %s', self.socket_path)
+        if self.textfile_path:
+            self.write_textfile()
+            self._timer = backend.timeout_add(self.textfile_ms, self.write_textfile)
+            logger.info('[METRICS] Writing %s every %d ms', self.textfile_path, self.textfile_ms)
+        return self
+
+    def stop(self):
+        import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+
+        backend = gatt_backend.get_backend()
+        if self._calibration is not None:
+            backend.source_remove(self._calibration)
+            self._calibration = None
+        if self._timer is not None:
+            backend.source_remove(self._timer)
+            self._timer = None
+            self.write_textfile()
+        if self._sock is not None:
+            backend.source_remove(self._watch)
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def _calibrate(self):
+        self._calibration = None
+        logger.info('[METRICS] Instrumentation overhead %.2f us per method call', calibrate() * 1e6)
+        return False
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._sock.accept()
+            except BlockingIOError:
+                return True
+            except OSError as error:
+                logger.warning('[METRICS] Accept failed: %s', error)
+                return True
+
+            # A few kilobytes, they fit in the socket buffer, a client that does not read cannot stall the loop
+            with client:
+                try:
+                    client.setblocking(False)
+                    client.sendall(self.render().encode('utf-8'))
+                except OSError as error:
+                    logger.warning('[METRICS] Scrape failed: %s', error)
+                    continue
+            self.scrapes += 1
+
+    def write_textfile(self):
+        # Renamed into place, the collector never reads a partial file
+        temporary = self.textfile_path + '.tmp'
+        try:
+            with open(temporary, 'w') as textfile:
+                textfile.write(self.render())
+            os.replace(temporary, self.textfile_path)
+        except OSError as error:
+            logger.warning('[METRICS] Could not write %s: %s', self.textfile_path, error)
+        return True
+
+
+def start_exporter(process):
+    """
+    Export the registry as configured in gatt_config, None when no export is configured.
+
+    """
+    if not gatt_config.metrics_socket_path and not gatt_config.metrics_textfile_path:
+        return None
+    return MetricsExporter(process, gatt_config.metrics_socket_path, gatt_config.metrics_textfile_path).start()
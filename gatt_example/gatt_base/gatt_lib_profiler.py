@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import signal
+import collections
+
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('profiler')
+
+PROFILER_IFACE = 'org.bluez.example.Profiler1'
+PROFILER_PATH = '/org/bluez/example/profiler'
+
+IDLE = 'idle'
+
+
+def _frame_taggers():
+    """
+    Code objects of the frames the main loop dispatches its sources through, with the function naming the source
+    from such a frame's locals: the timeouts and descriptor watches of the backends and the D-Bus method calls.
+
+    """
+    import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+    import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+
+    def method_name(frame):
+        f_locals = frame.f_locals
+        return 'dbus %s %s' % (f_locals['name'], getattr(f_locals.get('self'), 'path', '?'))
+
+    def asyncio_call(frame):
+        message = frame.f_locals['message']
+        return 'dbus %s %s' % (message.member, message.path)
+
+    def dbus_python_call(frame):
+        message = frame.f_locals['message']
+        return 'dbus %s %s' % (message.get_member(), message.get_path())
+
+    def callback(kind):
+        def name(frame):
+            function = frame.f_locals['callback']
+            return '%s %s' % (kind, getattr(function, '__qualname__', type(function).__name__))
+        return name
+
+    taggers = {
+        gatt_metrics.timed_method(lambda self: None, '', '').__code__: method_name,
+        gatt_aio_bus.AsyncioBus._handle_method_call.__code__: asyncio_call,
+        gatt_backend.GLibBackend._timed_timeout(0, lambda: None).__code__: callback('timeout'),
+        gatt_backend.GLibBackend._watch_cb.__code__: callback('fd'),
+        gatt_backend.AsyncioBackend._dispatch.__code__: callback('timeout'),
+        gatt_backend.AsyncioBackend._dispatch_fd.__code__: callback('fd'),
+    }
+    message_cb = getattr(gatt_dbus.Object, '_message_cb', None)
+    if message_cb is not None:
+        taggers[message_cb.__code__] = dbus_python_call
+    return taggers
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the main loop thread rate_hz times a second from a background thread, between start() and
+    stop(). Nothing runs while it is stopped.
+
+    Each sample is attributed to the main loop source it runs under, the outermost timeout, descriptor watch or
+    D-Bus method call (with its object path) on the stack, or to idle when the loop waits for events. stop() writes
+    the samples as collapsed stacks, one 'frame;frame;frame count' line per distinct stack ready for
+    flamegraph.pl, with the sources as frames of their own.
+
+    """
+
+    def __init__(self, process, rate_hz=None, directory=None):
+        self.process = process
+        self.rate_hz = rate_hz or gatt_config.profiler_rate_hz
+        self.directory = directory or gatt_config.profiler_dir
+        self.thread_id = None
+        self.stacks = collections.Counter()
+        self.sources = collections.Counter()
+        self.samples = 0
+        self.sampling_time = 0.0
+        self._thread = None
+        self._stopping = None
+        self._start_time = None
+        self._labels = {}
+        self._taggers = None
+        self._idle_codes = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, rate_hz=None):
+        if self.running:
+            return False
+
+        import threading
+
+        if self._taggers is None:
+            self._taggers = _frame_taggers()
+            self._idle_codes = self._idle_code_objects()
+        if rate_hz:
+            self.rate_hz = rate_hz
+        self.thread_id = threading.main_thread().ident
+        self.stacks.clear()
+        self.sources.clear()
+        self.samples = 0
+        self.sampling_time = 0.0
+        self._stopping = threading.Event()
+        self._start_time = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='gatt-profiler', daemon=True)
+        self._thread.start()
+        logger.info('[PROFILER] Sampling the main loop %d times a second', self.rate_hz)
+        return True
+
+    def stop(self):
+        """
+        Stop sampling and write the collapsed stacks, return the file written or None.
+
+        """
+        if not self.running:
+            return None
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        duration = time.monotonic() - self._start_time
+        path = self.write()
+        self.log_summary(duration, path)
+        return path
+
+    @staticmethod
+    def _idle_code_objects():
+        import selectors
+
+        codes = {gatt_backend.GLibBackend.run.__code__}
+        for name in ('EpollSelector', 'PollSelector', 'SelectSelector', 'KqueueSelector', 'DevpollSelector'):
+            selector = getattr(selectors, name, None)
+            if selector is not None:
+                codes.add(selector.select.__code__)
+        return codes
+
+    def _run(self):
+        interval = 1.0 / self.rate_hz
+        deadline = time.monotonic()
+        while not self._stopping.is_set():
+            start = time.perf_counter()
+            self._sample()
+            self.sampling_time += time.perf_counter() - start
+
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay < 0:
+                # Behind, skip the samples missed instead of taking them back to back
+                deadline = time.monotonic()
+                delay = 0
+            self._stopping.wait(delay)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s:%s' % (os.path.basename(code.co_filename),
+                                                    getattr(code, 'co_qualname', code.co_name))
+        return label
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        stack = []
+        source = None
+        innermost = frame.f_code
+        while frame is not None:
+            code = frame.f_code
+            tagger = self._taggers.get(code)
+            if tagger is not None:
+                try:
+                    tag = tagger(frame)
+                except Exception:
+                    tag = None
+                if tag is not None:
+                    # Walking outwards, the last tag found is the outermost, the source dispatched by the loop
+                    source = tag
+                    stack.append('[%s]' % tag)
+                    frame = frame.f_back
+                    continue
+            stack.append(self._label(code))
+            frame = frame.f_back
+
+        if source is None and innermost in self._idle_codes:
+            source = IDLE
+            stack.append('[%s]' % IDLE)
+        stack.reverse()
+        self.stacks[';'.join(stack)] += 1
+        self.sources[source or 'other'] += 1
+        self.samples += 1
+
+    def write(self):
+        path = os.path.join(self.directory, '%s-%s-%d.folded' % (self.process, time.strftime('%Y%m%d-%H%M%S'),
+                                                                   os.getpid()))
+        try:
+            with open(path, 'w') as output:
+                for stack, count in sorted(self.stacks.items()):
+                    output.write('%s %d\n' % (stack, count))
+        except OSError as error:
+            logger.error('[PROFILER] Could not write %s: %s', path, error)
+            return None
+        return path
+
+    def log_summary(self, duration, path):
+        logger.info('[PROFILER] %d samples in %.1f s written to %s, sampling took %.1f%% of a CPU', self.samples,
+                    duration, path, self.sampling_time / duration * 100.0 if duration else 0.0)
+        for source, count in self.sources.most_common(10):
+            logger.info('[PROFILER] %5.1f%% %s', count * 100.0 / self.samples, source)
+
+
+class ProfilerControl(gatt_dbus.Object):
+    """
+    Starts and stops the profiler over D-Bus, on the unique name of the daemon.
+
+    """
+
+    def __init__(self, bus, profiler):
+        self.path = PROFILER_PATH
+        self.bus = bus
+        self.profiler = profiler
+        gatt_backend.get_backend().export_object(self, bus, self.path)
+
+    @gatt_dbus.method(PROFILER_IFACE, in_signature='u', out_signature='b')
+    def Start(self, rate_hz):
+        return self.profiler.start(int(rate_hz))
+
+    @gatt_dbus.method(PROFILER_IFACE, in_signature='', out_signature='s')
+    def Stop(self):
+        return self.profiler.stop() or ''
+
+
+def install(process, bus):
+    """
+    Profiler of process started by SIGUSR1 and stopped by SIGUSR2, or through ProfilerControl on bus.
+
+    """
+    profiler = SamplingProfiler(process)
+    backend = gatt_backend.get_backend()
+    backend.add_signal_handler(signal.SIGUSR1, profiler.start)
+    backend.add_signal_handler(signal.SIGUSR2, profiler.stop)
+    ProfilerControl(bus, profiler)
+    return profiler
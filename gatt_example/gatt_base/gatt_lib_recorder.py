@@ -0,0 +1,238 @@
+import os
+import mmap
+import time
+import struct
+import collections
+
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('recorder')
+
+# Memory mapped log of the GATT traffic of the application, appended by the main loop and replayed by Gattreplay.
+#
+# Header (32 bytes): magic, version, wall clock time of the start, bytes used after the header.
+# Record (21 bytes + payload): monotonic nanoseconds since the start, duration of the call in nanoseconds, event,
+# object path id, device path id, D-Bus error name id, payload length. An id is NO_ID when there is no such name.
+# Names are written once as a NAME record defining their id, later records refer to the id.
+# The used length in the header is updated after each record, a log cut short by a crash stays readable.
+
+RECORD_MAGIC = b'GATTRECD'
+RECORD_VERSION = 1
+HEADER_STRUCT = struct.Struct('<8sHHdQ')
+USED_STRUCT = struct.Struct('<Q')
+USED_OFFSET = 20
+HEADER_SIZE = 32
+RECORD_STRUCT = struct.Struct('<QIBHHHH')
+READ_STRUCT = struct.Struct('<HH')
+WRITE_STRUCT = struct.Struct('<HHB')
+
+EVENT_NAME = 1
+EVENT_READ = 2
+EVENT_WRITE = 3
+EVENT_START_NOTIFY = 4
+EVENT_STOP_NOTIFY = 5
+EVENT_PROPERTIES_CHANGED = 6
+
+EVENTS = {
+    'ReadValue': EVENT_READ,
+    'WriteValue': EVENT_WRITE,
+    'StartNotify': EVENT_START_NOTIFY,
+    'StopNotify': EVENT_STOP_NOTIFY,
+}
+EVENT_NAMES = dict((event, name) for name, event in EVENTS.items())
+EVENT_NAMES[EVENT_PROPERTIES_CHANGED] = 'PropertiesChanged'
+
+WRITE_TYPES = ('request', 'command', 'reliable')
+NO_ID = 0xFFFF
+MAX_DURATION_NS = 0xFFFFFFFF
+
+Event = collections.namedtuple('Event', ['time', 'duration', 'event', 'error', 'path', 'device', 'offset', 'mtu',
+                                         'write_type', 'value'])
+
+recorder = None
+
+
+class TrafficRecorder(object):
+    """
+    Appends the ReadValue, WriteValue, StartNotify and StopNotify calls of the characteristics and descriptors,
+    and the notifications they send, by PropertiesChanged or on an acquired socket, to a memory mapped file of
+    size bytes. A notification is recorded once however many devices it is sent to.
+
+    Appending packs the record into the mapping, the kernel writes the pages back on its own, so the main loop
+    never waits for the disk. Once the file is full further events are counted as dropped.
+
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.size = size or gatt_config.record_size_mb * 1048576
+        self.records = 0
+        self.dropped = 0
+        self._mm = None
+        self._fd = None
+        self._offset = HEADER_SIZE
+        self._ids = {}
+        self._start_ns = None
+
+    def start(self):
+        global recorder
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, self.size)
+        self._mm = mmap.mmap(self._fd, self.size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self._start_ns = time.monotonic_ns()
+        HEADER_STRUCT.pack_into(self._mm, 0, RECORD_MAGIC, RECORD_VERSION, HEADER_SIZE, time.time(), 0)
+
+        recorder = self
+        gatt_metrics.set_call_observer(self.call)
+        logger.info('[RECORDER] Recording the GATT traffic to %s, up to %d kB', self.path, self.size // 1024)
+        return self
+
+    def stop(self):
+        global recorder
+
+        if self._mm is None:
+            return
+        if recorder is self:
+            recorder = None
+            gatt_metrics.set_call_observer(None)
+
+        used = self._offset
+        self._mm.flush()
+        self._mm.close()
+        self._mm = None
+        # Only what was written is kept
+        os.ftruncate(self._fd, used)
+        os.close(self._fd)
+        self._fd = None
+        logger.info('[RECORDER] %d events, %d bytes recorded to %s, %d dropped', self.records, used, self.path,
+                    self.dropped)
+
+    def _append(self, time_ns, duration_ns, event, path_id, device_id=NO_ID, error_id=NO_ID, payload_struct=None,
+                payload_fields=(), value=b''):
+        payload_size = (payload_struct.size if payload_struct is not None else 0) + len(value)
+        end = self._offset + RECORD_STRUCT.size + payload_size
+        if end > self.size:
+            self.dropped += 1
+            return False
+
+        RECORD_STRUCT.pack_into(self._mm, self._offset, time_ns, duration_ns, event, path_id, device_id, error_id,
+                                payload_size)
+        position = self._offset + RECORD_STRUCT.size
+        if payload_struct is not None:
+            payload_struct.pack_into(self._mm, position, *payload_fields)
+            position += payload_struct.size
+        if value:
+            self._mm[position:end] = value
+        self._offset = end
+        USED_STRUCT.pack_into(self._mm, USED_OFFSET, end - HEADER_SIZE)
+        self.records += 1
+        return True
+
+    def _name_id(self, name):
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = len(self._ids)
+            if name_id >= NO_ID:
+                return None
+            if not self._append(time.monotonic_ns() - self._start_ns, 0, EVENT_NAME, name_id,
+                                value=name.encode('utf-8')):
+                return None
+            self._ids[name] = name_id
+        return name_id
+
+    def call(self, kind, name, path, args, duration, error):
+        """
+        Observer of the instrumented D-Bus methods, see gatt_lib_metrics.set_call_observer().
+
+        """
+        event = EVENTS.get(name)
+        if event is None or self._mm is None:
+            return
+
+        duration_ns = min(MAX_DURATION_NS, int(duration * 1e9))
+        # Stamped with the time the call started
+        time_ns = max(0, time.monotonic_ns() - self._start_ns - duration_ns)
+        path_id = self._name_id(path)
+        if path_id is None:
+            self.dropped += 1
+            return
+
+        options = args[-1] if args and isinstance(args[-1], dict) else {}
+        device_id = self._name_id(str(options['device'])) if 'device' in options else None
+        error_id = None
+        if error is not None:
+            error_id = self._name_id(getattr(error, '_dbus_error_name', None) or type(error).__name__)
+        ids = (path_id, NO_ID if device_id is None else device_id, NO_ID if error_id is None else error_id)
+        offset = min(0xFFFF, int(options.get('offset', 0)))
+        mtu = min(0xFFFF, int(options.get('mtu', 0)))
+
+        if event == EVENT_READ:
+            self._append(time_ns, duration_ns, event, *ids, payload_struct=READ_STRUCT,
+                         payload_fields=(offset, mtu))
+        elif event == EVENT_WRITE:
+            write_type = str(options.get('type', 'request'))
+            self._append(time_ns, duration_ns, event, *ids, payload_struct=WRITE_STRUCT,
+                         payload_fields=(offset, mtu, WRITE_TYPES.index(write_type) if write_type in WRITE_TYPES
+                                         else 0), value=bytes(args[0]))
+        else:
+            self._append(time_ns, duration_ns, event, *ids)
+
+    def properties_changed(self, path, value):
+        if self._mm is None:
+            return
+        path_id = self._name_id(path)
+        if path_id is None:
+            self.dropped += 1
+            return
+        self._append(time.monotonic_ns() - self._start_ns, 0, EVENT_PROPERTIES_CHANGED, path_id, value=bytes(value))
+
+
+def read_events(path):
+    """
+    The events of a recording in order, with their names resolved and times in seconds since its start.
+
+    """
+    with open(path, 'rb') as recording:
+        data = recording.read()
+
+    magic, version, header_size, wall_time, used = HEADER_STRUCT.unpack_from(data, 0)
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        raise ValueError('%s is not a GATT traffic recording' % path)
+
+    names = {NO_ID: None}
+    offset = header_size
+    end = min(len(data), header_size + used)
+    while offset + RECORD_STRUCT.size <= end:
+        time_ns, duration_ns, event, path_id, device_id, error_id, length = RECORD_STRUCT.unpack_from(data, offset)
+        offset += RECORD_STRUCT.size
+        payload = data[offset:offset + length]
+        offset += length
+
+        if event == EVENT_NAME:
+            names[path_id] = payload.decode('utf-8')
+            continue
+
+        offset_field, mtu, write_type, value = 0, 0, None, b''
+        if event == EVENT_READ:
+            offset_field, mtu = READ_STRUCT.unpack_from(payload)
+        elif event == EVENT_WRITE:
+            offset_field, mtu, write_type_index = WRITE_STRUCT.unpack_from(payload)
+            write_type = WRITE_TYPES[write_type_index]
+            value = payload[WRITE_STRUCT.size:]
+        elif event == EVENT_PROPERTIES_CHANGED:
+            value = payload
+        yield Event(time_ns / 1e9, duration_ns / 1e9, event, names.get(error_id), names.get(path_id),
+                    names.get(device_id), offset_field, mtu, write_type, value)
+
+
+def start_recording():
+    """
+    Record to gatt_config.record_path, None when not configured.
+
+    """
+    if not gatt_config.record_path:
+        return None
+    return TrafficRecorder(gatt_config.record_path).start()
@@ -0,0 +1,205 @@
+import time
+
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_adapters as gatt_adapters
+import gatt_example.gatt_base.gatt_lib_startup as gatt_startup
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('registration')
+
+ALREADY_EXISTS = 'org.bluez.Error.AlreadyExists'
+
+RECOVERY = gatt_metrics.histogram('gatt_registration_recovery_seconds',
+                                  'Time from losing a registration with BlueZ to being fully registered again',
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+REGISTRATIONS = gatt_metrics.counter('gatt_registrations_total', 'Registrations with BlueZ by outcome',
+                                     ('registration', 'outcome'))
+
+
+class Registration(object):
+
+    def __init__(self, name, interface, register, unregister, path, on_registered=None, on_lost=None):
+        self.name = name
+        self.interface = interface
+        self.register = register
+        self.unregister = unregister
+        self.path = path
+        self.on_registered = on_registered
+        self.on_lost = on_lost
+
+
+class Registrar(object):
+    """
+    Keeps the application and the advertisement registered with BlueZ for the life of the process.
+
+    The registrations are made in the order they were added, the next one once the previous one is registered, on
+    every usable adapter or on the first one only. When an adapter goes away, is powered off or bluetoothd
+    restarts, they are made again as soon as an adapter is usable again, from the same exported objects: services,
+    notification sources and encoded values stay as they are. A failed registration is retried with exponential
+    backoff instead of ending the process.
+
+    stats and the gatt_registration_recovery_seconds metric hold the time from losing a registration to being fully
+    registered again, the recovery time.
+
+    """
+
+    def __init__(self, bus, shutdown=None, all_adapters=False):
+        self.bus = bus
+        self.shutdown = shutdown
+        self.all_adapters = all_adapters
+        self.registrations = []
+        self.adapters = None
+        # Adapters served, and per adapter how many registrations are done
+        self.serving = {}
+        self._generation = {}
+        self._retry_sources = {}
+        self._attempts = {}
+        self._lost_time = None
+        self.stats = {'registered': 0, 'failed': 0, 'recoveries': 0, 'recovery_ms': None, 'max_recovery_ms': None}
+
+    def add(self, name, interface, register, unregister, path, on_registered=None, on_lost=None):
+        """
+        Register path on each adapter served by calling register of interface, unregister undoes it on shutdown.
+        on_registered() is called after every successful registration, on_lost(adapter, everything) when the
+        registration on adapter is lost, before registering again, everything being True when no adapter is served
+        anymore.
+
+        """
+        self.registrations.append(Registration(name, interface, register, unregister, path, on_registered, on_lost))
+
+    def start(self):
+        interfaces = []
+        for registration in self.registrations:
+            if registration.interface not in interfaces:
+                interfaces.append(registration.interface)
+        self.adapters = gatt_adapters.AdapterManager(self.bus, interfaces, self.adapter_added, self.adapter_removed)
+        self.adapters.start()
+        if self.shutdown is not None:
+            self.shutdown.on_stop(self.stop)
+        if not self.adapters.ready:
+            logger.warning('[REGISTRATION] No adapter with %s yet, waiting for one', ', '.join(
+                interface.rsplit('.', 1)[1] for interface in interfaces))
+        return self
+
+    def stop(self):
+        backend = gatt_backend.get_backend()
+        for source in self._retry_sources.values():
+            backend.source_remove(source)
+        self._retry_sources = {}
+        if self.adapters is not None:
+            self.adapters.stop()
+
+    def _stopping(self):
+        return self.shutdown is not None and self.shutdown.stopping
+
+    def adapter_added(self, adapter):
+        if self._stopping() or (not self.all_adapters and self.serving):
+            return
+
+        self.serving[adapter] = 0
+        self._generation[adapter] = self._generation.get(adapter, 0) + 1
+        self._attempts[adapter] = 0
+        self._register(adapter)
+
+    def adapter_removed(self, adapter):
+        if adapter not in self.serving:
+            return
+
+        registered = self.serving.pop(adapter)
+        self._generation[adapter] += 1
+        source = self._retry_sources.pop(adapter, None)
+        if source is not None:
+            gatt_backend.get_backend().source_remove(source)
+        if self.shutdown is not None:
+            self.shutdown.adapter_removed(adapter)
+        if registered and self._lost_time is None:
+            self._lost_time = time.monotonic()
+        logger.warning('[REGISTRATION] Lost %d registrations with %s, %d adapters left', registered, adapter,
+                       len(self.serving))
+        # BlueZ forgot what it had of them without calling back, e.g. StopNotify
+        for registration in self.registrations[:registered]:
+            if registration.on_lost is not None:
+                registration.on_lost(adapter, not self.serving)
+
+        if not self.all_adapters and self.adapters is not None:
+            # Move to the next usable adapter, if any
+            for other in sorted(self.adapters.ready):
+                if other != adapter:
+                    self.adapter_added(other)
+                    break
+
+    def _register(self, adapter):
+        if adapter not in self.serving or self._stopping():
+            return
+        index = self.serving[adapter]
+        if index == len(self.registrations):
+            self._adapter_registered(adapter)
+            return
+
+        registration = self.registrations[index]
+        generation = self._generation[adapter]
+        logger.info('[REGISTRATION] Registering the %s on %s', registration.name, adapter)
+        gatt_backend.get_backend().call_method(
+            self.bus, gatt_var.BLUEZ_SERVICE_NAME, adapter, registration.interface, registration.register, 'oa{sv}',
+            [registration.path, {}],
+            reply_handler=lambda *reply: self._registered(adapter, generation, registration),
+            error_handler=lambda error: self._failed(adapter, generation, registration, error))
+
+    def _current(self, adapter, generation):
+        # A reply for an adapter lost or lost and found again meanwhile is not followed up
+        return self._generation.get(adapter) == generation and adapter in self.serving and not self._stopping()
+
+    def _registered(self, adapter, generation, registration):
+        if not self._current(adapter, generation):
+            return
+
+        self.stats['registered'] += 1
+        REGISTRATIONS.labels(registration.name, 'registered').inc()
+        self._attempts[adapter] = 0
+        self.serving[adapter] += 1
+        if self.shutdown is not None:
+            self.shutdown.registered(adapter, registration.interface, registration.unregister, registration.path)
+        if registration.on_registered is not None:
+            registration.on_registered()
+        self._register(adapter)
+
+    def _failed(self, adapter, generation, registration, error):
+        if not self._current(adapter, generation):
+            return
+
+        name = error.get_dbus_name() if hasattr(error, 'get_dbus_name') else None
+        if name == ALREADY_EXISTS:
+            # Still registered from before the adapter was powered off
+            self._registered(adapter, generation, registration)
+            return
+
+        self.stats['failed'] += 1
+        REGISTRATIONS.labels(registration.name, 'failed').inc()
+        delay_ms = gatt_adapters.retry_delay_ms(self._attempts[adapter])
+        self._attempts[adapter] += 1
+        logger.error('[REGISTRATION] Failed to register the %s on %s, retrying in %d ms: %s', registration.name,
+                     adapter, delay_ms, error)
+        gatt_startup.status('Failed to register the %s on %s, retrying: %s' % (registration.name, adapter, error))
+        self._retry_sources[adapter] = gatt_backend.get_backend().timeout_add(
+            delay_ms, lambda: self._retry(adapter, generation))
+
+    def _retry(self, adapter, generation):
+        self._retry_sources.pop(adapter, None)
+        if self._current(adapter, generation):
+            self._register(adapter)
+        return False
+
+    def _adapter_registered(self, adapter):
+        logger.info('[REGISTRATION] Everything registered on %s', adapter)
+        if self._lost_time is None or any(done < len(self.registrations) for done in self.serving.values()):
+            return
+
+        recovery_ms = (time.monotonic() - self._lost_time) * 1e3
+        self._lost_time = None
+        self.stats['recoveries'] += 1
+        RECOVERY.labels().observe(recovery_ms / 1e3)
+        self.stats['recovery_ms'] = recovery_ms
+        self.stats['max_recovery_ms'] = max(recovery_ms, self.stats['max_recovery_ms'] or 0.0)
+        logger.info('[REGISTRATION] Recovered in %.1f ms', recovery_ms)
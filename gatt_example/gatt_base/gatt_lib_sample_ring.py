@@ -0,0 +1,229 @@
+import os
+import mmap
+import time
+import struct
+import collections
+
+# Shared memory ring file written by a single producer process and read by the GATT server.
+#
+# Header (64 bytes): magic, version, capacity (records), channels, record size, write sequence.
+# Record: sequence, monotonic timestamp, one float64 per channel, sequence again.
+# The producer writes the record first and publishes the write sequence last. A reader accepts a record only when
+# both sequence copies match the one it expects, anything else means the producer lapped it while reading.
+# A producer never resizes a ring in place, which would fault the readers mapping it, it builds a new file and
+# renames it over the previous one. Readers open the new file once the old one has nothing new.
+
+RING_MAGIC = b'GATTRING'
+RING_VERSION = 1
+HEADER_STRUCT = struct.Struct('<8sIIII')
+WRITE_SEQ_STRUCT = struct.Struct('<Q')
+WRITE_SEQ_OFFSET = 32
+HEADER_SIZE = 64
+
+# Channel layout shared by the producer and the characteristics: power (W), pedal force (N), crank angle (degrees),
+# wheel revolutions counted by the wheel sensor since the producer started
+CHANNEL_POWER = 0
+CHANNEL_FORCE = 1
+CHANNEL_CRANK_ANGLE = 2
+CHANNEL_WHEEL_REVOLUTIONS = 3
+DEFAULT_CHANNELS = 4
+
+Sample = collections.namedtuple('Sample', ['seq', 'timestamp', 'values'])
+
+# Attempts of latest() at a consistent record before it falls back to the previous one
+MAX_READ_ATTEMPTS = 3
+
+
+def _record_struct(channels):
+    return struct.Struct('<Qd%ddQ' % channels)
+
+
+class SampleRingWriter(object):
+    """
+    Producer side of the ring. Creates the ring file, replacing any previous one, and appends samples.
+
+    """
+
+    def __init__(self, path, capacity=4096, channels=DEFAULT_CHANNELS):
+        self.path = path
+        self.capacity = capacity
+        self.channels = channels
+        self._record = _record_struct(channels)
+        size = HEADER_SIZE + capacity * self._record.size
+
+        # Readers may still map the ring of a previous producer, it is replaced, never truncated
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        self._fd = os.open(temporary_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            HEADER_STRUCT.pack_into(self._mm, 0, RING_MAGIC, RING_VERSION, capacity, channels, self._record.size)
+            WRITE_SEQ_STRUCT.pack_into(self._mm, WRITE_SEQ_OFFSET, 0)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.close(self._fd)
+            os.unlink(temporary_path)
+            raise
+        self._seq = 0
+
+    def write(self, values, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        seq = self._seq + 1
+        offset = HEADER_SIZE + ((seq - 1) % self.capacity) * self._record.size
+        self._record.pack_into(self._mm, offset, seq, timestamp, *values, seq)
+        WRITE_SEQ_STRUCT.pack_into(self._mm, WRITE_SEQ_OFFSET, seq)
+        self._seq = seq
+        return seq
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+
+class SampleRingReader(object):
+    """
+    Consumer side of the ring. Reads are lock free and unpack straight out of the mapping, so they are safe to call
+    from the GLib main loop at notification rate.
+
+    overruns counts samples lost because the producer lapped the reader or left a record half written, underruns
+    counts polls that found no new sample.
+
+    When latest() or read_new() find nothing new they check whether a restarted producer replaced the ring file,
+    and map the new one, with its own capacity and channels, in place of the old one.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mm, self.capacity, self.channels, self._record, self._identity = self._open()
+        self.overruns = 0
+        self.underruns = 0
+        # Samples written before the reader attached are not counted as lost
+        self._last_seq = self.write_seq()
+        self._latest_seq = 0
+        self._latest = None
+
+    def _open(self):
+        with open(self.path, 'rb') as ring_file:
+            status = os.fstat(ring_file.fileno())
+            mm = mmap.mmap(ring_file.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+
+        magic, version, capacity, channels, record_size = HEADER_STRUCT.unpack_from(mm, 0)
+        if magic != RING_MAGIC or version != RING_VERSION:
+            mm.close()
+            raise ValueError('%s is not a version %d sample ring' % (self.path, RING_VERSION))
+        record = _record_struct(channels)
+        if record_size != record.size:
+            mm.close()
+            raise ValueError('%s has an unexpected record size %d' % (self.path, record_size))
+        return mm, capacity, channels, record, (status.st_dev, status.st_ino)
+
+    def _reopen_if_replaced(self):
+        """
+        Map the ring file again when it is not the one mapped, return True when it was. The sequences start over.
+
+        """
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            return False
+        if (status.st_dev, status.st_ino) == self._identity:
+            return False
+        try:
+            opened = self._open()
+        except (OSError, ValueError):
+            # Checked again at the next poll
+            return False
+
+        self._mm.close()
+        self._mm, self.capacity, self.channels, self._record, self._identity = opened
+        self._last_seq = 0
+        self._latest_seq = 0
+        return True
+
+    def write_seq(self):
+        return WRITE_SEQ_STRUCT.unpack_from(self._mm, WRITE_SEQ_OFFSET)[0]
+
+    def _read(self, seq):
+        record = self._record.unpack_from(self._mm, HEADER_SIZE + ((seq - 1) % self.capacity) * self._record.size)
+        if record[0] != seq or record[-1] != seq:
+            return None
+        return Sample(seq, record[1], record[2:-1])
+
+    def latest(self):
+        """
+        Most recent sample or None if the producer has not written anything yet. When no consistent record is
+        found within MAX_READ_ATTEMPTS the previous sample is returned again, None if there is none.
+
+        """
+        seq = self.write_seq()
+        if seq == self._latest_seq and self._reopen_if_replaced():
+            seq = self.write_seq()
+        if seq == 0 or seq == self._latest_seq:
+            self.underruns += 1
+            if seq == 0:
+                return None
+
+        sample = self._read(seq)
+        attempts = 1
+        while sample is None:
+            # The producer is rewriting the slot, the next sequence has been written completely. One that died
+            # mid write or keeps lapping the reader must not stall the main loop.
+            self.overruns += 1
+            if attempts >= MAX_READ_ATTEMPTS:
+                return self._latest
+            seq = self.write_seq()
+            sample = self._read(seq)
+            attempts += 1
+        self._latest_seq = seq
+        self._latest = sample
+        return sample
+
+    def read_new(self, limit=None):
+        """
+        Samples written since the previous read_new call, oldest first.
+
+        """
+        seq = self.write_seq()
+        if seq <= self._last_seq and self._reopen_if_replaced():
+            # The producer restarted, everything in its ring is new
+            seq = self.write_seq()
+        first = self._last_seq + 1
+        if first > seq:
+            self.underruns += 1
+            return []
+
+        if seq - first >= self.capacity:
+            self.overruns += seq - first - self.capacity + 1
+            first = seq - self.capacity + 1
+        if limit is not None and seq - first >= limit:
+            first = seq - limit + 1
+
+        samples = []
+        for sample_seq in range(first, seq + 1):
+            sample = self._read(sample_seq)
+            if sample is None:
+                # Lapped while reading, what is left is newer than what the producer reported
+                self.overruns += 1
+                continue
+            samples.append(sample)
+        self._last_seq = seq
+        return samples
+
+    def window(self, count):
+        """
+        Up to count most recent samples, oldest first. Does not move the read_new position.
+
+        """
+        seq = self.write_seq()
+        first = max(1, seq - min(count, self.capacity) + 1)
+        samples = []
+        for sample_seq in range(first, seq + 1):
+            sample = self._read(sample_seq)
+            if sample is not None:
+                samples.append(sample)
+        return samples
+
+    def close(self):
+        self._mm.close()
@@ -0,0 +1,161 @@
+import time
+import heapq
+import itertools
+
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+
+logger = gatt_log.get_logger('scheduler')
+
+JOB_LATENESS = gatt_metrics.histogram('gatt_notification_lateness_seconds',
+                                      'How late periodic notification jobs run after their deadline', ('job',))
+MISSED_DEADLINES = gatt_metrics.counter('gatt_notification_missed_deadlines_total',
+                                        'Deadlines of periodic notification jobs skipped', ('job',))
+
+# Fractional part of the golden ratio, spreads the first deadlines of jobs evenly over their period
+PHASE_STEP = 0.6180339887498949
+
+
+class NotificationJob(object):
+    """
+    A periodic callback owned by the NotificationScheduler, with its deadline and timing statistics.
+
+    """
+
+    def __init__(self, job_id, name, period, callback, deadline):
+        self.job_id = job_id
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.deadline = deadline
+        self.cancelled = False
+        self.runs = 0
+        self.missed_deadlines = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.lateness = JOB_LATENESS.labels(self.name)
+        self.missed = MISSED_DEADLINES.labels(self.name)
+
+    def get_stats(self):
+        return {
+            'period_ms': self.period * 1000.0,
+            'runs': self.runs,
+            'missed_deadlines': self.missed_deadlines,
+            'jitter_mean_ms': (self.jitter_total / self.runs) * 1000.0 if self.runs else 0.0,
+            'jitter_max_ms': self.jitter_max * 1000.0,
+        }
+
+
+class NotificationScheduler(object):
+    """
+    Runs every periodic notification of the application from a single backend timeout.
+
+    Deadlines are absolute on the monotonic clock (deadline += period), so they do not drift with the callback
+    duration the way a rearmed timeout_add does. Deadlines that were missed by more than a period are
+    skipped and counted instead of being run back to back. Callback return values are ignored, jobs only stop
+    through cancel().
+
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._phase = itertools.count(1)
+        self._source_id = None
+        self._armed_deadline = None
+
+    def add(self, period_ms, callback, name=None):
+        """
+        Schedule callback every period_ms milliseconds, return the job id to pass to cancel().
+
+        """
+        job_id = next(self._ids)
+        period = period_ms / 1000.0
+        phase = (next(self._phase) * PHASE_STEP) % 1.0
+        job = NotificationJob(job_id, name or str(job_id), period, callback, time.monotonic() + phase * period)
+
+        self._jobs[job_id] = job
+        heapq.heappush(self._heap, (job.deadline, job_id, job))
+        self._arm()
+        return job_id
+
+    def cancel(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return False
+
+        job.cancelled = True
+        self._arm()
+        logger.info('[SCHEDULER] Job %s cancelled, %s', job.name, job.get_stats())
+        return True
+
+    def stop(self):
+        if self._jobs:
+            logger.info('[SCHEDULER] Stopping %d jobs, %d missed deadlines, %s', len(self._jobs),
+                        self.get_missed_deadlines(), self.get_stats())
+        for job in self._jobs.values():
+            job.cancelled = True
+        self._jobs.clear()
+        self._heap = []
+        self._arm()
+
+    def get_stats(self):
+        return dict((job.name, job.get_stats()) for job in self._jobs.values())
+
+    def get_missed_deadlines(self):
+        return sum(job.missed_deadlines for job in self._jobs.values())
+
+    def _arm(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+
+        deadline = self._heap[0][0] if self._heap else None
+        if deadline == self._armed_deadline:
+            return
+
+        if self._source_id is not None:
+            gatt_backend.get_backend().source_remove(self._source_id)
+            self._source_id = None
+        self._armed_deadline = deadline
+
+        if deadline is not None:
+            delay_ms = max(0, int((deadline - time.monotonic()) * 1000.0 + 0.999))
+            self._source_id = gatt_backend.get_backend().timeout_add(delay_ms, self._tick)
+
+    def _tick(self):
+        self._source_id = None
+        self._armed_deadline = None
+
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, job_id, job = heapq.heappop(self._heap)
+            if job.cancelled:
+                continue
+
+            lateness = now - deadline
+            if lateness >= job.period:
+                missed = int(lateness / job.period)
+                job.missed_deadlines += missed
+                job.missed.inc(missed)
+                deadline += missed * job.period
+                lateness -= missed * job.period
+
+            job.runs += 1
+            job.jitter_total += lateness
+            job.lateness.observe(lateness)
+            if lateness > job.jitter_max:
+                job.jitter_max = lateness
+
+            try:
+                job.callback()
+            except Exception:
+                logger.exception('[SCHEDULER] Notification job %s failed', job.name)
+
+            if not job.cancelled:
+                job.deadline = deadline + job.period
+                heapq.heappush(self._heap, (job.deadline, job_id, job))
+
+        self._arm()
+        return False
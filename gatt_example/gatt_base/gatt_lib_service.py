@@ -1,11 +1,12 @@
-import dbus
-import dbus.service
-
+import gatt_example.gatt_base.gatt_lib_dbus_types as gatt_dbus
 import gatt_example.gatt_base.gatt_lib_variables as gatt_var
 import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
 
 
-class Service(dbus.service.Object):
+@gatt_metrics.instrumented('service')
+class Service(gatt_dbus.Object):
     """
     org.bluez.GattService1 interface implementation
     """
@@ -17,24 +18,35 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
-        dbus.service.Object.__init__(self, bus, self.path)
+        self.application = None
+        self._properties = None
+        gatt_backend.get_backend().export_object(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            gatt_var.GATT_SERVICE_IFACE: {
-                'UUID': self.uuid,
-                'Primary': self.primary,
-                'Characteristics': dbus.Array(
-                    self.get_characteristic_paths(),
-                    signature='o')
+        # The snapshot is shared with GetAll and the application's GetManagedObjects, it must not be mutated.
+        if self._properties is None:
+            self._properties = {
+                gatt_var.GATT_SERVICE_IFACE: {
+                    'UUID': self.uuid,
+                    'Primary': self.primary,
+                    'Characteristics': gatt_dbus.Array(
+                        self.get_characteristic_paths(),
+                        signature='o')
+                }
             }
-        }
+        return self._properties
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return gatt_dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self._properties = None
+        self.invalidate_managed_objects()
+
+    def invalidate_managed_objects(self):
+        if self.application is not None:
+            self.application.invalidate_managed_objects()
 
     def get_characteristic_paths(self):
         result = []
@@ -45,9 +57,9 @@ class Service(dbus.service.Object):
     def get_characteristics(self):
         return self.characteristics
 
-    @dbus.service.method(gatt_var.DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
+    @gatt_dbus.method(gatt_var.DBUS_PROP_IFACE,
+                      in_signature='s',
+                      out_signature='a{sv}')
     def GetAll(self, interface):
         if interface != gatt_var.GATT_SERVICE_IFACE:
             raise gatt_except.InvalidArgsException()
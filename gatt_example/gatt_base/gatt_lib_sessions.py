@@ -0,0 +1,134 @@
+import time
+
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('sessions')
+
+
+class ClientSession(object):
+    """
+    State of one connected device (central), keyed by the object path BlueZ passes as 'device' in the options of
+    ReadValue, WriteValue, AcquireNotify and AcquireWrite.
+
+    The notification rate cap is a token bucket of notify_burst packets refilled at notify_rate packets per second,
+    None for no cap. allow_notify() is O(1), it is called for every packet sent to the device.
+
+    """
+
+    def __init__(self, device, notify_rate=None, notify_burst=1):
+        self.device = device
+        self.adapter = device.rsplit('/', 1)[0]
+        self.mtu = gatt_var.ATT_DEFAULT_MTU
+        self.connected_time = time.monotonic()
+        # Characteristics holding state for the device, by path, told through session_closed() on disconnect
+        self.characteristics = {}
+        self.reads = 0
+        self.writes = 0
+        self.notify_sent = 0
+        self.notify_dropped = 0
+        self.notify_rate_limited = 0
+        self.set_notify_rate(notify_rate, notify_burst)
+
+    def set_notify_rate(self, rate, burst=1):
+        self.notify_rate = rate
+        self.notify_burst = max(1, burst)
+        self._tokens = float(self.notify_burst)
+        self._token_time = time.monotonic()
+
+    def allow_notify(self, now):
+        if self.notify_rate is None:
+            return True
+
+        tokens = min(self.notify_burst, self._tokens + (now - self._token_time) * self.notify_rate)
+        self._token_time = now
+        if tokens < 1.0:
+            self._tokens = tokens
+            self.notify_rate_limited += 1
+            return False
+        self._tokens = tokens - 1.0
+        return True
+
+    def get_stats(self):
+        return {
+            'adapter': self.adapter,
+            'mtu': self.mtu,
+            'connected_s': time.monotonic() - self.connected_time,
+            'subscriptions': len(self.characteristics),
+            'reads': self.reads,
+            'writes': self.writes,
+            'notify_sent': self.notify_sent,
+            'notify_dropped': self.notify_dropped,
+            'notify_rate_limited': self.notify_rate_limited,
+        }
+
+
+class SessionManager(object):
+    """
+    The ClientSession of every device that used the application, created on its first request and closed when
+    BlueZ reports it disconnected (Device1.Connected false) or removed.
+
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.sessions = {}
+        self._receivers = []
+
+    def start(self):
+        backend = gatt_backend.get_backend()
+        self._receivers.append(backend.add_signal_receiver(self.bus, self._properties_changed,
+                                                           gatt_var.BLUEZ_SERVICE_NAME, gatt_var.DBUS_PROP_IFACE,
+                                                           'PropertiesChanged', path_keyword='path'))
+        self._receivers.append(backend.add_signal_receiver(self.bus, self._interfaces_removed,
+                                                           gatt_var.BLUEZ_SERVICE_NAME, gatt_var.DBUS_OM_IFACE,
+                                                           'InterfacesRemoved'))
+        return self
+
+    def stop(self):
+        backend = gatt_backend.get_backend()
+        for receiver in self._receivers:
+            backend.remove_signal_receiver(self.bus, receiver)
+        self._receivers = []
+
+    def session(self, options):
+        """
+        Session of the device the request options come from, None when BlueZ did not say.
+
+        """
+        device = options.get('device')
+        if device is None:
+            return None
+
+        session = self.sessions.get(device)
+        if session is None:
+            device = str(device)
+            session = ClientSession(device, gatt_config.session_notify_rate, gatt_config.session_notify_burst)
+            self.sessions[device] = session
+            logger.info('[SESSIONS] %s connected, %d sessions', device, len(self.sessions))
+        if 'mtu' in options:
+            session.mtu = int(options['mtu'])
+        return session
+
+    def close(self, device):
+        session = self.sessions.pop(device, None)
+        if session is None:
+            return
+
+        for characteristic in list(session.characteristics.values()):
+            characteristic.session_closed(session)
+        session.characteristics.clear()
+        logger.info('[SESSIONS] %s disconnected, %s', device, session.get_stats())
+
+    def get_stats(self):
+        return dict((device, session.get_stats()) for device, session in self.sessions.items())
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        if interface == gatt_var.DEVICE_IFACE and not changed.get('Connected', True):
+            self.close(str(path))
+
+    def _interfaces_removed(self, path, interfaces):
+        if gatt_var.DEVICE_IFACE in interfaces:
+            self.close(str(path))
@@ -0,0 +1,172 @@
+import time
+
+from signal import SIGTERM, SIGINT
+
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_startup as gatt_startup
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+import gatt_example.configuration.gatt_lib_config as gatt_config
+
+logger = gatt_log.get_logger('shutdown')
+
+DRAIN_POLL_MS = 20
+
+
+class GracefulShutdown(object):
+    """
+    Teardown of a daemon on its main loop, started by SIGTERM or SIGINT once install() was called.
+
+    The stop callbacks stop the timers producing notifications and advertising updates first. The main loop then
+    keeps running while a drain callback reports data in flight, for at most drain_ms, so the last notifications
+    and their acknowledgements go out. Finally the registrations are unregistered, the advertisement before the
+    application of the same adapter, and the main loop quits on the last reply. Whatever did not complete within
+    deadline_ms of the signal is abandoned, BlueZ reaps it when the process leaves the bus.
+
+    """
+
+    def __init__(self, bus, drain_ms=None, deadline_ms=None):
+        self.bus = bus
+        self.drain_ms = gatt_config.shutdown_drain_ms if drain_ms is None else drain_ms
+        self.deadline_ms = gatt_config.shutdown_deadline_ms if deadline_ms is None else deadline_ms
+        self.stopping = False
+        # Per adapter, the (interface, unregister method, object path) of every registration, in order
+        self.registrations = {}
+        self._stop_callbacks = []
+        self._drain_callbacks = []
+        self._start_time = None
+        self._drain_time = None
+        self._pending = 0
+        self._deadline_source = None
+        self.stats = {}
+
+    def install(self):
+        backend = gatt_backend.get_backend()
+        for signum in (SIGTERM, SIGINT):
+            backend.add_signal_handler(signum, self.start)
+        return self
+
+    def on_stop(self, callback):
+        self._stop_callbacks.append(callback)
+
+    def on_drain(self, callback):
+        """
+        callback() is polled during the drain and returns True while it still has data in flight.
+
+        """
+        self._drain_callbacks.append(callback)
+
+    def registered(self, adapter, interface, member, path):
+        """
+        Unregister path from adapter by calling member of interface on shutdown.
+
+        """
+        self.registrations.setdefault(adapter, []).append((interface, member, path))
+
+    def adapter_removed(self, adapter):
+        # BlueZ dropped the registrations with the adapter
+        self.registrations.pop(adapter, None)
+
+    def start(self):
+        if self.stopping:
+            # Asked again, stop waiting
+            logger.warning('[SHUTDOWN] Signal received again, quitting now')
+            self._finish()
+            return
+
+        self.stopping = True
+        self._start_time = time.monotonic()
+        self.stats = {'unregistered': 0, 'failed': 0, 'abandoned': 0}
+        logger.info('[SHUTDOWN] Stopping')
+        gatt_startup.sd_notify('STOPPING=1')
+
+        for callback in self._stop_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception('[SHUTDOWN] Stop callback failed')
+
+        backend = gatt_backend.get_backend()
+        self._deadline_source = backend.timeout_add(self.deadline_ms, self._deadline_expired)
+        if self._drain():
+            backend.timeout_add(DRAIN_POLL_MS, self._drain_poll)
+        else:
+            self._unregister()
+
+    def _in_flight(self):
+        in_flight = False
+        for callback in self._drain_callbacks:
+            try:
+                in_flight = callback() or in_flight
+            except Exception:
+                logger.exception('[SHUTDOWN] Drain callback failed')
+        return in_flight
+
+    def _drain(self):
+        return self._in_flight() and (time.monotonic() - self._start_time) * 1e3 < self.drain_ms
+
+    def _drain_poll(self):
+        if self._drain_time is not None:
+            return False
+        if self._drain():
+            return True
+        self._unregister()
+        return False
+
+    def _unregister(self):
+        self._drain_time = time.monotonic()
+        if self._in_flight():
+            logger.warning('[SHUTDOWN] Data still in flight after %d ms, dropped', self.drain_ms)
+
+        backend = gatt_backend.get_backend()
+        calls = [(adapter, registration) for adapter, registrations in self.registrations.items()
+                 for registration in reversed(registrations)]
+        self.registrations = {}
+        self._pending = len(calls)
+        if not calls:
+            self._finish()
+            return
+
+        # Sent back to back, BlueZ handles the calls of one connection in order
+        for adapter, (interface, member, path) in calls:
+            backend.call_method(self.bus, gatt_var.BLUEZ_SERVICE_NAME, adapter, interface, member, 'o', [path],
+                                reply_handler=lambda *reply: self._unregistered(True),
+                                error_handler=lambda error, member=member, adapter=adapter:
+                                self._unregistered(False, member, adapter, error))
+
+    def _unregistered(self, success, member=None, adapter=None, error=None):
+        if self._pending <= 0:
+            return
+
+        self._pending -= 1
+        if success:
+            self.stats['unregistered'] += 1
+        else:
+            self.stats['failed'] += 1
+            logger.warning('[SHUTDOWN] %s on %s failed: %s', member, adapter, error)
+        if not self._pending:
+            self._finish()
+
+    def _deadline_expired(self):
+        self._deadline_source = None
+        logger.warning('[SHUTDOWN] Deadline of %d ms expired', self.deadline_ms)
+        self._finish()
+        return False
+
+    def _finish(self):
+        backend = gatt_backend.get_backend()
+        if self._deadline_source is not None:
+            backend.source_remove(self._deadline_source)
+            self._deadline_source = None
+
+        now = time.monotonic()
+        if self._start_time is not None and 'total_ms' not in self.stats:
+            # Replies still awaited and registrations never unregistered, when the drain used the whole deadline
+            self.stats['abandoned'] = self._pending + sum(len(registrations)
+                                                          for registrations in self.registrations.values())
+            self._pending = 0
+            self.registrations = {}
+            self.stats['drain_ms'] = ((self._drain_time or now) - self._start_time) * 1e3
+            self.stats['total_ms'] = (now - self._start_time) * 1e3
+            logger.info('[SHUTDOWN] Done in %.1f ms: %s', self.stats['total_ms'], self.stats)
+        backend.quit()
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('startup')
+
+
+def process_age():
+    """
+    Seconds since the kernel started this process, None when /proc does not say. Clock tick resolution.
+
+    """
+    try:
+        with open('/proc/self/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime:
+            now = float(uptime.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(0.0, now - int(fields[19]) / float(os.sysconf('SC_CLK_TCK')))
+
+
+def sd_notify(state):
+    """
+    Send state, e.g. 'READY=1', to the service manager, False when not run by systemd with a NOTIFY_SOCKET.
+
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.sendto(state.encode('utf-8'), address)
+    except OSError as error:
+        logger.warning('[STARTUP] sd_notify %r failed: %s', state, error)
+        return False
+    return True
+
+
+class StartupTimer(object):
+    """
+    Phases of a cold start, each mark() closes the phase running since the previous one. The first phase is the
+    interpreter startup and the imports before this module, measured from the process start time in /proc.
+
+    Once every event given to begin() is done() the startup is over: the phases are logged as one JSON record and
+    READY=1 is sent to systemd. Marks after that are ignored, e.g. the registrations on adapters plugged in later.
+
+    """
+
+    def __init__(self):
+        now = time.monotonic()
+        self.start = now - (process_age() or 0.0)
+        self.phases = [('interpreter', now)]
+        self.name = None
+        self.pending = None
+        self.ready = False
+
+    def begin(self, name, *events):
+        self.name = name
+        self.pending = set(events)
+        self.mark('setup')
+
+    def mark(self, phase):
+        if not self.ready:
+            self.phases.append((phase, time.monotonic()))
+
+    def done(self, event):
+        if self.ready:
+            return
+        self.mark(event)
+        if self.pending is None:
+            return
+        self.pending.discard(event)
+        if not self.pending:
+            self.ready = True
+            self.report()
+
+    def record(self):
+        phases = []
+        previous = self.start
+        for phase, when in self.phases:
+            phases.append((phase, round((when - previous) * 1e3, 3)))
+            previous = when
+        return {
+            'process': self.name,
+            'pid': os.getpid(),
+            'total_ms': round((self.phases[-1][1] - self.start) * 1e3, 3),
+            'phases_ms': dict(phases),
+        }
+
+    def report(self):
+        record = self.record()
+        logger.info('[STARTUP] %s', json.dumps(record))
+        sd_notify('READY=1\nSTATUS=%s ready in %.0f ms' % (self.name, record['total_ms']))
+        return record
+
+
+_timer = StartupTimer()
+
+
+def get_timer():
+    return _timer
+
+
+def begin(name, *events):
+    """
+    Name the process and the events, e.g. 'application', that make it ready.
+
+    """
+    _timer.begin(name, *events)
+
+
+def mark(phase):
+    _timer.mark(phase)
+
+
+def done(event):
+    _timer.done(event)
+
+
+def status(text):
+    sd_notify('STATUS=' + text)
@@ -1,4 +1,6 @@
 BLUEZ_SERVICE_NAME = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
 GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
 DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
 DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
@@ -14,4 +16,6 @@ DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
 
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
 
-sigterm_thread_exit = False
+# ATT MTU before any exchange, notifications and writes carry MTU - 3 bytes of value
+ATT_DEFAULT_MTU = 23
+ATT_HEADER_SIZE = 3
@@ -0,0 +1,134 @@
+import collections
+
+import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
+import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('write_assembler')
+
+DEFAULT_INITIAL_SIZE = 512
+DEFAULT_MAX_PAYLOAD = 16384
+DEFAULT_MAX_DEVICES = 8
+# BlueZ replays the prepared writes of one Execute Write back to back, a quiet period ends the sequence
+DEFAULT_COMMIT_DELAY_MS = 20
+
+
+class _Reassembly(object):
+
+    def __init__(self, initial_size):
+        self.buffer = bytearray(initial_size)
+        self.length = 0
+        self.commit_source = None
+
+
+class WriteAssembler(object):
+    """
+    Reassembles the WriteValue calls of a characteristic into whole payloads, one buffer per client device.
+
+    A single write ('request' or 'command' at offset 0) is a payload on its own. Long and reliable writes arrive
+    as 'reliable' writes at increasing offsets, they are collected in a preallocated bytearray that grows up to
+    max_payload and handed over as one payload once the sequence is over, a sequence with a gap or that
+    overflows is dropped as a whole. At most max_devices buffers are kept, the least recently used idle one is
+    released first.
+
+    """
+
+    def __init__(self, on_payload, max_payload=DEFAULT_MAX_PAYLOAD, initial_size=DEFAULT_INITIAL_SIZE,
+                 max_devices=DEFAULT_MAX_DEVICES, commit_delay_ms=DEFAULT_COMMIT_DELAY_MS):
+        self.on_payload = on_payload
+        self.max_payload = max_payload
+        self.initial_size = min(initial_size, max_payload)
+        self.max_devices = max_devices
+        self.commit_delay_ms = commit_delay_ms
+        self._devices = collections.OrderedDict()
+        self.payloads = 0
+        self.dropped = 0
+
+    def write(self, value, options):
+        """
+        Feed one WriteValue call, errors are raised as the D-Bus exception BlueZ turns into the ATT error.
+
+        """
+        device = options.get('device')
+        offset = int(options.get('offset', 0))
+        write_type = options.get('type', 'request')
+
+        if offset == 0 and write_type != 'reliable':
+            self.discard(device)
+            self._deliver(device, bytes(value))
+            return
+
+        reassembly = self._get_reassembly(device)
+        if offset == 0:
+            reassembly.length = 0
+        elif offset != reassembly.length:
+            logger.warning('[WRITE-ASSEMBLER] %s: Write at offset %d, expected %d, dropping payload',
+                           device, offset, reassembly.length)
+            self.discard(device)
+            self.dropped += 1
+            raise gatt_except.InvalidOffsetException()
+
+        end = offset + len(value)
+        if end > self.max_payload:
+            logger.warning('[WRITE-ASSEMBLER] %s: Payload exceeds %d B, dropping payload', device, self.max_payload)
+            self.discard(device)
+            self.dropped += 1
+            raise gatt_except.InvalidValueLengthException()
+
+        if end > len(reassembly.buffer):
+            size = len(reassembly.buffer)
+            while size < end:
+                size *= 2
+            reassembly.buffer.extend(bytes(min(size, self.max_payload) - len(reassembly.buffer)))
+
+        reassembly.buffer[offset:end] = value
+        reassembly.length = end
+        self._arm_commit(device, reassembly)
+
+    def discard(self, device):
+        reassembly = self._devices.pop(device, None)
+        if reassembly is not None and reassembly.commit_source is not None:
+            gatt_backend.get_backend().source_remove(reassembly.commit_source)
+
+    def _get_reassembly(self, device):
+        reassembly = self._devices.get(device)
+        if reassembly is not None:
+            self._devices.move_to_end(device)
+            return reassembly
+
+        if len(self._devices) >= self.max_devices:
+            for other, candidate in self._devices.items():
+                if candidate.commit_source is None:
+                    del self._devices[other]
+                    break
+            else:
+                # Every buffer is mid sequence, the oldest one is given up
+                self.dropped += 1
+                self.discard(next(iter(self._devices)))
+
+        reassembly = self._devices[device] = _Reassembly(self.initial_size)
+        return reassembly
+
+    def _arm_commit(self, device, reassembly):
+        backend = gatt_backend.get_backend()
+        if reassembly.commit_source is not None:
+            backend.source_remove(reassembly.commit_source)
+        reassembly.commit_source = backend.timeout_add(self.commit_delay_ms, self._commit, device)
+
+    def _commit(self, device):
+        reassembly = self._devices.get(device)
+        if reassembly is None:
+            return False
+
+        reassembly.commit_source = None
+        payload = bytes(memoryview(reassembly.buffer)[:reassembly.length])
+        reassembly.length = 0
+        self._deliver(device, payload)
+        return False
+
+    def _deliver(self, device, payload):
+        self.payloads += 1
+        try:
+            self.on_payload(device, payload)
+        except Exception:
+            logger.exception('[WRITE-ASSEMBLER] %s: Payload handler failed', device)
@@ -1,17 +1,13 @@
-import dbus
-import dbus.service
 import time
-import logging
-
-try:
-    from gi.repository import GObject
-except ImportError:
-    import gobject as GObject
 
 import gatt_example.gatt_base.gatt_lib_variables as gatt_vars
 import gatt_example.gatt_base.gatt_lib_service as gatt_service
 import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
-import gatt_example.configuration.gatt_lib_config as gatt_config
+import gatt_example.gatt_base.gatt_lib_write_assembler as gatt_write_asm
+import gatt_example.gatt_implementations.gatt_lib_custom_transport as gatt_transport
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('custom')
 
 
 class CustomGattService(gatt_service.Service):
@@ -27,72 +23,122 @@ class CustomGattService(gatt_service.Service):
         self.add_characteristic(CustomGattCharacteristic(bus, 0, self))
 
 
+class _Client(object):
+    """
+    Transport state of one device, each has its own sequence numbers and window.
+
+    """
+
+    def __init__(self, transport, dispatcher):
+        self.transport = transport
+        self.dispatcher = dispatcher
+
+
 class CustomGattCharacteristic(gatt_char.Characteristic):
     """
     Read, write and get notified packets
 
+    Writes and notifications carry the frames of a gatt_lib_custom_transport.FramedTransport, requests are
+    dispatched to the handlers registered with register_handler() and answered through notifications.
+
+    Every device has a transport of its own, created on its first frame or its AcquireNotify, reset when it
+    acquires again and dropped when it releases the socket or disconnects. Its frames only go to its acquired
+    socket, a device that did not acquire one can only be reached by the PropertiesChanged signal of StartNotify,
+    which BlueZ sends to every subscribed device. Writes without a device in the options share one transport,
+    reset on the first StartNotify and dropped after the last StopNotify.
+
     """
     update_timeout = 100
+    acquire_notify = True
+    acquire_write = True
     CUST_GATT_CHRC_UUID = '31842d98-c4f6-487b-80c5-715aa5657461'
 
     def __init__(self, bus, index, service):
-        logger = logging.getLogger("rotating.logger")
         gatt_char.Characteristic.__init__(
             self, bus, index,
             self.CUST_GATT_CHRC_UUID,
-            ['write', 'notify'],
+            ['write', 'write-without-response', 'notify'],
             service)
-        self.value = []
-        self.notifying = False
+        self.write_assembler = gatt_write_asm.WriteAssembler(self.payload_cb)
+        # Holds the handlers, shared by the dispatchers of every client
+        self.dispatcher = gatt_transport.RequestDispatcher()
+        self.clients = {}
+        self.register_handler(gatt_transport.OPCODE_ECHO, bytes)
+
+    def register_handler(self, opcode, handler):
+        self.dispatcher.register(opcode, handler)
+
+    def client(self, key):
+        """
+        Transport state of the device key, None for the shared one, created when missing.
+
+        """
+        client = self.clients.get(key)
+        if client is None:
+            dispatcher = gatt_transport.RequestDispatcher(self.dispatcher.handlers)
+            transport = gatt_transport.FramedTransport(lambda frame: self.send_frame(key, frame),
+                                                       lambda: self.frame_size(key),
+                                                       dispatcher.on_message)
+            dispatcher.transport = transport
+            client = self.clients[key] = _Client(transport, dispatcher)
+        return client
+
+    def frame_size(self, key):
+        entry = self.subscribers.get(key)
+        mtu = entry[2].mtu if entry is not None and entry[2] is not None else self.mtu
+        return mtu - gatt_vars.ATT_HEADER_SIZE
+
+    def payload_cb(self, device, payload):
+        logger.debug('[CUSTOM-CHAR][WRITE] Frame from %s, size: %d B', device, len(payload))
+        self.client(str(device) if device is not None else None).transport.receive_frame(payload)
+
+    def send_frame(self, key, frame):
+        # Frames are never deduplicated or chunked, they bypass the notification policy
+        if key in self.subscribers:
+            self._record_notification(frame)
+            self._send_acquired(key, frame, time.monotonic(), capped=False)
+        elif self._signal_subscribers:
+            self._record_notification(frame)
+            self._emit_signal(frame)
 
     def returns_and_replies_cb(self):
-        logger = logging.getLogger("rotating.logger")
-
-        characteristic_value = []
-
-        if gatt_config.debug_log:
-            logger.debug('[%s][CUSTOM-CHAR][UPDATE] >> Updated characteristic, size: %s B',
-                         time.strftime('%d/%m %H:%M:%S'),
-                         len(characteristic_value))
-
-        self.PropertiesChanged(gatt_vars.GATT_CHRC_IFACE, {'Value': characteristic_value}, [])
+        for key, client in list(self.clients.items()):
+            if client.transport.poll():
+                logger.debug('[CUSTOM-CHAR][UPDATE] >> Transport of %s: %s', key, client.transport.get_stats())
         return self.notifying
 
-    def _update_char(self):
-        logger = logging.getLogger("rotating.logger")
-        if gatt_config.debug_log:
-            logger.debug('[%s][CUSTOM-CHAR] Update returns and replies', time.strftime('%d/%m %H:%M:%S'))
-
+    def in_flight(self):
+        # Polling also retransmits the frames not acknowledged in time. A request partly written may still get
+        # its response within the drain.
         if not self.notifying:
-            return
+            return False
+        busy = False
+        for client in list(self.clients.values()):
+            busy = client.transport.poll() or client.transport.receiving() or busy
+        return busy
 
-        GObject.timeout_add(self.update_timeout, self.returns_and_replies_cb)
+    def notify_started(self):
+        self.start_periodic_notify(self.update_timeout, self.returns_and_replies_cb)
 
-    def StartNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        if self.notifying:
-            logger.debug('[%s][CUSTOM-CHAR] Already notifying, nothing to do', time.strftime('%d/%m %H:%M:%S'))
-            return
+    def notify_stopped(self):
+        self.stop_periodic_notify()
 
-        logger.debug('[%s][CUSTOM-CHAR] Starting notifications', time.strftime('%d/%m %H:%M:%S'))
-        self.notifying = True
-        self._update_char()
+    def notify_acquired(self, key):
+        self.client(key).transport.reset()
 
-    def StopNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        if not self.notifying:
-            logger.debug('[%s][CUSTOM-CHAR] Not notifying, nothing to do', time.strftime('%d/%m %H:%M:%S'))
-            return
+    def notify_released(self, key):
+        self.clients.pop(key, None)
 
-        logger.debug('[%s][CUSTOM-CHAR] Stopping notifications', time.strftime('%d/%m %H:%M:%S'))
-        self.notifying = False
-        self._update_char()
+    def session_closed(self, session):
+        self.write_assembler.discard(session.device)
+        self.clients.pop(session.device, None)
+        gatt_char.Characteristic.session_closed(self, session)
 
     def WriteValue(self, value, options):
-        logger = logging.getLogger("rotating.logger")
-        if gatt_config.debug_log:
-            logger.debug('[%s][CUSTOM-CHAR][WRITE] Example Characteristic - Write, size: %d B',
-                         time.strftime('%d/%m %H:%M:%S'),
-                         len(value))
-        # TODO do something with the writen value
-        self.value = value
+        logger.debug('[CUSTOM-CHAR][WRITE] Example Characteristic - Write, size: %d B, offset: %d',
+                     len(value), int(options.get('offset', 0)))
+        session = self.client_session(options)
+        if session is not None:
+            session.writes += 1
+            session.characteristics[self.path] = self
+        self.write_assembler.write(value, options)
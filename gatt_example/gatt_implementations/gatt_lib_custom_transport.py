@@ -0,0 +1,249 @@
+import time
+import struct
+import collections
+
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('custom_transport')
+
+# Frame: flags/kind byte, sequence number. The first frame of a message carries the message header.
+FRAME_HEADER = struct.Struct('<BB')
+# Message header: opcode, request id
+MESSAGE_HEADER = struct.Struct('<BB')
+
+FRAME_DATA = 0x00
+FRAME_ACK = 0x01
+FRAME_KIND_MASK = 0x0F
+FRAME_FIRST = 0x40
+FRAME_LAST = 0x80
+
+SEQ_MODULO = 256
+MAX_WINDOW = SEQ_MODULO // 2 - 1
+
+# Responses carry the opcode of their request with the response bit set
+OPCODE_RESPONSE = 0x80
+OPCODE_ERROR = 0x7F
+OPCODE_ECHO = 0x01
+
+ERROR_UNKNOWN_OPCODE = 0x01
+ERROR_HANDLER_FAILED = 0x02
+
+DEFAULT_WINDOW = 8
+DEFAULT_RETRANSMIT_TIMEOUT = 0.5
+DEFAULT_MAX_MESSAGE = 65536
+
+
+class FramedTransport(object):
+    """
+    Reliable, ordered message transport over a pipe that carries frames of at most frame_size() bytes, such as a
+    write+notify characteristic.
+
+    Messages are segmented into numbered frames, at most window of them are in flight. The receiver only accepts
+    the next frame in order and acknowledges cumulatively, once half a window was received, at the end of a
+    message or when a frame is out of order. Unacknowledged frames are all sent again (go-back-N) when the oldest
+    one is older than retransmit_timeout, checked from poll().
+
+    """
+
+    def __init__(self, send_frame, frame_size, on_message, window=DEFAULT_WINDOW,
+                 retransmit_timeout=DEFAULT_RETRANSMIT_TIMEOUT, max_message=DEFAULT_MAX_MESSAGE):
+        if not 0 < window <= MAX_WINDOW:
+            raise ValueError('Window must be between 1 and %d frames' % MAX_WINDOW)
+
+        self.send_frame = send_frame
+        self.frame_size = frame_size
+        self.on_message = on_message
+        self.window = window
+        self.retransmit_timeout = retransmit_timeout
+        self.max_message = max_message
+
+        self._next_seq = 0
+        self._unacked = collections.deque()
+        self._pending = collections.deque()
+        self._sent_time = 0.0
+
+        self._expected_seq = 0
+        self._unacked_received = 0
+        self._message = None
+
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.retransmissions = 0
+        self.out_of_order = 0
+
+    # Sending
+
+    def send_message(self, opcode, request_id, payload):
+        """
+        Queue a message, it is segmented with the frame size at the time of the call.
+
+        """
+        body = MESSAGE_HEADER.pack(opcode, request_id) + bytes(payload)
+        segment_size = self.frame_size() - FRAME_HEADER.size
+        if segment_size <= 0:
+            raise ValueError('Frame size too small for the frame header')
+
+        view = memoryview(body)
+        for start in range(0, len(body), segment_size):
+            flags = FRAME_DATA
+            if start == 0:
+                flags |= FRAME_FIRST
+            if start + segment_size >= len(body):
+                flags |= FRAME_LAST
+            self._pending.append((flags, view[start:start + segment_size]))
+        self._pump()
+
+    def _pump(self):
+        while self._pending and len(self._unacked) < self.window:
+            flags, segment = self._pending.popleft()
+            frame = FRAME_HEADER.pack(flags, self._next_seq) + segment
+            self._next_seq = (self._next_seq + 1) % SEQ_MODULO
+            if not self._unacked:
+                self._sent_time = time.monotonic()
+            self._unacked.append(frame)
+            self._send(frame)
+
+    def _send(self, frame):
+        self.frames_sent += 1
+        self.send_frame(frame)
+
+    def _on_ack(self, seq):
+        # Cumulative, seq is the last frame received in order
+        if not self._unacked:
+            return
+        first_seq = self._unacked[0][1]
+        acked = (seq - first_seq) % SEQ_MODULO + 1
+        if acked > len(self._unacked):
+            # Duplicate acknowledgement of frames already released
+            return
+
+        for _ in range(acked):
+            self._unacked.popleft()
+        self._sent_time = time.monotonic()
+        self._pump()
+
+    def poll(self):
+        """
+        Retransmit the window when it timed out, return True while frames are outstanding.
+
+        """
+        if self._unacked and time.monotonic() - self._sent_time >= self.retransmit_timeout:
+            logger.debug('[CUSTOM-TRANSPORT] Retransmitting %d frames', len(self._unacked))
+            self.retransmissions += len(self._unacked)
+            self._sent_time = time.monotonic()
+            for frame in self._unacked:
+                self._send(frame)
+        return bool(self._unacked or self._pending)
+
+    def reset(self):
+        """
+        Forget every frame in flight and start both directions over at sequence number 0.
+
+        """
+        self._next_seq = 0
+        self._unacked.clear()
+        self._pending.clear()
+        self._expected_seq = 0
+        self._unacked_received = 0
+        self._message = None
+
+    # Receiving
+
+    def receive_frame(self, frame):
+        if len(frame) < FRAME_HEADER.size:
+            logger.warning('[CUSTOM-TRANSPORT] Runt frame of %d B dropped', len(frame))
+            return
+
+        flags, seq = FRAME_HEADER.unpack_from(frame)
+        if flags & FRAME_KIND_MASK == FRAME_ACK:
+            self._on_ack(seq)
+            return
+
+        self.frames_received += 1
+        if seq != self._expected_seq:
+            # Go-back-N: drop it and tell the sender where we stand
+            self.out_of_order += 1
+            self._send_ack()
+            return
+
+        self._expected_seq = (seq + 1) % SEQ_MODULO
+        self._unacked_received += 1
+
+        if flags & FRAME_FIRST:
+            self._message = bytearray()
+        if self._message is not None:
+            self._message += memoryview(frame)[FRAME_HEADER.size:]
+            if len(self._message) > self.max_message + MESSAGE_HEADER.size:
+                logger.warning('[CUSTOM-TRANSPORT] Message exceeds %d B, dropped', self.max_message)
+                self._message = None
+
+        if flags & FRAME_LAST or self._unacked_received >= max(1, self.window // 2):
+            self._send_ack()
+
+        if flags & FRAME_LAST and self._message is not None:
+            message, self._message = self._message, None
+            if len(message) < MESSAGE_HEADER.size:
+                logger.warning('[CUSTOM-TRANSPORT] Message without header dropped')
+                return
+            opcode, request_id = MESSAGE_HEADER.unpack_from(message)
+            self.on_message(opcode, request_id, memoryview(message)[MESSAGE_HEADER.size:])
+
+    def receiving(self):
+        """
+        True while a message is partly received.
+
+        """
+        return self._message is not None
+
+    def _send_ack(self):
+        self._unacked_received = 0
+        self._send(FRAME_HEADER.pack(FRAME_ACK, (self._expected_seq - 1) % SEQ_MODULO))
+
+    def get_stats(self):
+        return {
+            'frames_sent': self.frames_sent,
+            'frames_received': self.frames_received,
+            'retransmissions': self.retransmissions,
+            'out_of_order': self.out_of_order,
+            'in_flight': len(self._unacked),
+            'queued': len(self._pending),
+        }
+
+
+class RequestDispatcher(object):
+    """
+    Request/response on top of a FramedTransport. Handlers are registered per opcode, they get the request
+    payload and return the response payload (or None to not respond). Unknown opcodes and failing handlers are
+    answered with an OPCODE_ERROR message carrying the request opcode and the error code. Dispatchers of several
+    transports may share one handlers dict.
+
+    """
+
+    def __init__(self, handlers=None):
+        self.handlers = {} if handlers is None else handlers
+        self.transport = None
+
+    def register(self, opcode, handler):
+        if opcode & OPCODE_RESPONSE or opcode == OPCODE_ERROR:
+            raise ValueError('Opcode 0x%02x is reserved' % opcode)
+        self.handlers[opcode] = handler
+
+    def unregister(self, opcode):
+        self.handlers.pop(opcode, None)
+
+    def on_message(self, opcode, request_id, payload):
+        handler = self.handlers.get(opcode)
+        if handler is None:
+            logger.warning('[CUSTOM-TRANSPORT] No handler for opcode 0x%02x', opcode)
+            self.transport.send_message(OPCODE_ERROR, request_id, bytes((opcode, ERROR_UNKNOWN_OPCODE)))
+            return
+
+        try:
+            response = handler(payload)
+        except Exception:
+            logger.exception('[CUSTOM-TRANSPORT] Handler of opcode 0x%02x failed', opcode)
+            self.transport.send_message(OPCODE_ERROR, request_id, bytes((opcode, ERROR_HANDLER_FAILED)))
+            return
+
+        if response is not None:
+            self.transport.send_message(opcode | OPCODE_RESPONSE, request_id, response)
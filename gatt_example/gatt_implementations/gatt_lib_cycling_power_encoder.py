@@ -0,0 +1,199 @@
+import sys
+import array
+import struct
+
+
+class CyclingPowerMeasurementEncoder(object):
+    """
+    Table driven encoder for the Cycling Power Measurement characteristic value.
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_measurement.xml
+
+    Every flags combination is compiled once into a struct.Struct layout and the list of sample keys it consumes,
+    so encoding a sample is a single pack call. Sample values are given in the units of the specification
+    (e.g. pedal power balance in 1/2 %, accumulated torque in 1/32 Nm, accumulated energy in kJ).
+
+    """
+
+    PEDAL_POWER_BALANCE_PRESENT = 0x0001
+    PEDAL_POWER_BALANCE_REFERENCE = 0x0002
+    ACCUMULATED_TORQUE_PRESENT = 0x0004
+    ACCUMULATED_TORQUE_SOURCE = 0x0008
+    WHEEL_REVOLUTION_DATA_PRESENT = 0x0010
+    CRANK_REVOLUTION_DATA_PRESENT = 0x0020
+    EXTREME_FORCE_MAGNITUDES_PRESENT = 0x0040
+    EXTREME_TORQUE_MAGNITUDES_PRESENT = 0x0080
+    EXTREME_ANGLES_PRESENT = 0x0100
+    TOP_DEAD_SPOT_ANGLE_PRESENT = 0x0200
+    BOTTOM_DEAD_SPOT_ANGLE_PRESENT = 0x0400
+    ACCUMULATED_ENERGY_PRESENT = 0x0800
+    OFFSET_COMPENSATION_INDICATOR = 0x1000
+
+    # Mandatory part of every frame: flags (uint16) and instantaneous power (sint16)
+    HEADER_FORMAT = 'Hh'
+
+    # Optional fields in the order they appear on air: (flag, struct format, sample keys)
+    # The extreme angles are a 24 bit field (12 bit maximum, 12 bit minimum), it is packed as uint16 + uint8
+    # from the 'extreme_angles' pseudo key computed in encode().
+    FIELDS = (
+        (PEDAL_POWER_BALANCE_PRESENT, 'B', ('pedal_power_balance',)),
+        (ACCUMULATED_TORQUE_PRESENT, 'H', ('accumulated_torque',)),
+        (WHEEL_REVOLUTION_DATA_PRESENT, 'IH', ('cumulative_wheel_revolutions', 'last_wheel_event_time')),
+        (CRANK_REVOLUTION_DATA_PRESENT, 'HH', ('cumulative_crank_revolutions', 'last_crank_event_time')),
+        (EXTREME_FORCE_MAGNITUDES_PRESENT, 'hh', ('maximum_force_magnitude', 'minimum_force_magnitude')),
+        (EXTREME_TORQUE_MAGNITUDES_PRESENT, 'hh', ('maximum_torque_magnitude', 'minimum_torque_magnitude')),
+        (EXTREME_ANGLES_PRESENT, 'HB', ('extreme_angles_low', 'extreme_angles_high')),
+        (TOP_DEAD_SPOT_ANGLE_PRESENT, 'H', ('top_dead_spot_angle',)),
+        (BOTTOM_DEAD_SPOT_ANGLE_PRESENT, 'H', ('bottom_dead_spot_angle',)),
+        (ACCUMULATED_ENERGY_PRESENT, 'H', ('accumulated_energy',)),
+    )
+
+    def __init__(self):
+        self._layouts = {}
+
+    def get_layout(self, flags):
+        """
+        Return the compiled (struct.Struct, sample keys) pair for a flags value, compiling it on first use.
+
+        """
+        layout = self._layouts.get(flags)
+        if layout is None:
+            layout = self._compile(flags)
+            self._layouts[flags] = layout
+        return layout
+
+    @classmethod
+    def _compile(cls, flags):
+        fmt = '<' + cls.HEADER_FORMAT
+        keys = []
+        for flag, field_format, field_keys in cls.FIELDS:
+            if flags & flag:
+                fmt += field_format
+                keys.extend(field_keys)
+        return struct.Struct(fmt), tuple(keys)
+
+    def encode(self, flags, sample):
+        """
+        Encode a sample (a dict keyed by the names in FIELDS plus 'instantaneous_power') into the on air bytes.
+
+        """
+        frame_struct, keys = self.get_layout(flags)
+        if flags & self.EXTREME_ANGLES_PRESENT:
+            angles = (sample['maximum_angle'] & 0xFFF) | ((sample['minimum_angle'] & 0xFFF) << 12)
+            sample = dict(sample, extreme_angles_low=angles & 0xFFFF, extreme_angles_high=angles >> 16)
+        return frame_struct.pack(flags, sample['instantaneous_power'], *[sample[key] for key in keys])
+
+    def frame_size(self, flags):
+        return self.get_layout(flags)[0].size
+
+
+def magnitude_bytes(magnitudes):
+    """
+    Little endian sint16 bytes of the magnitudes, saturated to the sint16 range, converted in one call: a NumPy
+    array through astype (NumPy is never imported here, any array with astype and clip is taken as one), an
+    array.array('h') as it is, anything else through an array.array('h') of the rounded values.
+
+    """
+    if hasattr(magnitudes, 'astype') and hasattr(magnitudes, 'clip'):
+        return magnitudes.clip(-0x8000, 0x7FFF).round().astype('<i2').tobytes()
+
+    if not isinstance(magnitudes, array.array) or magnitudes.typecode != 'h':
+        try:
+            magnitudes = array.array('h', [int(round(value)) for value in magnitudes])
+        except OverflowError:
+            magnitudes = array.array('h', [max(-0x8000, min(0x7FFF, int(round(value)))) for value in magnitudes])
+    if sys.byteorder == 'big':
+        magnitudes = array.array('h', magnitudes)
+        magnitudes.byteswap()
+    return magnitudes.tobytes()
+
+
+class CyclingPowerVectorEncoder(object):
+    """
+    Encoder for the Cycling Power Vector characteristic value, a flags byte, the optional crank revolution data and
+    first crank measurement angle, then an array of instantaneous force (N) or torque (1/32 Nm) magnitudes.
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_vector.xml
+
+    An array longer than one notification is split over as few notifications as the payload size allows, each
+    filled with as many whole magnitudes as fit. The first one carries the crank revolution data and the first
+    crank measurement angle, the following ones only the flags and the rest of the array, so a client appends
+    them until the next notification with the crank data.
+
+    """
+
+    CRANK_REVOLUTION_DATA_PRESENT = 0x01
+    FIRST_CRANK_MEASUREMENT_ANGLE_PRESENT = 0x02
+    INSTANTANEOUS_FORCE_MAGNITUDE_ARRAY_PRESENT = 0x04
+    INSTANTANEOUS_TORQUE_MAGNITUDE_ARRAY_PRESENT = 0x08
+    # Bits 4-5, the direction the magnitudes are measured in
+    DIRECTION_SHIFT = 4
+    DIRECTION_UNKNOWN = 0
+    DIRECTION_TANGENTIAL = 1
+    DIRECTION_RADIAL = 2
+    DIRECTION_LATERAL = 3
+
+    MAGNITUDE_SIZE = 2
+    # Fields only the first notification of a vector carries
+    FIRST_FIELDS = (
+        (CRANK_REVOLUTION_DATA_PRESENT, 'HH', ('cumulative_crank_revolutions', 'last_crank_event_time')),
+        (FIRST_CRANK_MEASUREMENT_ANGLE_PRESENT, 'H', ('first_crank_measurement_angle',)),
+    )
+
+    def __init__(self):
+        self._layouts = {}
+
+    def get_layout(self, flags):
+        """
+        Return the compiled (struct.Struct, sample keys) pair of the first notification for a flags value.
+
+        """
+        layout = self._layouts.get(flags)
+        if layout is None:
+            fmt = '<B'
+            keys = []
+            for flag, field_format, field_keys in self.FIRST_FIELDS:
+                if flags & flag:
+                    fmt += field_format
+                    keys.extend(field_keys)
+            layout = self._layouts[flags] = (struct.Struct(fmt), tuple(keys))
+        return layout
+
+    def encode(self, flags, sample, magnitudes, payload_size):
+        """
+        Encode a vector into the notifications carrying it, each at most payload_size (ATT MTU - 3) bytes.
+        sample holds the crank revolution data and first crank measurement angle the flags ask for, magnitudes
+        are packed with magnitude_bytes().
+
+        """
+        header_struct, keys = self.get_layout(flags)
+        array_flags = flags & (self.INSTANTANEOUS_FORCE_MAGNITUDE_ARRAY_PRESENT |
+                               self.INSTANTANEOUS_TORQUE_MAGNITUDE_ARRAY_PRESENT)
+        header = header_struct.pack(flags, *[sample[key] for key in keys])
+        if not array_flags:
+            return [header]
+
+        data = magnitude_bytes(magnitudes)
+        first = (payload_size - len(header)) // self.MAGNITUDE_SIZE * self.MAGNITUDE_SIZE
+        if first <= 0:
+            raise ValueError('A payload of %d B cannot carry the %d B vector header' % (payload_size, len(header)))
+        packets = [header + data[:first]]
+        if len(data) <= first:
+            return packets
+
+        # Continuations keep the array and direction flags, the first only fields are left out
+        continuation = struct.pack('<B', flags & ~(self.CRANK_REVOLUTION_DATA_PRESENT |
+                                                   self.FIRST_CRANK_MEASUREMENT_ANGLE_PRESENT))
+        step = (payload_size - 1) // self.MAGNITUDE_SIZE * self.MAGNITUDE_SIZE
+        view = memoryview(data)
+        packets.extend(continuation + view[start:start + step] for start in range(first, len(data), step))
+        return packets
+
+    def notification_count(self, flags, count, payload_size):
+        """
+        How many notifications encode() needs for count magnitudes.
+
+        """
+        header_size = self.get_layout(flags)[0].size
+        first = (payload_size - header_size) // self.MAGNITUDE_SIZE
+        if count <= first:
+            return 1
+        return 1 + -(-(count - first) // ((payload_size - 1) // self.MAGNITUDE_SIZE))
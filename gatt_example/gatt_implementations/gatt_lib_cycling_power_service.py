@@ -1,17 +1,32 @@
-import dbus
-import dbus.service
-import time
+import math
+import array
 import logging
-
-try:
-    from gi.repository import GObject
-except ImportError:
-    import gobject as GObject
+import struct
 
 import gatt_example.gatt_base.gatt_lib_variables as gatt_var
 import gatt_example.gatt_base.gatt_lib_service as gatt_service
 import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+import gatt_example.gatt_implementations.gatt_lib_cycling_power_encoder as gatt_cp_enc
+import gatt_example.gatt_implementations.gatt_lib_revolutions as gatt_revolutions
 import gatt_example.configuration.gatt_lib_config as gatt_config
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('cycling_power')
+
+
+def open_sample_reader():
+    """
+    Reader of the configured sample ring, None without one or when it cannot be opened.
+
+    """
+    if gatt_config.sample_ring_path is None:
+        return None
+    try:
+        return gatt_ring.SampleRingReader(gatt_config.sample_ring_path)
+    except (OSError, ValueError) as error:
+        logger.warning('[CYCLING-POWER] Could not open sample ring: %s', error)
+        return None
 
 
 class CyclingPowerService(gatt_service.Service):
@@ -25,9 +40,16 @@ class CyclingPowerService(gatt_service.Service):
 
     def __init__(self, bus, index):
         gatt_service.Service.__init__(self, bus, index, self.CYCLING_POWER_UUID, True)
+        # Settings of the Control Point: crank length in 1/2 mm and the force offset found by the last offset
+        # compensation, in N, subtracted from the vector magnitudes
+        self.crank_length = 345
+        self.force_offset = 0
         self.add_characteristic(CyclingPowerMeasurementChrc(bus, 0, self))
         self.add_characteristic(CyclingPowerFeatureChrc(bus, 1, self))
-        self.add_characteristic(CyclingPowerSensorLocationChrc(bus, 2, self))
+        self.sensor_location = CyclingPowerSensorLocationChrc(bus, 2, self)
+        self.add_characteristic(self.sensor_location)
+        self.add_characteristic(CyclingPowerVectorChrc(bus, 3, self))
+        self.add_characteristic(CyclingPowerControlPointChrc(bus, 4, self))
 
 
 class CyclingPowerMeasurementChrc(gatt_char.Characteristic):
@@ -35,9 +57,22 @@ class CyclingPowerMeasurementChrc(gatt_char.Characteristic):
     Cycling Power Measurement characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_measurement.xml
 
+    The wheel and crank revolution data are those of the revolution trackers of the application, shared with the
+    Cycling Speed and Cadence Measurement.
+
+    With notify_on_change a measurement is sent when the power or a revolution count changed. The event times are
+    left out of the comparison since they only move with the counts, so while pedalling every measurement goes out
+    and only those of a rider stopped at a constant power are suppressed, down to the notify_max_interval heartbeat.
+
     """
 
     update_timeout = 250
+    notify_on_change = True
+    # Compare the fields of CHANGE_FIELDS, exactly, instead of the encoded bytes
+    notify_deadband = {}
+    CHANGE_FIELDS = ('instantaneous_power', 'cumulative_wheel_revolutions', 'cumulative_crank_revolutions')
+    acquire_notify = True
+    notify_max_interval = 2.0
     CYCLING_POWER_MEASURMENT_UUID = '00002A63-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
@@ -46,64 +81,234 @@ class CyclingPowerMeasurementChrc(gatt_char.Characteristic):
             self.CYCLING_POWER_MEASURMENT_UUID,
             ['notify'],
             service)
-        self.notifying = False
+        self.encoder = gatt_cp_enc.CyclingPowerMeasurementEncoder()
+        # Flags of the measurement frame, every optional field whose flag is set must be present in the sample.
+        self.measurement_flags = (gatt_cp_enc.CyclingPowerMeasurementEncoder.WHEEL_REVOLUTION_DATA_PRESENT |
+                                  gatt_cp_enc.CyclingPowerMeasurementEncoder.CRANK_REVOLUTION_DATA_PRESENT)
+        self.sample = {'instantaneous_power': 150}
+        self.sample_reader = None
+
+    def _open_sample_reader(self):
+        if self.sample_reader is None:
+            self.sample_reader = open_sample_reader()
 
     def power_msrmt_cb(self):
-        logger = logging.getLogger("rotating.logger")
-
-        # 1st byte - 2nd byte: Flags. We support Instantaneous Power Data only nothing else.
-        # 16bit field
-        characteristic_value = [dbus.Byte(0x00), dbus.Byte(0x00)]
-
-        power_16bit = 150
-        lso_mask = 0xFF
-        power_lso = power_16bit & lso_mask
-        power_mso = (power_16bit >> 8) & lso_mask
-        characteristic_value.append(dbus.Byte(power_lso))
-        characteristic_value.append(dbus.Byte(power_mso))
-
-        if gatt_config.debug_log:
-            logger.debug('[%s][CYCLING-POWER-CHAR][ZMQ-IN] >> Updated characteristic, Values: %s, Cycling Power: %d',
-                         time.strftime('%d/%m %H:%M:%S'),
+        if self.sample_reader is not None:
+            sample = self.sample_reader.latest()
+            if sample is not None:
+                power = int(sample.values[gatt_ring.CHANNEL_POWER])
+                self.sample['instantaneous_power'] = max(-0x8000, min(0x7FFF, power))
+
+        revolutions = self.service.application.revolutions
+        revolutions.poll()
+        self.sample['cumulative_wheel_revolutions'] = revolutions.wheel.cumulative(
+            gatt_revolutions.WHEEL_REVOLUTION_BITS)
+        self.sample['last_wheel_event_time'] = revolutions.wheel.event_time(gatt_revolutions.EVENT_TIME_2048)
+        self.sample['cumulative_crank_revolutions'] = revolutions.crank.cumulative(
+            gatt_revolutions.CRANK_REVOLUTION_BITS)
+        self.sample['last_crank_event_time'] = revolutions.crank.event_time(gatt_revolutions.EVENT_TIME_1024)
+
+        characteristic_value = self.encoder.encode(self.measurement_flags, self.sample)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[CYCLING-POWER-CHAR][ZMQ-IN] >> Updated characteristic, Values: %s, Cycling Power: %d',
                          repr(characteristic_value),
-                         power_16bit
+                         self.sample['instantaneous_power']
                          )
 
-        self.PropertiesChanged(gatt_var.GATT_CHRC_IFACE, {'Value': characteristic_value}, [])
+        self.notify_value(characteristic_value, {key: self.sample[key] for key in self.CHANGE_FIELDS})
+        return self.notifying
+
+    def notify_started(self):
+        self._open_sample_reader()
+        self.start_periodic_notify(self.update_timeout, self.power_msrmt_cb)
+
+    def notify_stopped(self):
+        self.stop_periodic_notify()
+
+
+class CyclingPowerVectorChrc(gatt_char.Characteristic):
+    """
+    Cycling Power Vector characteristic
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_vector.xml
+
+    One vector per crank revolution: the tangential force magnitudes sampled over the revolution, from the force and
+    crank angle channels of the sample ring, sent once the crank angle wraps. Without a sample ring a synthetic
+    pedal stroke of synthetic_samples magnitudes is sent at cadence_rpm. The crank revolution data are those of the
+    revolution trackers of the application, the same as in the measurements. A vector goes out as the few MTU sized
+    notifications gatt_lib_cycling_power_encoder.CyclingPowerVectorEncoder splits it into, never partly dropped by
+    the rate cap of a session.
+
+    """
+
+    CP_VECTOR_UUID = '00002A64-0000-1000-8000-00805f9b34fb'
+    # Sample ring poll period
+    update_timeout = 50
+    acquire_notify = True
+    cadence_rpm = 90
+    synthetic_samples = 36
+    # A crank standing still never wraps, the samples of a revolution are bounded
+    max_samples = 4096
+    VECTOR_FLAGS = (gatt_cp_enc.CyclingPowerVectorEncoder.CRANK_REVOLUTION_DATA_PRESENT |
+                    gatt_cp_enc.CyclingPowerVectorEncoder.FIRST_CRANK_MEASUREMENT_ANGLE_PRESENT |
+                    gatt_cp_enc.CyclingPowerVectorEncoder.INSTANTANEOUS_FORCE_MAGNITUDE_ARRAY_PRESENT |
+                    gatt_cp_enc.CyclingPowerVectorEncoder.DIRECTION_TANGENTIAL <<
+                    gatt_cp_enc.CyclingPowerVectorEncoder.DIRECTION_SHIFT)
+
+    def __init__(self, bus, index, service):
+        gatt_char.Characteristic.__init__(
+            self, bus, index,
+            self.CP_VECTOR_UUID,
+            ['notify'],
+            service)
+        self.encoder = gatt_cp_enc.CyclingPowerVectorEncoder()
+        self.sample = {'first_crank_measurement_angle': 0}
+        self.sample_reader = None
+        self.vectors_sent = 0
+        self._forces = []
+        self._first_angle = None
+        self._last_angle = None
+        # Packed once, the synthetic stroke is the same every revolution
+        self._synthetic = array.array('h', [int(150 + 250 * math.sin(2 * math.pi * index / self.synthetic_samples))
+                                            for index in range(self.synthetic_samples)])
+
+    def send_vector(self, magnitudes, first_angle):
+        revolutions = self.service.application.revolutions
+        revolutions.poll()
+        self.sample['cumulative_crank_revolutions'] = revolutions.crank.cumulative(
+            gatt_revolutions.CRANK_REVOLUTION_BITS)
+        self.sample['last_crank_event_time'] = revolutions.crank.event_time(gatt_revolutions.EVENT_TIME_1024)
+        self.sample['first_crank_measurement_angle'] = int(first_angle) % 360
+        packets = self.encoder.encode(self.VECTOR_FLAGS, self.sample, magnitudes, self.mtu - gatt_var.ATT_HEADER_SIZE)
+        for packet in packets:
+            self._emit_chunk(packet, capped=False)
+        self.count_sent(len(packets))
+        self.vectors_sent += 1
+
+    def synthetic_cb(self):
+        self.send_vector(self._synthetic, 0)
+        return self.notifying
+
+    def vector_cb(self):
+        offset = self.service.force_offset
+        for sample in self.sample_reader.read_new():
+            angle = sample.values[gatt_ring.CHANNEL_CRANK_ANGLE]
+            # The revolution the forces belong to ends here, the wrap itself is counted by the revolution trackers
+            if self._last_angle is not None and angle < self._last_angle and self._forces:
+                self.send_vector(self._forces, self._first_angle)
+                self._forces = []
+            if not self._forces or len(self._forces) >= self.max_samples:
+                self._forces = []
+                self._first_angle = angle
+            self._forces.append(sample.values[gatt_ring.CHANNEL_FORCE] - offset)
+            self._last_angle = angle
         return self.notifying
 
-    def _update_power_msrmt(self):
-        logger = logging.getLogger("rotating.logger")
-        if gatt_config.debug_log:
-            logger.debug('[%s][CYCLING-POWER-CHAR] Update Power Measurement', time.strftime('%d/%m %H:%M:%S'))
+    def notify_started(self):
+        if self.sample_reader is None:
+            self.sample_reader = open_sample_reader()
+        if self.sample_reader is None:
+            self.start_periodic_notify(int(60000 / self.cadence_rpm), self.synthetic_cb)
+            return
+
+        # Start with the next revolution, not with what the ring holds from before
+        self.sample_reader.read_new()
+        self._forces = []
+        self._last_angle = None
+        self.start_periodic_notify(self.update_timeout, self.vector_cb)
+
+    def notify_stopped(self):
+        self.stop_periodic_notify()
+
+
+class CyclingPowerControlPointChrc(gatt_char.ControlPointCharacteristic):
+    """
+    Cycling Power Control Point characteristic
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_control_point.xml
+
+    Set Cumulative Value sets the wheel revolutions shared with the Cycling Speed and Cadence service, offset
+    compensation takes offset_compensation_ms.
+
+    """
+
+    CP_CONTROL_POINT_UUID = '00002A66-0000-1000-8000-00805f9b34fb'
 
-        if not self.notifying:
+    SET_CUMULATIVE_VALUE = 0x01
+    UPDATE_SENSOR_LOCATION = 0x02
+    REQUEST_SUPPORTED_SENSOR_LOCATIONS = 0x03
+    SET_CRANK_LENGTH = 0x04
+    REQUEST_CRANK_LENGTH = 0x05
+    START_OFFSET_COMPENSATION = 0x0C
+    RESPONSE_CODE = 0x20
+
+    offset_compensation_ms = 500
+    # Force samples averaged into the offset
+    offset_samples = 100
+
+    def __init__(self, bus, index, service):
+        gatt_char.ControlPointCharacteristic.__init__(
+            self, bus, index,
+            self.CP_CONTROL_POINT_UUID,
+            service)
+        self.sample_reader = None
+        self.handlers = {
+            self.SET_CUMULATIVE_VALUE: self._set_cumulative_value,
+            self.UPDATE_SENSOR_LOCATION: self._update_sensor_location,
+            self.REQUEST_SUPPORTED_SENSOR_LOCATIONS: self._request_supported_sensor_locations,
+            self.SET_CRANK_LENGTH: self._set_crank_length,
+            self.REQUEST_CRANK_LENGTH: self._request_crank_length,
+            self.START_OFFSET_COMPENSATION: self._start_offset_compensation,
+        }
+
+    # Procedures, each ends with respond()
+
+    def _set_cumulative_value(self, op_code, parameter):
+        if len(parameter) != 4:
+            self.respond(op_code, self.INVALID_PARAMETER)
+            return
+        self.service.application.revolutions.wheel.set_revolutions(struct.unpack('<I', parameter)[0])
+        self.respond(op_code, self.SUCCESS)
+
+    def _update_sensor_location(self, op_code, parameter):
+        sensor_location = self.service.sensor_location
+        if len(parameter) != 1 or parameter[0] not in sensor_location.SUPPORTED_LOCATIONS:
+            self.respond(op_code, self.INVALID_PARAMETER)
             return
+        sensor_location.set_location(parameter[0])
+        self.respond(op_code, self.SUCCESS)
 
-        GObject.timeout_add(self.update_timeout, self.power_msrmt_cb)
+    def _request_supported_sensor_locations(self, op_code, parameter):
+        self.respond(op_code, self.SUCCESS, bytes(self.service.sensor_location.SUPPORTED_LOCATIONS))
 
-    def StartNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        if self.notifying:
-            logger.debug('[%s][CYCLING-POWER-CHAR] Already notifying, nothing to do', time.strftime('%d/%m %H:%M:%S'))
+    def _set_crank_length(self, op_code, parameter):
+        if len(parameter) != 2:
+            self.respond(op_code, self.INVALID_PARAMETER)
             return
+        self.service.crank_length = struct.unpack('<H', parameter)[0]
+        logger.info('[CYCLING-POWER-CONTROL-POINT] Crank length set to %.1f mm', self.service.crank_length / 2.0)
+        self.respond(op_code, self.SUCCESS)
 
-        logger.debug('[%s][CYCLING-POWER-CHAR] Starting notifications', time.strftime('%d/%m %H:%M:%S'))
-        self.notifying = True
-        self._update_power_msrmt()
+    def _request_crank_length(self, op_code, parameter):
+        self.respond(op_code, self.SUCCESS, struct.pack('<H', self.service.crank_length))
 
-    def StopNotify(self):
-        logger = logging.getLogger("rotating.logger")
-        if not self.notifying:
-            logger.debug('[%s][CYCLING-POWER-CHAR] Not notifying, nothing to do', time.strftime('%d/%m %H:%M:%S'))
+    def _start_offset_compensation(self, op_code, parameter):
+        if parameter:
+            self.respond(op_code, self.INVALID_PARAMETER)
             return
+        self.start_timer(self.offset_compensation_ms, self._offset_compensated, op_code)
 
-        logger.debug('[%s][INDOOR-BIKE-DATA-CHAR] Stoping notifications', time.strftime('%d/%m %H:%M:%S'))
-        self.notifying = False
-        self._update_power_msrmt()
+    def _offset_compensated(self, op_code):
+        if self.sample_reader is None:
+            self.sample_reader = open_sample_reader()
+        samples = self.sample_reader.window(self.offset_samples) if self.sample_reader is not None else []
+        # The unloaded pedal, what it measures is the offset
+        offset = sum(sample.values[gatt_ring.CHANNEL_FORCE] for sample in samples) / len(samples) if samples else 0
+        self.service.force_offset = max(-0x8000, min(0x7FFF, int(round(offset))))
+        logger.info('[CYCLING-POWER-CONTROL-POINT] Offset compensation done, offset %d N', self.service.force_offset)
+        self.respond(op_code, self.SUCCESS, struct.pack('<h', self.service.force_offset))
 
 
-class CyclingPowerFeatureChrc(gatt_char.Characteristic):
+class CyclingPowerFeatureChrc(gatt_char.StaticCharacteristic):
     """
     Cycling Power Feature characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.cycling_power_feature.xml
@@ -112,29 +317,28 @@ class CyclingPowerFeatureChrc(gatt_char.Characteristic):
 
     CP_FEATURE_UUID = '00002A65-0000-1000-8000-00805f9b34fb'
 
+    WHEEL_REVOLUTION_DATA_SUPPORTED = 1 << 2
+    CRANK_REVOLUTION_DATA_SUPPORTED = 1 << 3
+    OFFSET_COMPENSATION_SUPPORTED = 1 << 9
+    MULTIPLE_SENSOR_LOCATIONS_SUPPORTED = 1 << 11
+    CRANK_LENGTH_ADJUSTMENT_SUPPORTED = 1 << 12
+    # Bit 16, the sensor measurement context, is left 0: force based
+    INSTANTANEOUS_MEASUREMENT_DIRECTION_SUPPORTED = 1 << 17
+
+    # What the Measurement, the Control Point and the Vector implement, 32bits field
+    FEATURES = (WHEEL_REVOLUTION_DATA_SUPPORTED | CRANK_REVOLUTION_DATA_SUPPORTED | OFFSET_COMPENSATION_SUPPORTED |
+                MULTIPLE_SENSOR_LOCATIONS_SUPPORTED | CRANK_LENGTH_ADJUSTMENT_SUPPORTED |
+                INSTANTANEOUS_MEASUREMENT_DIRECTION_SUPPORTED)
+
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.CP_FEATURE_UUID,
-            ['read'],
+            struct.pack('<I', self.FEATURES),
             service)
 
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        # Return Everything as 0 bits.
-        # Value: 000000000000000000000000000000000
-        # 32bits field
-        characteristic_value = [dbus.Byte(0x00), dbus.Byte(0x00), dbus.Byte(0x00), dbus.Byte(0x00)]
-
-        if gatt_config.debug_log:
-            logger.debug('[%s][CYCLING-POWER-FEATURE-CHAR] Read characteristic values: %s',
-                         time.strftime('%d/%m %H:%M:%S'),
-                         repr(characteristic_value)
-                         )
-        return characteristic_value
-
 
-class CyclingPowerSensorLocationChrc(gatt_char.Characteristic):
+class CyclingPowerSensorLocationChrc(gatt_char.StaticCharacteristic):
     """
     Cycling Power Sensor Location characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.sensor_location.xml
@@ -142,24 +346,16 @@ class CyclingPowerSensorLocationChrc(gatt_char.Characteristic):
     """
 
     CP_SENSOR_LOCATION_UUID = '00002A5D-0000-1000-8000-00805f9b34fb'
+    # Rear Wheel, Left Pedal, Right Pedal, Left Crank, Right Crank: the ones the Control Point may switch to
+    SUPPORTED_LOCATIONS = (12, 7, 8, 5, 6)
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        # 8 bit unsigned field, 'Rear Wheel' as the sensor location
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.CP_SENSOR_LOCATION_UUID,
-            ['read'],
+            struct.pack('<B', self.SUPPORTED_LOCATIONS[0]),
             service)
 
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-
-        # 8 bit unsigned field
-        # Return 'Rear Wheel' as the sensor location.
-        characteristic_value = [dbus.Byte(12)]
-
-        if gatt_config.debug_log:
-            logger.debug('[%s][CYCLING-POWER-SENSOR-LOCATION-CHAR] Read characteristic values: %s',
-                         time.strftime('%d/%m %H:%M:%S'),
-                         repr(characteristic_value)
-                         )
-        return characteristic_value
+    def set_location(self, location):
+        self.set_value(struct.pack('<B', location))
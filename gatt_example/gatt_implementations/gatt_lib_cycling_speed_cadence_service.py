@@ -0,0 +1,131 @@
+import logging
+import struct
+
+import gatt_example.gatt_base.gatt_lib_service as gatt_service
+import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+import gatt_example.gatt_implementations.gatt_lib_revolutions as gatt_revolutions
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('cycling_speed_cadence')
+
+
+class CyclingSpeedCadenceService(gatt_service.Service):
+    """
+    Cycling Speed and Cadence service.
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.service.cycling_speed_and_cadence.xml
+
+    """
+
+    CYCLING_SPEED_CADENCE_UUID = '00001816-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, bus, index):
+        gatt_service.Service.__init__(self, bus, index, self.CYCLING_SPEED_CADENCE_UUID, True)
+        self.add_characteristic(CscMeasurementChrc(bus, 0, self))
+        self.add_characteristic(CscFeatureChrc(bus, 1, self))
+        self.add_characteristic(ScControlPointChrc(bus, 2, self))
+
+
+class CscMeasurementChrc(gatt_char.Characteristic):
+    """
+    CSC Measurement characteristic
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.csc_measurement.xml
+
+    The wheel and crank revolution data of the revolution trackers of the application, shared with the Cycling
+    Power Measurement. Both event times are in 1/1024 s here.
+
+    """
+
+    update_timeout = 1000
+    notify_on_change = True
+    acquire_notify = True
+    notify_max_interval = 2.0
+    CSC_MEASUREMENT_UUID = '00002A5B-0000-1000-8000-00805f9b34fb'
+
+    WHEEL_REVOLUTION_DATA_PRESENT = 0x01
+    CRANK_REVOLUTION_DATA_PRESENT = 0x02
+    # Flags, cumulative wheel revolutions, last wheel event time, cumulative crank revolutions, last crank event time
+    MEASUREMENT_STRUCT = struct.Struct('<BIHHH')
+
+    def __init__(self, bus, index, service):
+        gatt_char.Characteristic.__init__(
+            self, bus, index,
+            self.CSC_MEASUREMENT_UUID,
+            ['notify'],
+            service)
+
+    def csc_msrmt_cb(self):
+        revolutions = self.service.application.revolutions
+        revolutions.poll()
+        characteristic_value = self.MEASUREMENT_STRUCT.pack(
+            self.WHEEL_REVOLUTION_DATA_PRESENT | self.CRANK_REVOLUTION_DATA_PRESENT,
+            revolutions.wheel.cumulative(gatt_revolutions.WHEEL_REVOLUTION_BITS),
+            revolutions.wheel.event_time(gatt_revolutions.EVENT_TIME_1024),
+            revolutions.crank.cumulative(gatt_revolutions.CRANK_REVOLUTION_BITS),
+            revolutions.crank.event_time(gatt_revolutions.EVENT_TIME_1024))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[CSC-CHAR] >> Updated characteristic, Values: %s', repr(characteristic_value))
+
+        self.notify_value(characteristic_value)
+        return self.notifying
+
+    def notify_started(self):
+        self.start_periodic_notify(self.update_timeout, self.csc_msrmt_cb)
+
+    def notify_stopped(self):
+        self.stop_periodic_notify()
+
+
+class CscFeatureChrc(gatt_char.StaticCharacteristic):
+    """
+    CSC Feature characteristic
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.csc_feature.xml
+
+    """
+
+    CSC_FEATURE_UUID = '00002A5C-0000-1000-8000-00805f9b34fb'
+
+    WHEEL_REVOLUTION_DATA_SUPPORTED = 1 << 0
+    CRANK_REVOLUTION_DATA_SUPPORTED = 1 << 1
+
+    def __init__(self, bus, index, service):
+        # 16bits field, a single sensor location so the Sensor Location characteristic is left out
+        gatt_char.StaticCharacteristic.__init__(
+            self, bus, index,
+            self.CSC_FEATURE_UUID,
+            struct.pack('<H', self.WHEEL_REVOLUTION_DATA_SUPPORTED | self.CRANK_REVOLUTION_DATA_SUPPORTED),
+            service)
+
+
+class ScControlPointChrc(gatt_char.ControlPointCharacteristic):
+    """
+    SC Control Point characteristic
+    https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.sc_control_point.xml
+
+    Mandatory with the wheel revolution data, Set Cumulative Value sets the wheel revolutions shared with the
+    Cycling Power service.
+
+    """
+
+    SC_CONTROL_POINT_UUID = '00002A55-0000-1000-8000-00805f9b34fb'
+
+    SET_CUMULATIVE_VALUE = 0x01
+    RESPONSE_CODE = 0x10
+
+    def __init__(self, bus, index, service):
+        gatt_char.ControlPointCharacteristic.__init__(
+            self, bus, index,
+            self.SC_CONTROL_POINT_UUID,
+            service)
+        self.handlers = {
+            self.SET_CUMULATIVE_VALUE: self._set_cumulative_value,
+        }
+
+    def _set_cumulative_value(self, op_code, parameter):
+        if len(parameter) != 4:
+            self.respond(op_code, self.INVALID_PARAMETER)
+            return
+        self.service.application.revolutions.wheel.set_revolutions(struct.unpack('<I', parameter)[0])
+        logger.info('[SC-CONTROL-POINT] Cumulative wheel revolutions set to %d',
+                    self.service.application.revolutions.wheel.revolutions)
+        self.respond(op_code, self.SUCCESS)
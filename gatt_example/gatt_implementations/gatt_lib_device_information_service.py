@@ -1,10 +1,8 @@
-import dbus
-import dbus.service
-import time
-import logging
-
 import gatt_example.gatt_base.gatt_lib_service as gatt_service
 import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('device_information')
 
 
 class DeviceInformationService(gatt_service.Service):
@@ -23,7 +21,7 @@ class DeviceInformationService(gatt_service.Service):
         self.add_characteristic(SerialNumberStringChrc(bus, 2, self))
 
 
-class ManufacturerNameStringChrc(gatt_char.Characteristic):
+class ManufacturerNameStringChrc(gatt_char.StaticCharacteristic):
     """
     Manufacturer Name String characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.manufacturer_name_string.xml
@@ -33,22 +31,15 @@ class ManufacturerNameStringChrc(gatt_char.Characteristic):
     MANUFACTURER_NAME_UUID = '00002A29-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        # Manufacturer name: Name here
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.MANUFACTURER_NAME_UUID,
-            ['read'],
+            b'\x00\x00',
             service)
 
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s][MANUFACTURER-NAME-CHAR][READ]', time.strftime('%d/%m %H:%M:%S'))
-        # Manufacturer name: Name here
-        characteristic_value = [dbus.Byte(0x00), dbus.Byte(0x00)]
-
-        return characteristic_value
-
 
-class ModelNumberStringChrc(gatt_char.Characteristic):
+class ModelNumberStringChrc(gatt_char.StaticCharacteristic):
     """
     Model Number String characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.model_number_string.xml
@@ -58,22 +49,14 @@ class ModelNumberStringChrc(gatt_char.Characteristic):
     MODEL_NUMBER_UUID = '00002A24-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.MODEL_NUMBER_UUID,
-            ['read'],
+            '1.0',
             service)
 
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s][MODEL-NUMBER-CHAR][READ]', time.strftime('%d/%m %H:%M:%S'))
-        # Model number: '1.0'
-        characteristic_value = [dbus.Byte(0x31), dbus.Byte(0x2e), dbus.Byte(0x30)]
 
-        return characteristic_value
-
-
-class SerialNumberStringChrc(gatt_char.Characteristic):
+class SerialNumberStringChrc(gatt_char.StaticCharacteristic):
     """
     Serial Number String characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.serial_number_string.xml
@@ -83,16 +66,9 @@ class SerialNumberStringChrc(gatt_char.Characteristic):
     SERIAL_NUMBER_UUID = '00002A25-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        # Serial number: 'Serial Here'
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.SERIAL_NUMBER_UUID,
-            ['read'],
+            b'\x00\x00',
             service)
-
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s][SERIAL-NUMBER-CHAR][READ]', time.strftime('%d/%m %H:%M:%S'))
-        # Serial number: 'Serial Here'
-        characteristic_value = [dbus.Byte(0x00), dbus.Byte(0x00)]
-
-        return characteristic_value
@@ -1,10 +1,10 @@
-import dbus
-import dbus.service
-import time
-import logging
+import struct
 
 import gatt_example.gatt_base.gatt_lib_service as gatt_service
 import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('generic_access')
 
 
 class GenericAccessService(gatt_service.Service):
@@ -22,7 +22,7 @@ class GenericAccessService(gatt_service.Service):
         self.add_characteristic(AppearanceChrc(bus, 1, self))
 
 
-class DeviceNameChrc(gatt_char.Characteristic):
+class DeviceNameChrc(gatt_char.StaticCharacteristic):
     """
     Device Name characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.gap.device_name.xml
@@ -32,22 +32,14 @@ class DeviceNameChrc(gatt_char.Characteristic):
     DEVICE_NAME_UUID = '00002A00-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.DEVICE_NAME_UUID,
-            ['read'],
+            'DevName',
             service)
 
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s][DEVICE-NAME-CHAR][READ]', time.strftime('%d/%m %H:%M:%S'))
-        device_name = 'DevName'
-        characteristic_value = dbus.String(device_name)
-
-        return characteristic_value
-
 
-class AppearanceChrc(gatt_char.Characteristic):
+class AppearanceChrc(gatt_char.StaticCharacteristic):
     """
     Appearance characteristic
     https://www.bluetooth.com/specifications/gatt/viewer?attributeXmlFile=org.bluetooth.characteristic.gap.appearance.xml
@@ -57,18 +49,10 @@ class AppearanceChrc(gatt_char.Characteristic):
     APPEARANCE_UUID = '00002A01-0000-1000-8000-00805f9b34fb'
 
     def __init__(self, bus, index, service):
-        gatt_char.Characteristic.__init__(
+        # 1 x 16 bit field
+        # 1153 - Cycling: Cycling Computer - Cycling subtype
+        gatt_char.StaticCharacteristic.__init__(
             self, bus, index,
             self.APPEARANCE_UUID,
-            ['read'],
+            struct.pack('<H', 1153),
             service)
-
-    def ReadValue(self, options):
-        logger = logging.getLogger("rotating.logger")
-        logger.debug('[%s][APPEARENCE-CHAR][READ]', time.strftime('%d/%m %H:%M:%S'))
-        # 1 x 16 bit field
-        # 1153 - Cycling: Cycling Computer - Cycling subtype
-        # 1st - 2nd byte
-        value = [dbus.Byte(0x81), dbus.Byte(0x04)]
-
-        return value
@@ -0,0 +1,137 @@
+import time
+
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+
+# Crank and wheel revolution data as the Cycling Power and the Cycling Speed and Cadence services send it: a
+# cumulative revolution count and the time of the last revolution event, both wrapping. A client turns two
+# consecutive values into a cadence or a speed from their differences modulo the field size, so the counts and the
+# event times must wrap exactly, never be reset or rounded differently from one value to the next.
+
+CRANK_REVOLUTION_BITS = 16
+WHEEL_REVOLUTION_BITS = 32
+EVENT_TIME_MASK = 0xFFFF
+# Last event time units: 1/1024 s everywhere except the wheel event time of the Cycling Power Measurement
+EVENT_TIME_1024 = 1024
+EVENT_TIME_2048 = 2048
+
+
+class RevolutionTracker(object):
+    """
+    Cumulative revolutions of a crank or a wheel and the time of the last revolution event, from the timestamps of
+    the edges of its sensor, one edge per revolution. edge() and add() are O(1), the count is kept unbounded and
+    wrapped to the field size only when read with cumulative().
+
+    Event times are taken from the monotonic timestamps themselves, floored to the unit and wrapped, so the
+    difference of two consecutive event times is exact modulo 65536 however long the tracker runs.
+
+    """
+
+    __slots__ = ('revolutions', 'last_event')
+
+    def __init__(self):
+        self.revolutions = 0
+        # Monotonic seconds of the last edge, None before the first one
+        self.last_event = None
+
+    def edge(self, timestamp):
+        self.revolutions += 1
+        self.last_event = timestamp
+
+    def add(self, revolutions, timestamp):
+        """
+        Several revolutions seen at once, the last of them at timestamp, e.g. from a counter sampled slower than it
+        counts.
+
+        """
+        if revolutions <= 0:
+            return
+        self.revolutions += revolutions
+        self.last_event = timestamp
+
+    def set_revolutions(self, revolutions):
+        """
+        Set Cumulative Value of the control points, the count continues from revolutions.
+
+        """
+        self.revolutions = revolutions
+
+    def cumulative(self, bits):
+        return self.revolutions & ((1 << bits) - 1)
+
+    def event_time(self, units_per_s):
+        if self.last_event is None:
+            return 0
+        return int(self.last_event * units_per_s) & EVENT_TIME_MASK
+
+
+class RevolutionIngest(object):
+    """
+    The crank and the wheel trackers shared by the Cycling Power Measurement and the Cycling Speed and Cadence
+    Measurement, so both report the same revolutions.
+
+    The edges come from the sample ring: a crank revolution each time the crank angle channel wraps, interpolated
+    between the two samples around the wrap, and the wheel revolutions counted by the wheel channel. Without a
+    sample ring a synthetic rider pedals at cadence_rpm with the wheel at wheel_rpm. poll() ingests what is new
+    since the last call, whichever characteristic makes it, so it is cheap to call before every notification.
+
+    """
+
+    cadence_rpm = 90
+    # About 30 km/h on a 2.1 m wheel
+    wheel_rpm = 240
+
+    def __init__(self, open_reader):
+        self.crank = RevolutionTracker()
+        self.wheel = RevolutionTracker()
+        self.open_reader = open_reader
+        self.sample_reader = None
+        self._opened = False
+        self._last_angle = None
+        self._last_time = None
+        self._last_wheel = None
+        self._synthetic_start = None
+        self._synthetic_edges = {}
+
+    def poll(self, now=None):
+        if not self._opened:
+            self._opened = True
+            self.sample_reader = self.open_reader()
+            if self.sample_reader is not None:
+                # Count from the next edge, not from what the ring holds from before
+                self.sample_reader.read_new()
+        if self.sample_reader is None:
+            self._poll_synthetic(time.monotonic() if now is None else now)
+            return
+
+        for sample in self.sample_reader.read_new():
+            self.ingest(sample.timestamp, sample.values[gatt_ring.CHANNEL_CRANK_ANGLE],
+                        sample.values[gatt_ring.CHANNEL_WHEEL_REVOLUTIONS])
+
+    def ingest(self, timestamp, angle, wheel_revolutions):
+        """
+        One sample of the crank angle in degrees and of the wheel revolution counter.
+
+        """
+        if self._last_angle is not None and angle < self._last_angle:
+            # The crank passed 0 between the two samples, at the time the angle would have at constant cadence
+            travelled = angle + 360.0 - self._last_angle
+            self.crank.edge(self._last_time + (timestamp - self._last_time) * (360.0 - self._last_angle) / travelled)
+        self._last_angle = angle
+        self._last_time = timestamp
+
+        revolutions = int(wheel_revolutions)
+        # A counter going backwards is a restarted producer, it counts from there on
+        if self._last_wheel is not None and revolutions > self._last_wheel:
+            self.wheel.add(revolutions - self._last_wheel, timestamp)
+        self._last_wheel = revolutions
+
+    def _poll_synthetic(self, now):
+        if self._synthetic_start is None:
+            self._synthetic_start = now
+            return
+        elapsed = now - self._synthetic_start
+        for tracker, rpm in ((self.crank, self.cadence_rpm), (self.wheel, self.wheel_rpm)):
+            period = 60.0 / rpm
+            edges = int(elapsed / period)
+            tracker.add(edges - self._synthetic_edges.get(tracker, 0), self._synthetic_start + edges * period)
+            self._synthetic_edges[tracker] = edges
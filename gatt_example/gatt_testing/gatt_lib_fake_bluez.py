@@ -0,0 +1,490 @@
+import copy
+import time
+import socket
+import asyncio
+import collections
+
+import gatt_example.gatt_base.gatt_lib_dbus_wire as gatt_wire
+import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+
+logger = gatt_log.get_logger('fake_bluez')
+
+ADAPTER_PATH_BASE = '/org/bluez/hci'
+DEVICE_ADDRESS = '00:11:22:33:44:55'
+DEFAULT_MTU = 185
+
+
+def device_path(adapter_path, address):
+    return adapter_path + '/dev_' + address.replace(':', '_')
+
+
+class GattClientApplication(object):
+    """
+    A GATT application registered on one adapter of the fake BlueZ, seen from the client side.
+
+    """
+
+    def __init__(self, adapter_path, sender, path, objects, registered_time):
+        self.adapter_path = adapter_path
+        self.device_path = device_path(adapter_path, DEVICE_ADDRESS)
+        self.sender = sender
+        self.path = path
+        self.objects = objects
+        self.registered_time = registered_time
+
+    def device(self, address):
+        """
+        The application as seen by another device connected to the same adapter.
+
+        """
+        client = copy.copy(self)
+        client.device_path = device_path(self.adapter_path, address)
+        return client
+
+    def characteristics(self, flag=None):
+        """
+        Paths of the characteristics, only those with flag in their Flags when given.
+
+        """
+        result = []
+        for path, interfaces in sorted(self.objects.items()):
+            properties = interfaces.get(gatt_var.GATT_CHRC_IFACE)
+            if properties is not None and (flag is None or flag in properties['Flags']):
+                result.append(path)
+        return result
+
+    def uuid(self, path):
+        return self.objects[path][gatt_var.GATT_CHRC_IFACE]['UUID']
+
+    def properties(self, path):
+        return self.objects[path][gatt_var.GATT_CHRC_IFACE]
+
+
+class FakeAdvertisement(object):
+    """
+    A registered advertisement, its properties follow PropertiesChanged like bluetoothd's advertising data does.
+
+    """
+
+    def __init__(self, adapter_path, sender, path, properties, registered_time):
+        self.adapter_path = adapter_path
+        self.sender = sender
+        self.path = path
+        self.properties = properties
+        self.registered_time = registered_time
+        self.updates = 0
+        self.receiver = None
+
+    def properties_changed(self, message):
+        interface, changed, invalidated = message.body
+        if interface != gatt_var.LE_ADVERTISEMENT_IFACE:
+            return
+        self.properties.update(changed)
+        for name in invalidated:
+            self.properties.pop(name, None)
+        self.updates += 1
+
+
+class FakeBluez(object):
+    """
+    Stand-in for bluetoothd on a private bus: adapters with GattManager1 and LEAdvertisingManager1 under an
+    ObjectManager, which may be added and removed at runtime (InterfacesAdded/InterfacesRemoved), and per adapter a
+    GATT client that drives the registered applications the way BlueZ does for one connected device
+    (GetManagedObjects, ReadValue, WriteValue, StartNotify, AcquireNotify). Further devices are simulated with
+    GattClientApplication.device(), notifications are counted per device and characteristic path.
+
+    """
+
+    def __init__(self, bus, adapters=1, mtu=DEFAULT_MTU):
+        self.bus = bus
+        self.mtu = mtu
+        self.adapters = collections.OrderedDict()
+        self.applications = {}
+        self.advertisements = {}
+        self.notifications = collections.Counter()
+        self.notify_handlers = {}
+        self.on_application = None
+        self.on_advertisement = None
+        self._started = False
+        self._adapter_index = 0
+        self._app_changed = asyncio.Event()
+        self._adv_changed = asyncio.Event()
+        self._receivers = {}
+        self._subscribers = collections.defaultdict(set)
+        self._acquired = {}
+        # Characteristics subscribed to for indications, and the sender confirming each indication goes to
+        self._indications = {}
+        self.confirmed = 0
+        self._owner_receiver = None
+        # Registrations removed by their owner and those dropped because the owner left the bus
+        self.unregistered = 0
+        self.reaped = 0
+        self._gone = set()
+
+        for _ in range(adapters):
+            self.add_adapter()
+
+    async def start(self):
+        reply = await self.bus.request_name(gatt_var.BLUEZ_SERVICE_NAME)
+        if reply != 1:
+            raise RuntimeError('Could not own %s on the bus (reply %d)' % (gatt_var.BLUEZ_SERVICE_NAME, reply))
+        self.bus.export('/', _ObjectManager(self))
+        for path in self.adapters:
+            self.bus.export(path, _Adapter(self, path))
+        self._owner_receiver = self.bus.add_signal_receiver(self._name_owner_changed, gatt_aio_bus.DBUS_SERVICE_NAME,
+                                                            gatt_aio_bus.DBUS_SERVICE_NAME, 'NameOwnerChanged')
+        self._started = True
+        return self
+
+    def _name_owner_changed(self, message):
+        name, old_owner, new_owner = message.body
+        if name.startswith(':') and not new_owner:
+            self._gone.add(name)
+            self.client_gone(name)
+
+    def client_gone(self, sender):
+        """
+        Like bluetoothd, drop the applications and advertisements of a client that left the bus.
+
+        """
+        for key in [key for key in self.applications if key[1] == sender]:
+            del self.applications[key]
+            self.reaped += 1
+        for key in [key for key in self.advertisements if key[1] == sender]:
+            self.bus.remove_signal_receiver(self.advertisements.pop(key).receiver)
+            self.reaped += 1
+
+    def _adapter_interfaces(self, path):
+        return {
+            gatt_var.ADAPTER_IFACE: dict(self.adapters[path]),
+            gatt_var.GATT_MANAGER_IFACE: {},
+            gatt_var.LE_ADVERTISING_MANAGER_IFACE: {},
+        }
+
+    def get_managed_objects(self):
+        return dict((path, self._adapter_interfaces(path)) for path in self.adapters)
+
+    def add_adapter(self):
+        path = ADAPTER_PATH_BASE + str(self._adapter_index)
+        self.adapters[path] = {
+            'Address': '00:00:00:00:00:%02X' % (self._adapter_index + 1),
+            'Name': 'fake-bluez-%d' % self._adapter_index,
+            'Powered': False,
+            'Discoverable': False,
+        }
+        self._adapter_index += 1
+
+        if self._started:
+            self.bus.export(path, _Adapter(self, path))
+            self.bus.emit_signal('/', gatt_var.DBUS_OM_IFACE, 'InterfacesAdded', 'oa{sa{sv}}',
+                                 [gatt_wire.ObjectPath(path), self._adapter_interfaces(path)])
+        return path
+
+    def remove_adapter(self, path):
+        interfaces = list(self._adapter_interfaces(path))
+        del self.adapters[path]
+        self.bus.unexport(path)
+
+        # Like bluetoothd, everything registered on the adapter goes with it
+        for key in [key for key in self.applications if key[0] == path]:
+            del self.applications[key]
+        for key in [key for key in self.advertisements if key[0] == path]:
+            self.bus.remove_signal_receiver(self.advertisements.pop(key).receiver)
+        for key in [key for key in self._acquired if key[0].startswith(path + '/')]:
+            self._release(key)
+        for subscribers in self._subscribers.values():
+            subscribers.difference_update([entry for entry in subscribers if entry[0] == path])
+
+        self.bus.emit_signal('/', gatt_var.DBUS_OM_IFACE, 'InterfacesRemoved', 'oas',
+                             [gatt_wire.ObjectPath(path), interfaces])
+
+    def set_powered(self, path, powered):
+        """
+        Power the adapter off or on as if rfkill or another client did. Like bluetoothd, advertising stops with
+        the controller, the advertisements registered on the adapter are dropped.
+
+        """
+        self.adapters[path]['Powered'] = powered
+        if not powered:
+            for key in [key for key in self.advertisements if key[0] == path]:
+                self.bus.remove_signal_receiver(self.advertisements.pop(key).receiver)
+        self.bus.emit_signal(path, gatt_var.DBUS_PROP_IFACE, 'PropertiesChanged', 'sa{sv}as',
+                             [gatt_var.ADAPTER_IFACE, {'Powered': powered}, []])
+
+    def client_options(self, application, **options):
+        result = {'device': gatt_wire.Variant('o', application.device_path), 'mtu': gatt_wire.Variant('q', self.mtu),
+                  'link': gatt_wire.Variant('s', 'LE')}
+        for key, value in options.items():
+            if isinstance(value, int):
+                result[key] = gatt_wire.Variant('q', value)
+            else:
+                result[key] = gatt_wire.Variant('s', value)
+        return result
+
+    # Registration
+
+    async def register_application(self, adapter_path, sender, path):
+        if (adapter_path, sender) in self.applications:
+            raise gatt_wire.DBusError('org.bluez.Error.AlreadyExists', 'Application already registered')
+
+        objects = (await self.bus.call(sender, path, gatt_var.DBUS_OM_IFACE, 'GetManagedObjects'))[0]
+        if sender in self._gone:
+            raise gatt_wire.DBusError('org.bluez.Error.Failed', 'Application left the bus')
+        application = GattClientApplication(adapter_path, sender, path, objects, time.monotonic())
+        self.applications[(adapter_path, sender)] = application
+        logger.info('[FAKE-BLUEZ] Application %s%s registered on %s with %d objects', sender, path, adapter_path,
+                    len(objects))
+        self._app_changed.set()
+        if self.on_application is not None:
+            self.on_application(application)
+
+    def unregister_application(self, adapter_path, sender, path):
+        application = self.applications.get((adapter_path, sender))
+        if application is None or application.path != path:
+            raise gatt_wire.DBusError('org.bluez.Error.DoesNotExist', 'Application not registered')
+        del self.applications[(adapter_path, sender)]
+        self.unregistered += 1
+
+    async def register_advertisement(self, adapter_path, sender, path):
+        properties = (await self.bus.call(sender, path, gatt_var.DBUS_PROP_IFACE, 'GetAll', 's',
+                                          [gatt_var.LE_ADVERTISEMENT_IFACE]))[0]
+        if sender in self._gone:
+            raise gatt_wire.DBusError('org.bluez.Error.Failed', 'Advertisement left the bus')
+        advertisement = FakeAdvertisement(adapter_path, sender, path, properties, time.monotonic())
+        advertisement.receiver = self.bus.add_signal_receiver(advertisement.properties_changed, sender=sender,
+                                                              interface=gatt_var.DBUS_PROP_IFACE,
+                                                              member='PropertiesChanged', path=path)
+        self.advertisements[(adapter_path, sender, path)] = advertisement
+        logger.info('[FAKE-BLUEZ] Advertisement %s%s registered on %s', sender, path, adapter_path)
+        self._adv_changed.set()
+        if self.on_advertisement is not None:
+            self.on_advertisement(advertisement)
+
+    def unregister_advertisement(self, adapter_path, sender, path):
+        advertisement = self.advertisements.pop((adapter_path, sender, path), None)
+        if advertisement is None:
+            raise gatt_wire.DBusError('org.bluez.Error.DoesNotExist', 'Advertisement not registered')
+        self.bus.remove_signal_receiver(advertisement.receiver)
+        self.unregistered += 1
+
+    async def wait_applications(self, count, timeout, adapter_path=None):
+        """
+        Wait until count applications are registered (on adapter_path when given), return them.
+
+        """
+        return await self._wait(self._app_changed, self.applications, count, timeout, adapter_path)
+
+    async def wait_application(self, timeout, adapter_path=None):
+        return (await self.wait_applications(1, timeout, adapter_path))[0]
+
+    async def wait_advertisements(self, count, timeout, adapter_path=None):
+        return await self._wait(self._adv_changed, self.advertisements, count, timeout, adapter_path)
+
+    async def wait_advertisement(self, timeout, adapter_path=None):
+        return (await self.wait_advertisements(1, timeout, adapter_path))[0]
+
+    async def _wait(self, event, registry, count, timeout, adapter_path):
+        deadline = time.monotonic() + timeout
+        while True:
+            found = [item for key, item in registry.items() if adapter_path is None or key[0] == adapter_path]
+            if len(found) >= count:
+                return found
+            event.clear()
+            await asyncio.wait_for(event.wait(), max(0.0, deadline - time.monotonic()))
+
+    # GATT client
+
+    async def read_value(self, application, path, offset=0):
+        return (await self.bus.call(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'ReadValue', 'a{sv}',
+                                    [self.client_options(application, offset=offset)]))[0]
+
+    async def write_value(self, application, path, value, write_type='request', offset=0):
+        await self.bus.call(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'WriteValue', 'aya{sv}',
+                            [value, self.client_options(application, offset=offset, type=write_type)])
+
+    def write_command(self, application, path, value):
+        """
+        Write without response, not waiting for the call to complete.
+
+        """
+        self.bus.call_async(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'WriteValue', 'aya{sv}',
+                            [value, self.client_options(application, offset=0, type='command')],
+                            error_handler=lambda error: logger.warning('[FAKE-BLUEZ] Write command failed: %s',
+                                                                        error))
+
+    async def start_notify(self, application, path, handler=None):
+        """
+        Subscribe through StartNotify and the PropertiesChanged signal, handler(device_path, path, value) is
+        optional. Like bluetoothd, StartNotify is called for the first device of an adapter and the signal is
+        delivered to every subscribed device. A value of a characteristic with the indicate flag is confirmed with
+        Confirm(), as bluetoothd does once the device acknowledged the indication.
+
+        """
+        adapter_path, device = application.adapter_path, application.device_path
+        if 'indicate' in application.properties(path)['Flags']:
+            self._indications[path] = application.sender
+        if handler is not None:
+            self.notify_handlers[(device, path)] = handler
+        subscribers = self._subscribers[path]
+        first = not any(entry[0] == adapter_path for entry in subscribers)
+        subscribers.add((adapter_path, device))
+        if path not in self._receivers:
+            self._receivers[path] = self.bus.add_signal_receiver(self._properties_changed, sender=application.sender,
+                                                                 interface=gatt_var.DBUS_PROP_IFACE,
+                                                                 member='PropertiesChanged', path=path)
+            # Make sure the match rule is in place before the first notification can be sent
+            await self.bus.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus.Peer',
+                                'Ping')
+        if first:
+            await self.bus.call(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'StartNotify')
+
+    async def stop_notify(self, application, path):
+        adapter_path, device = application.adapter_path, application.device_path
+        subscribers = self._subscribers[path]
+        subscribers.discard((adapter_path, device))
+        self.notify_handlers.pop((device, path), None)
+        if any(entry[0] == adapter_path for entry in subscribers):
+            return
+
+        await self.bus.call(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'StopNotify')
+        if not subscribers:
+            self._indications.pop(path, None)
+            receiver = self._receivers.pop(path, None)
+            if receiver is not None:
+                self.bus.remove_signal_receiver(receiver)
+
+    async def acquire_notify(self, application, path, handler=None):
+        """
+        Subscribe through AcquireNotify, notifications are read from the returned socket.
+
+        """
+        key = (application.device_path, path)
+        if handler is not None:
+            self.notify_handlers[key] = handler
+        fd, mtu = await self.bus.call(application.sender, path, gatt_var.GATT_CHRC_IFACE, 'AcquireNotify', 'a{sv}',
+                                      [self.client_options(application)])
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        self._acquired[key] = sock
+        self.bus.loop.add_reader(sock.fileno(), self._acquired_readable, key, sock, mtu)
+        return mtu
+
+    def release_notify(self, application, path):
+        self._release((application.device_path, path))
+
+    async def disconnect(self, application):
+        """
+        Disconnect the device of application: its subscriptions end and Device1.Connected turns false.
+
+        """
+        device = application.device_path
+        for key in [key for key in self._acquired if key[0] == device]:
+            self._release(key)
+        for path, subscribers in list(self._subscribers.items()):
+            if (application.adapter_path, device) in subscribers:
+                await self.stop_notify(application, path)
+        self.bus.emit_signal(device, gatt_var.DBUS_PROP_IFACE, 'PropertiesChanged', 'sa{sv}as',
+                             [gatt_var.DEVICE_IFACE, {'Connected': gatt_wire.Variant('b', False)}, []])
+
+    def _release(self, key):
+        sock = self._acquired.pop(key, None)
+        if sock is not None:
+            self.bus.loop.remove_reader(sock.fileno())
+            sock.close()
+        self.notify_handlers.pop(key, None)
+
+    def _acquired_readable(self, key, sock, mtu):
+        while True:
+            try:
+                value = sock.recv(mtu)
+            except BlockingIOError:
+                return
+            except OSError:
+                value = b''
+            if not value:
+                self._release(key)
+                return
+            self._notification(key, value)
+
+    def _properties_changed(self, message):
+        interface, changed = message.body[0], message.body[1]
+        if interface == gatt_var.GATT_CHRC_IFACE and 'Value' in changed:
+            sender = self._indications.get(message.path)
+            if sender is not None:
+                # Without a reply like bluetoothd, and sent before anything the value leads to
+                self.confirmed += 1
+                self.bus.send_message(gatt_wire.Message(gatt_wire.METHOD_CALL, path=message.path,
+                                                        interface=gatt_var.GATT_CHRC_IFACE, member='Confirm',
+                                                        destination=sender, flags=gatt_wire.NO_REPLY_EXPECTED))
+            for adapter_path, device in list(self._subscribers[message.path]):
+                self._notification((device, message.path), changed['Value'])
+
+    def _notification(self, key, value):
+        self.notifications[key] += 1
+        handler = self.notify_handlers.get(key)
+        if handler is not None:
+            handler(key[0], key[1], value)
+
+    def close(self):
+        for key in list(self._acquired):
+            self._release(key)
+        if self._owner_receiver is not None:
+            self.bus.remove_signal_receiver(self._owner_receiver)
+            self._owner_receiver = None
+
+
+class _ObjectManager(object):
+
+    def __init__(self, bluez):
+        self.bluez = bluez
+
+    @gatt_wire.method(gatt_var.DBUS_OM_IFACE, '', 'a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return self.bluez.get_managed_objects()
+
+
+class _Adapter(object):
+
+    def __init__(self, bluez, path):
+        self.bluez = bluez
+        self.path = path
+
+    @gatt_wire.method(gatt_var.DBUS_PROP_IFACE, 'ss', 'v')
+    def Get(self, interface, name):
+        properties = self.bluez.adapters[self.path]
+        if interface != gatt_var.ADAPTER_IFACE or name not in properties:
+            raise gatt_wire.DBusError('org.freedesktop.DBus.Error.InvalidArgs', name)
+        return properties[name]
+
+    @gatt_wire.method(gatt_var.DBUS_PROP_IFACE, 's', 'a{sv}')
+    def GetAll(self, interface):
+        if interface != gatt_var.ADAPTER_IFACE:
+            raise gatt_wire.DBusError('org.freedesktop.DBus.Error.InvalidArgs', interface)
+        return dict(self.bluez.adapters[self.path])
+
+    @gatt_wire.method(gatt_var.DBUS_PROP_IFACE, 'ssv', '')
+    def Set(self, interface, name, value):
+        properties = self.bluez.adapters[self.path]
+        if interface != gatt_var.ADAPTER_IFACE or name not in properties:
+            raise gatt_wire.DBusError('org.freedesktop.DBus.Error.InvalidArgs', name)
+        properties[name] = value
+        self.bluez.bus.emit_signal(self.path, gatt_var.DBUS_PROP_IFACE, 'PropertiesChanged', 'sa{sv}as',
+                                   [gatt_var.ADAPTER_IFACE, {name: value}, []])
+
+    @gatt_wire.method(gatt_var.GATT_MANAGER_IFACE, 'oa{sv}', '', sender_keyword='sender')
+    def RegisterApplication(self, application, options, sender=None):
+        return self.bluez.register_application(self.path, sender, application)
+
+    @gatt_wire.method(gatt_var.GATT_MANAGER_IFACE, 'o', '', sender_keyword='sender')
+    def UnregisterApplication(self, application, sender=None):
+        self.bluez.unregister_application(self.path, sender, application)
+
+    @gatt_wire.method(gatt_var.LE_ADVERTISING_MANAGER_IFACE, 'oa{sv}', '', sender_keyword='sender')
+    def RegisterAdvertisement(self, advertisement, options, sender=None):
+        return self.bluez.register_advertisement(self.path, sender, advertisement)
+
+    @gatt_wire.method(gatt_var.LE_ADVERTISING_MANAGER_IFACE, 'o', '', sender_keyword='sender')
+    def UnregisterAdvertisement(self, advertisement, sender=None):
+        self.bluez.unregister_advertisement(self.path, sender, advertisement)
@@ -0,0 +1,86 @@
+import shutil
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def bus_address():
+    """
+    Address of a private dbus-daemon, stopped after the test.
+
+    """
+    if shutil.which('dbus-daemon') is None:
+        pytest.skip('dbus-daemon is not installed')
+    import gatt_example.Gattbenchmark as gatt_bench
+
+    daemon, address = gatt_bench.start_private_bus()
+    yield address
+    daemon.terminate()
+    daemon.wait()
+
+
+@pytest.fixture
+def backend(bus_address):
+    """
+    The asyncio backend selected for the gatt_base objects, connected to the private bus as backend.bus.
+
+    """
+    import gatt_example.gatt_base.gatt_lib_backend as gatt_backend
+
+    previous = gatt_backend._backend
+    backend = gatt_backend.set_backend(gatt_backend.AsyncioBackend())
+    backend.bus = backend.connect_system_bus(bus_address)
+    yield backend
+    backend.bus.close()
+    backend.loop.run_until_complete(asyncio.sleep(0))
+    backend.loop.close()
+    gatt_backend.set_backend(previous)
+
+
+@pytest.fixture
+def application(backend):
+    """
+    The Gattserver application, created in the test process on the private bus.
+
+    """
+    import gatt_example.Gattserver as gatt_server
+
+    application = gatt_server.Application(backend.bus)
+    yield application
+    application.stop_notifications()
+
+
+@pytest.fixture
+def run_loop(backend):
+    """
+    Run the main loop of the backend for the seconds given.
+
+    """
+    def run(seconds):
+        backend.loop.run_until_complete(asyncio.sleep(seconds))
+    return run
+
+
+@pytest.fixture
+def fake_bluez(backend, bus_address):
+    """
+    Start a gatt_lib_fake_bluez.FakeBluez with the adapters given on its own connection to the private bus, on the
+    loop of the backend. Closed after the test unless the test closed it.
+
+    """
+    import gatt_example.gatt_base.gatt_lib_asyncio_bus as gatt_aio_bus
+    import gatt_example.gatt_testing.gatt_lib_fake_bluez as gatt_fake_bluez
+
+    started = []
+
+    def start(adapters=1):
+        bus = backend.loop.run_until_complete(gatt_aio_bus.AsyncioBus(bus_address, backend.loop).connect())
+        bluez = backend.loop.run_until_complete(gatt_fake_bluez.FakeBluez(bus, adapters).start())
+        started.append(bluez)
+        return bluez
+
+    yield start
+    for bluez in started:
+        bluez.close()
+        bluez.bus.close()
@@ -0,0 +1,106 @@
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_variables as gatt_var
+import gatt_example.gatt_base.gatt_lib_adapters as gatt_adapters
+import gatt_example.gatt_base.gatt_lib_registration as gatt_registration
+import gatt_example.Gattserver as gatt_server
+
+
+def wait_for(run_loop, condition, timeout=5.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        run_loop(0.01)
+    assert condition()
+
+
+@pytest.fixture
+def manager(backend):
+    events = []
+    manager = gatt_adapters.AdapterManager(backend.bus, gatt_var.GATT_MANAGER_IFACE,
+                                           lambda path: events.append(('added', path)),
+                                           lambda path: events.append(('removed', path)))
+    manager.events = events
+    yield manager
+    manager.stop()
+
+
+def test_adapters_found_and_powered(manager, fake_bluez, run_loop):
+    bluez = fake_bluez(adapters=3)
+    manager.start()
+    wait_for(run_loop, lambda: len(manager.ready) == 3)
+
+    assert sorted(manager.events) == [('added', path) for path in bluez.adapters]
+    assert all(properties['Powered'] for properties in bluez.adapters.values())
+
+
+def test_adapters_hot_added_and_removed(manager, fake_bluez, run_loop):
+    bluez = fake_bluez(adapters=1)
+    manager.start()
+    first = list(bluez.adapters)[0]
+    wait_for(run_loop, lambda: manager.ready == {first})
+
+    second = bluez.add_adapter()
+    wait_for(run_loop, lambda: manager.ready == {first, second})
+    bluez.remove_adapter(first)
+    wait_for(run_loop, lambda: manager.ready == {second})
+
+    assert manager.events == [('added', first), ('added', second), ('removed', first)]
+    assert list(manager.adapters) == [second]
+
+
+def test_powered_toggled(manager, fake_bluez, run_loop):
+    bluez = fake_bluez(adapters=2)
+    manager.start()
+    first, second = bluez.adapters
+    wait_for(run_loop, lambda: len(manager.ready) == 2)
+    del manager.events[:]
+
+    bluez.set_powered(first, False)
+    wait_for(run_loop, lambda: manager.ready == {second})
+    # Still there, only unusable
+    assert first in manager.adapters
+    bluez.set_powered(first, True)
+    wait_for(run_loop, lambda: manager.ready == {first, second})
+    assert manager.events == [('removed', first), ('added', first)]
+
+
+def test_application_registered_per_adapter(backend, application, fake_bluez, run_loop):
+    registrar = gatt_registration.Registrar(backend.bus, all_adapters=True)
+    gatt_server.add_application(registrar, application)
+    bluez = fake_bluez(adapters=2)
+    registrar.start()
+    clients = backend.loop.run_until_complete(bluez.wait_applications(2, 5))
+    assert sorted(client.adapter_path for client in clients) == list(bluez.adapters)
+
+    # A hot added adapter gets its own registration, a removed one takes its registration along
+    third = bluez.add_adapter()
+    backend.loop.run_until_complete(bluez.wait_application(5, third))
+    first = list(bluez.adapters)[0]
+    bluez.remove_adapter(first)
+    wait_for(run_loop, lambda: first not in registrar.serving)
+    assert sorted(key[0] for key in bluez.applications) == sorted(registrar.serving) == list(bluez.adapters)
+
+    # Powered off and on again, BlueZ kept the registration which is taken over
+    bluez.set_powered(third, False)
+    wait_for(run_loop, lambda: third not in registrar.serving)
+    bluez.set_powered(third, True)
+    wait_for(run_loop, lambda: registrar.serving.get(third) == len(registrar.registrations))
+    assert registrar.stats['failed'] == 0
+    registrar.stop()
+
+
+def test_single_adapter_fails_over(backend, application, fake_bluez, run_loop):
+    registrar = gatt_registration.Registrar(backend.bus)
+    gatt_server.add_application(registrar, application)
+    bluez = fake_bluez(adapters=2)
+    registrar.start()
+    first, second = bluez.adapters
+    client = backend.loop.run_until_complete(bluez.wait_application(5))
+    assert client.adapter_path == first
+    assert list(registrar.serving) == [first]
+
+    bluez.remove_adapter(first)
+    client = backend.loop.run_until_complete(bluez.wait_application(5, second))
+    assert list(registrar.serving) == [second]
+    registrar.stop()
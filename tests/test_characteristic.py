@@ -0,0 +1,169 @@
+import socket
+
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_metrics as gatt_metrics
+import gatt_example.gatt_base.gatt_lib_recorder as gatt_recorder
+import gatt_example.gatt_base.gatt_lib_service as gatt_service
+import gatt_example.gatt_base.gatt_lib_characteristic as gatt_char
+
+DEVICE = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+
+
+class EchoCharacteristic(gatt_char.Characteristic):
+    """
+    Write without response and notify over acquired sockets, keeping the values written.
+
+    """
+
+    acquire_notify = True
+    acquire_write = True
+
+    def __init__(self, bus, index, service):
+        gatt_char.Characteristic.__init__(self, bus, index, '12345678-1234-5678-1234-56789abcdef9',
+                                          ['write-without-response', 'notify'], service)
+        self.written = []
+        self.started = 0
+        self.stopped = 0
+
+    def WriteValue(self, value, options):
+        self.written.append((bytes(value), options))
+
+    def notify_started(self):
+        self.started += 1
+
+    def notify_stopped(self):
+        self.stopped += 1
+
+
+@pytest.fixture
+def chrc(application, backend):
+    service = gatt_service.Service(backend.bus, 9, '12345678-1234-5678-1234-56789abcdef0', True)
+    application.add_service(service)
+    chrc = EchoCharacteristic(backend.bus, 0, service)
+    service.add_characteristic(chrc)
+    return chrc
+
+
+def acquire(method, mtu=185, device=DEVICE):
+    fd, acquired_mtu = method({'device': device, 'mtu': mtu})
+    assert acquired_mtu == mtu
+    sock = socket.socket(fileno=fd.take())
+    sock.settimeout(1.0)
+    return sock
+
+
+def test_notify_socket_delivers_chunks(chrc, application):
+    sock = acquire(chrc.AcquireNotify)
+    assert chrc.notifying and chrc.started == 1
+    assert DEVICE in chrc.subscribers
+    assert application.sessions.sessions[DEVICE].mtu == 185
+
+    chrc._emit_chunk(b'\x01\x02\x03')
+    chrc._emit_value(bytes(range(200)))
+    # One packet per notification, the long value in MTU - 3 chunks
+    assert sock.recv(512) == b'\x01\x02\x03'
+    assert sock.recv(512) == bytes(range(182))
+    assert sock.recv(512) == bytes(range(182, 200))
+    assert application.sessions.sessions[DEVICE].notify_sent == 3
+    sock.close()
+
+
+def test_write_socket_reaches_write_value(chrc, run_loop):
+    sock = acquire(chrc.AcquireWrite)
+    sock.send(b'first')
+    sock.send(b'second')
+    run_loop(0.05)
+
+    assert [value for value, _ in chrc.written] == [b'first', b'second']
+    assert chrc.written[0][1] == {'type': 'command', 'offset': 0, 'mtu': 185, 'device': DEVICE}
+
+    # BlueZ closing its end releases the socket
+    sock.close()
+    run_loop(0.05)
+    assert DEVICE not in chrc._write_socks
+
+
+def test_hangup_releases_the_subscriber(chrc, application, run_loop):
+    notify = acquire(chrc.AcquireNotify)
+    write = acquire(chrc.AcquireWrite)
+    session = application.sessions.sessions[DEVICE]
+    assert session.characteristics[chrc.path] is chrc
+
+    notify.close()
+    run_loop(0.05)
+    assert DEVICE not in chrc.subscribers
+    assert not chrc.notifying and chrc.stopped == 1
+    # Still held by the write socket
+    assert session.characteristics[chrc.path] is chrc
+
+    write.close()
+    run_loop(0.05)
+    assert chrc.path not in session.characteristics
+
+
+def test_acquiring_again_replaces_the_socket(chrc, run_loop):
+    first = acquire(chrc.AcquireNotify)
+    second = acquire(chrc.AcquireNotify)
+    assert len(chrc.subscribers) == 1
+    chrc._emit_chunk(b'x')
+    assert second.recv(16) == b'x'
+    # The first one was closed on our side
+    assert first.recv(16) == b''
+    assert chrc.started == 1
+    second.close()
+    first.close()
+    run_loop(0.05)
+    assert not chrc.notifying
+
+
+def test_notification_recorded_once(chrc, tmp_path):
+    recorder = gatt_recorder.TrafficRecorder(str(tmp_path / 'recording'), 65536).start()
+    try:
+        first = acquire(chrc.AcquireNotify)
+        second = acquire(chrc.AcquireNotify, device='/org/bluez/hci0/dev_00_00_00_00_00_02')
+        chrc._emit_chunk(b'acquired')
+        chrc.StartNotify()
+        chrc._emit_chunk(b'acquired and signalled')
+    finally:
+        recorder.stop()
+
+    for sock in (first, second):
+        assert sock.recv(64) == b'acquired'
+        assert sock.recv(64) == b'acquired and signalled'
+    notifications = [event for event in gatt_recorder.read_events(recorder.path)
+                     if event.event == gatt_recorder.EVENT_PROPERTIES_CHANGED]
+    assert [(event.path, event.value) for event in notifications] == [(chrc.path, b'acquired'),
+                                                                       (chrc.path, b'acquired and signalled')]
+    first.close()
+    second.close()
+
+
+def test_static_value_replaced(application):
+    location = application.services[1].sensor_location
+    assert bytes(location.ReadValue({})) == b'\x0c'
+    location.set_location(7)
+    assert bytes(location.ReadValue({})) == b'\x07'
+
+    location.set_value('a longer value than one packet')
+    assert bytes(location.ReadValue({'offset': 2, 'mtu': 23})) == b'longer value than one '
+
+
+def test_new_subscriber_gets_an_unchanged_value(chrc):
+    chrc.notify_on_change = True
+    sent = gatt_metrics.NOTIFICATIONS_SENT.labels(chrc.path).value
+    first = acquire(chrc.AcquireNotify)
+    assert chrc.notify_value(b'same')
+    assert not chrc.notify_value(b'same')
+    assert chrc.notify_suppressed == gatt_metrics.NOTIFICATIONS_SUPPRESSED.labels(chrc.path).value == 1
+
+    # A second device, then a StartNotify subscriber, and the first device subscribing again
+    second = acquire(chrc.AcquireNotify, device='/org/bluez/hci0/dev_00_00_00_00_00_02')
+    assert chrc.notify_value(b'same')
+    chrc.StartNotify()
+    assert chrc.notify_value(b'same')
+    assert not chrc.notify_value(b'same')
+    first = acquire(chrc.AcquireNotify)
+    assert chrc.notify_value(b'same')
+    assert first.recv(16) == second.recv(16) == b'same'
+    assert chrc.notify_sent == gatt_metrics.NOTIFICATIONS_SENT.labels(chrc.path).value - sent == 4
@@ -0,0 +1,71 @@
+import socket
+
+import gatt_example.gatt_implementations.gatt_lib_custom_transport as gatt_transport
+
+
+class Device(object):
+    """
+    A central acquiring the notify socket of the custom characteristic and writing frames to it.
+
+    """
+
+    def __init__(self, chrc, address, mtu=185):
+        self.chrc = chrc
+        self.device = '/org/bluez/hci0/dev_' + address.replace(':', '_')
+        self.options = {'device': self.device, 'mtu': mtu}
+        self.replies = []
+        fd, _ = chrc.AcquireNotify(self.options)
+        self.sock = socket.socket(fileno=fd.take())
+        self.sock.setblocking(False)
+        self.transport = gatt_transport.FramedTransport(
+            lambda frame: chrc.WriteValue(bytes(frame), dict(self.options, type='command')), lambda: mtu - 3,
+            lambda opcode, request_id, payload: self.replies.append((opcode, request_id, bytes(payload))))
+
+    def receive(self):
+        while True:
+            try:
+                frame = self.sock.recv(512)
+            except BlockingIOError:
+                return
+            self.transport.receive_frame(frame)
+
+
+def test_devices_have_their_own_transport(application, run_loop):
+    chrc = application.services[2].get_characteristics()[0]
+    first = Device(chrc, '00:00:00:00:00:01')
+    second = Device(chrc, '00:00:00:00:00:02')
+    assert set(chrc.clients) == {first.device, second.device}
+
+    # Both start at sequence 0, a shared receiver would drop the frames of one as out of order
+    first.transport.send_message(gatt_transport.OPCODE_ECHO, 1, b'a' * 2000)
+    second.transport.send_message(gatt_transport.OPCODE_ECHO, 2, b'b' * 3000)
+    for _ in range(50):
+        run_loop(0.01)
+        first.receive()
+        second.receive()
+        first.transport.poll()
+        second.transport.poll()
+        if first.replies and second.replies:
+            break
+
+    response = gatt_transport.OPCODE_ECHO | gatt_transport.OPCODE_RESPONSE
+    assert first.replies == [(response, 1, b'a' * 2000)]
+    assert second.replies == [(response, 2, b'b' * 3000)]
+    assert chrc.clients[first.device].transport.out_of_order == 0
+    assert chrc.clients[second.device].transport.out_of_order == 0
+
+
+def test_client_state_reset_and_dropped(application):
+    chrc = application.services[2].get_characteristics()[0]
+    device = Device(chrc, '00:00:00:00:00:03')
+    device.transport.send_message(gatt_transport.OPCODE_ECHO, 1, b'x' * 1000)
+    transport = chrc.clients[device.device].transport
+    assert transport.frames_received
+
+    # Acquiring again starts the device over
+    Device(chrc, '00:00:00:00:00:03')
+    assert chrc.clients[device.device].transport._expected_seq == 0
+
+    application.sessions.close(device.device)
+    assert device.device not in chrc.clients
+    assert not chrc.notifying
@@ -0,0 +1,117 @@
+import random
+
+import pytest
+
+import gatt_example.gatt_implementations.gatt_lib_custom_transport as gatt_transport
+
+
+class LossyLink(object):
+    """
+    Frames between transports in flight in one queue, some lost and some overtaken by the next one.
+
+    """
+
+    def __init__(self, loss=0.0, reorder=0.0, seed=1):
+        self.random = random.Random(seed)
+        self.loss = loss
+        self.reorder = reorder
+        self.frames = []
+        self.lost = 0
+        self.reordered = 0
+
+    def sender(self, receiver):
+        def send(frame):
+            if self.random.random() < self.loss:
+                self.lost += 1
+            elif self.frames and self.random.random() < self.reorder:
+                self.reordered += 1
+                self.frames.insert(len(self.frames) - 1, (receiver, bytes(frame)))
+            else:
+                self.frames.append((receiver, bytes(frame)))
+        return send
+
+    def run(self, transports, max_steps=200000):
+        for _ in range(max_steps):
+            if self.frames:
+                receiver, frame = self.frames.pop(0)
+                receiver().receive_frame(frame)
+                continue
+            # Nothing in flight, whatever is still unacknowledged was lost and times out
+            if not any([transport.poll() for transport in transports]) and not self.frames:
+                return
+        raise AssertionError('Transfer did not complete')
+
+
+def connect(link, frame_size, window):
+    received = {'a': [], 'b': []}
+    transports = {}
+    for name, peer in (('a', 'b'), ('b', 'a')):
+        transports[name] = gatt_transport.FramedTransport(
+            link.sender(lambda peer=peer: transports[peer]), lambda: frame_size,
+            lambda opcode, request_id, payload, name=name: received[name].append((opcode, request_id, bytes(payload))),
+            window=window, retransmit_timeout=0.0)
+    return transports['a'], transports['b'], received
+
+
+@pytest.mark.parametrize('frame_size, window', [(20, 1), (182, 8), (509, 32)])
+def test_messages_arrive_intact_over_a_lossy_link(frame_size, window):
+    link = LossyLink(loss=0.1, reorder=0.1)
+    a, b, received = connect(link, frame_size, window)
+    payloads = [bytes(link.random.getrandbits(8) for _ in range(size)) for size in (4096, 12000, 1, 30000)]
+    for request_id, payload in enumerate(payloads):
+        a.send_message(gatt_transport.OPCODE_ECHO, request_id, payload)
+    b.send_message(gatt_transport.OPCODE_ECHO, 99, payloads[0][::-1])
+    link.run([a, b])
+
+    assert received['b'] == [(gatt_transport.OPCODE_ECHO, request_id, payload)
+                             for request_id, payload in enumerate(payloads)]
+    assert received['a'] == [(gatt_transport.OPCODE_ECHO, 99, payloads[0][::-1])]
+    assert link.lost and link.reordered
+    assert a.retransmissions and b.out_of_order
+    assert not a.receiving() and not b.receiving()
+
+
+def test_frames_of_a_lossless_link():
+    link = LossyLink()
+    a, b, received = connect(link, 182, 8)
+    a.send_message(gatt_transport.OPCODE_ECHO, 1, bytes(8000))
+    link.run([a, b])
+
+    # Message header and payload in segments of the frame size less the frame header
+    data_frames = -(-(gatt_transport.MESSAGE_HEADER.size + 8000) // (182 - gatt_transport.FRAME_HEADER.size))
+    assert received['b'] == [(gatt_transport.OPCODE_ECHO, 1, bytes(8000))]
+    assert b.frames_received == data_frames
+    assert a.retransmissions == 0 and b.out_of_order == 0
+    # Acknowledged every half window and at the end of the message
+    assert b.frames_sent == -(-data_frames // 4)
+
+
+def test_requests_answered_over_a_lossy_link():
+    link = LossyLink(loss=0.05, reorder=0.05, seed=2)
+    a, b, received = connect(link, 244, 8)
+    dispatcher = gatt_transport.RequestDispatcher()
+    dispatcher.register(gatt_transport.OPCODE_ECHO, bytes)
+    dispatcher.transport = b
+    b.on_message = dispatcher.on_message
+    payload = bytes(range(256)) * 20
+    a.send_message(gatt_transport.OPCODE_ECHO, 7, payload)
+    a.send_message(0x05, 8, b'?')
+    link.run([a, b])
+
+    assert received['a'] == [
+        (gatt_transport.OPCODE_ECHO | gatt_transport.OPCODE_RESPONSE, 7, payload),
+        (gatt_transport.OPCODE_ERROR, 8, bytes((0x05, gatt_transport.ERROR_UNKNOWN_OPCODE))),
+    ]
+
+
+def test_oversized_message_dropped():
+    link = LossyLink()
+    a, b, received = connect(link, 100, 8)
+    b.max_message = 1000
+    a.send_message(gatt_transport.OPCODE_ECHO, 1, bytes(5000))
+    a.send_message(gatt_transport.OPCODE_ECHO, 2, b'after')
+    link.run([a, b])
+
+    assert received['b'] == [(gatt_transport.OPCODE_ECHO, 2, b'after')]
+    with pytest.raises(ValueError):
+        gatt_transport.FramedTransport(lambda frame: None, lambda: 20, None, window=gatt_transport.MAX_WINDOW + 1)
@@ -0,0 +1,107 @@
+import struct
+
+import pytest
+
+import gatt_example.gatt_implementations.gatt_lib_cycling_power_encoder as gatt_cp_enc
+
+Encoder = gatt_cp_enc.CyclingPowerMeasurementEncoder
+
+
+def decode(value):
+    """
+    Cycling Power Measurement fields read back field by field, as a client does.
+
+    """
+    flags, power = struct.unpack_from('<Hh', value)
+    offset = 4
+    fields = {'instantaneous_power': power}
+
+    def take(fmt, *keys):
+        nonlocal offset
+        fields.update(zip(keys, struct.unpack_from('<' + fmt, value, offset)))
+        offset += struct.calcsize('<' + fmt)
+
+    if flags & Encoder.PEDAL_POWER_BALANCE_PRESENT:
+        take('B', 'pedal_power_balance')
+    if flags & Encoder.ACCUMULATED_TORQUE_PRESENT:
+        take('H', 'accumulated_torque')
+    if flags & Encoder.WHEEL_REVOLUTION_DATA_PRESENT:
+        take('IH', 'cumulative_wheel_revolutions', 'last_wheel_event_time')
+    if flags & Encoder.CRANK_REVOLUTION_DATA_PRESENT:
+        take('HH', 'cumulative_crank_revolutions', 'last_crank_event_time')
+    if flags & Encoder.EXTREME_FORCE_MAGNITUDES_PRESENT:
+        take('hh', 'maximum_force_magnitude', 'minimum_force_magnitude')
+    if flags & Encoder.EXTREME_TORQUE_MAGNITUDES_PRESENT:
+        take('hh', 'maximum_torque_magnitude', 'minimum_torque_magnitude')
+    if flags & Encoder.EXTREME_ANGLES_PRESENT:
+        # 12 bit maximum then 12 bit minimum in 3 bytes
+        angles = int.from_bytes(value[offset:offset + 3], 'little')
+        fields['maximum_angle'] = angles & 0xFFF
+        fields['minimum_angle'] = angles >> 12
+        offset += 3
+    if flags & Encoder.TOP_DEAD_SPOT_ANGLE_PRESENT:
+        take('H', 'top_dead_spot_angle')
+    if flags & Encoder.BOTTOM_DEAD_SPOT_ANGLE_PRESENT:
+        take('H', 'bottom_dead_spot_angle')
+    if flags & Encoder.ACCUMULATED_ENERGY_PRESENT:
+        take('H', 'accumulated_energy')
+    assert offset == len(value)
+    return flags, fields
+
+
+SAMPLE = {
+    'instantaneous_power': -300, 'pedal_power_balance': 101, 'accumulated_torque': 0xFFFF,
+    'cumulative_wheel_revolutions': 0xFFFFFFFF, 'last_wheel_event_time': 0xFFFE,
+    'cumulative_crank_revolutions': 0x8001, 'last_crank_event_time': 1,
+    'maximum_force_magnitude': 0x7FFF, 'minimum_force_magnitude': -0x8000,
+    'maximum_torque_magnitude': 1200, 'minimum_torque_magnitude': -100,
+    'maximum_angle': 95, 'minimum_angle': 275, 'top_dead_spot_angle': 10, 'bottom_dead_spot_angle': 190,
+    'accumulated_energy': 42,
+}
+ALL_FLAGS = sum(flag for flag, _, _ in Encoder.FIELDS)
+
+
+@pytest.mark.parametrize('flags', [
+    0,
+    Encoder.PEDAL_POWER_BALANCE_PRESENT | Encoder.PEDAL_POWER_BALANCE_REFERENCE,
+    Encoder.ACCUMULATED_TORQUE_PRESENT | Encoder.ACCUMULATED_TORQUE_SOURCE,
+    Encoder.WHEEL_REVOLUTION_DATA_PRESENT | Encoder.CRANK_REVOLUTION_DATA_PRESENT,
+    Encoder.EXTREME_FORCE_MAGNITUDES_PRESENT | Encoder.EXTREME_ANGLES_PRESENT,
+    Encoder.EXTREME_TORQUE_MAGNITUDES_PRESENT | Encoder.TOP_DEAD_SPOT_ANGLE_PRESENT |
+    Encoder.BOTTOM_DEAD_SPOT_ANGLE_PRESENT | Encoder.OFFSET_COMPENSATION_INDICATOR,
+    Encoder.ACCUMULATED_ENERGY_PRESENT | Encoder.EXTREME_ANGLES_PRESENT,
+    ALL_FLAGS,
+])
+def test_encoded_fields_decode(flags):
+    encoder = Encoder()
+    value = encoder.encode(flags, SAMPLE)
+    decoded_flags, fields = decode(value)
+
+    assert decoded_flags == flags
+    assert len(value) == encoder.frame_size(flags)
+    assert fields == dict((key, SAMPLE[key]) for key in fields)
+    # Nothing but the fields of the flags
+    assert len(fields) == 1 + sum(len(keys) for flag, _, keys in Encoder.FIELDS if flags & flag)
+
+
+@pytest.mark.parametrize('maximum, minimum', [(0, 0), (0xFFF, 0), (0, 0xFFF), (0xFFF, 0xFFF), (359, 180)])
+def test_extreme_angles(maximum, minimum):
+    flags = Encoder.EXTREME_ANGLES_PRESENT | Encoder.ACCUMULATED_ENERGY_PRESENT
+    value = Encoder().encode(flags, dict(SAMPLE, maximum_angle=maximum, minimum_angle=minimum))
+
+    assert len(value) == 4 + 3 + 2
+    _, fields = decode(value)
+    assert (fields['maximum_angle'], fields['minimum_angle']) == (maximum, minimum)
+    # The field after the 24 bits is where it should be
+    assert fields['accumulated_energy'] == SAMPLE['accumulated_energy']
+
+
+def test_extreme_angles_wrapped_to_12_bits():
+    value = Encoder().encode(Encoder.EXTREME_ANGLES_PRESENT, dict(SAMPLE, maximum_angle=0x1001, minimum_angle=-1))
+    _, fields = decode(value)
+    assert (fields['maximum_angle'], fields['minimum_angle']) == (1, 0xFFF)
+
+
+def test_out_of_range_value_raises():
+    with pytest.raises(struct.error):
+        Encoder().encode(Encoder.CRANK_REVOLUTION_DATA_PRESENT, dict(SAMPLE, cumulative_crank_revolutions=0x10000))
@@ -0,0 +1,52 @@
+import logging
+import argparse
+
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_logging as gatt_log
+# Register the metrics and recorder subsystems
+import gatt_example.gatt_base.gatt_lib_metrics  # noqa: F401
+import gatt_example.gatt_base.gatt_lib_recorder  # noqa: F401
+
+
+def parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-L", "--log-level", action="append", default=[], type=gatt_log.level_override)
+    return parser
+
+
+def test_overrides_parsed():
+    args = parser().parse_args(['-L', 'metrics=debug', '-L', 'recorder=WARNING'])
+    assert gatt_log.parse_level_overrides(args.log_level) == {'metrics': logging.DEBUG,
+                                                             'recorder': logging.WARNING}
+    assert gatt_log.parse_level_overrides(['recorder=ERROR']) == {'recorder': logging.ERROR}
+
+
+@pytest.mark.parametrize('override, message', [
+    ('metrics=BAR', 'Unknown log level'),
+    ('metrics', 'SUBSYSTEM=LEVEL'),
+    ('metrics=', 'Unknown log level'),
+    ('=INFO', 'SUBSYSTEM=LEVEL'),
+    ('metrics=Level 5', 'Unknown log level'),
+    ('metrcs=DEBUG', 'Unknown subsystem'),
+])
+def test_bad_override_is_a_usage_error(override, message, capsys):
+    with pytest.raises(SystemExit) as error:
+        parser().parse_args(['-L', override])
+    assert error.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+def test_bad_override_raises():
+    with pytest.raises(argparse.ArgumentTypeError):
+        gatt_log.parse_level_overrides(['metrics=BAR'])
+    with pytest.raises(argparse.ArgumentTypeError):
+        gatt_log.parse_level_overrides(['cyclng_power=DEBUG'])
+
+
+def test_overrides_applied():
+    gatt_log.get_logger('test_subsystem')
+    gatt_log.configure_levels(logging.INFO, gatt_log.parse_level_overrides(['test_subsystem=DEBUG']))
+    assert gatt_log.get_logger('test_subsystem').isEnabledFor(logging.DEBUG)
+    assert not gatt_log.get_logger('other_subsystem').isEnabledFor(logging.DEBUG)
+    gatt_log.get_logger('test_subsystem').setLevel(logging.NOTSET)
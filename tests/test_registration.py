@@ -0,0 +1,75 @@
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_registration as gatt_registration
+import gatt_example.Gattserver as gatt_server
+
+CP_MEASUREMENT_UUID = '00002A63'
+CUSTOM_UUID = '31842D98'
+
+
+@pytest.fixture
+def registrar(backend, application):
+    registrar = gatt_registration.Registrar(backend.bus)
+    gatt_server.add_application(registrar, application)
+    yield registrar
+    registrar.stop()
+
+
+def characteristic(application, uuid):
+    for service in application.services:
+        for chrc in service.get_characteristics():
+            if chrc.uuid.upper().startswith(uuid):
+                return chrc
+
+
+def find_path(client, uuid):
+    return [path for path in client.characteristics() if client.uuid(path).upper().startswith(uuid)][0]
+
+
+def test_bluez_restart_drops_subscriptions(backend, application, registrar, fake_bluez):
+    bluez = fake_bluez()
+    registrar.start()
+    client = backend.loop.run_until_complete(bluez.wait_application(5))
+    measurement = characteristic(application, CP_MEASUREMENT_UUID)
+    custom = characteristic(application, CUSTOM_UUID)
+    backend.loop.run_until_complete(bluez.start_notify(client, find_path(client, CP_MEASUREMENT_UUID)))
+    backend.loop.run_until_complete(bluez.acquire_notify(client, find_path(client, CUSTOM_UUID)))
+    assert measurement.notifying and custom.notifying
+
+    # bluetoothd goes away without StopNotify or closing its end of the acquired socket
+    bluez.close()
+    bluez.bus.close()
+    bluez = fake_bluez()
+    client = backend.loop.run_until_complete(bluez.wait_application(5))
+    assert not measurement.notifying and measurement.get_notify_stats()['signal_subscribers'] == 0
+    assert not custom.notifying and not custom.subscribers
+    assert not application.sessions.sessions
+
+    # The new bluetoothd subscribes again, one StopNotify ends it
+    path = find_path(client, CP_MEASUREMENT_UUID)
+    backend.loop.run_until_complete(bluez.start_notify(client, path))
+    assert measurement.get_notify_stats()['signal_subscribers'] == 1
+    backend.loop.run_until_complete(bluez.stop_notify(client, path))
+    assert not measurement.notifying
+
+
+def test_lost_adapter_releases_its_devices(backend, application, fake_bluez, run_loop):
+    registrar = gatt_registration.Registrar(backend.bus, all_adapters=True)
+    gatt_server.add_application(registrar, application)
+    bluez = fake_bluez(adapters=2)
+    registrar.start()
+    first, second = backend.loop.run_until_complete(bluez.wait_applications(2, 5))
+    custom = characteristic(application, CUSTOM_UUID)
+    for client in (first, second):
+        backend.loop.run_until_complete(bluez.acquire_notify(client, find_path(client, CUSTOM_UUID)))
+    assert len(custom.subscribers) == 2
+
+    bluez.set_powered(first.adapter_path, False)
+    backend.loop.run_until_complete(bluez.wait_applications(1, 5, second.adapter_path))
+    for _ in range(20):
+        if len(custom.subscribers) == 1:
+            break
+        run_loop(0.01)
+    assert list(custom.subscribers) == [second.device_path]
+    assert custom.notifying
+    registrar.stop()
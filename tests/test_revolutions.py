@@ -0,0 +1,114 @@
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+import gatt_example.gatt_implementations.gatt_lib_revolutions as gatt_revolutions
+
+CRANK_MASK = (1 << gatt_revolutions.CRANK_REVOLUTION_BITS) - 1
+WHEEL_MASK = (1 << gatt_revolutions.WHEEL_REVOLUTION_BITS) - 1
+
+
+def test_crank_wraps_at_high_cadence():
+    # 240 rpm sampled four times a revolution, the angle passes 0 halfway between two samples. The timestamps are
+    # binary fractions so the expected event times are exact.
+    ingest = gatt_revolutions.RevolutionIngest(lambda: None)
+    interval = 0.0625
+    start = 1000.0
+    revolutions = 70000
+    values = []
+    for index in range(revolutions * 4 + 1):
+        ingest.ingest(start + index * interval, 45.0 + 90.0 * (index % 4), 0)
+        if index % 4 == 0:
+            values.append((ingest.crank.cumulative(gatt_revolutions.CRANK_REVOLUTION_BITS),
+                           ingest.crank.event_time(gatt_revolutions.EVENT_TIME_1024)))
+
+    assert ingest.crank.revolutions == revolutions
+    assert values[-1][0] == revolutions & CRANK_MASK
+    assert values[-1][1] == int((start + revolutions * 0.25 - interval / 2) * 1024) & gatt_revolutions.EVENT_TIME_MASK
+    # The counts wrapped at 16 bits more than once, the event times every 64 s, and a client differencing two
+    # consecutive values always finds one revolution in 256/1024 s
+    for (count, event_time), (next_count, next_event_time) in zip(values[1:], values[2:]):
+        assert (next_count - count) & CRANK_MASK == 1
+        assert (next_event_time - event_time) & gatt_revolutions.EVENT_TIME_MASK == 256
+    assert sum(1 for (count, _), (next_count, _) in zip(values, values[1:]) if next_count < count) == 1
+
+
+def test_wheel_wraps_at_32_bits():
+    ingest = gatt_revolutions.RevolutionIngest(lambda: None)
+    ingest.wheel.set_revolutions(WHEEL_MASK - 10)
+    interval = 0.015625
+    counter = 500
+    ingest.ingest(0.0, 0.0, counter)
+    previous = ingest.wheel.event_time(gatt_revolutions.EVENT_TIME_2048)
+    for index in range(1, 20):
+        # A wheel at 11520 rpm, three revolutions between two samples
+        counter += 3
+        ingest.ingest(index * interval, 0.0, counter)
+        cumulative = ingest.wheel.cumulative(gatt_revolutions.WHEEL_REVOLUTION_BITS)
+        assert cumulative == (WHEEL_MASK - 10 + 3 * index) & WHEEL_MASK
+        event_time = ingest.wheel.event_time(gatt_revolutions.EVENT_TIME_2048)
+        assert (event_time - previous) & gatt_revolutions.EVENT_TIME_MASK == 32
+        previous = event_time
+    assert ingest.wheel.cumulative(gatt_revolutions.WHEEL_REVOLUTION_BITS) < 100
+
+    # A restarted producer counts from its new value
+    ingest.ingest(1.0, 0.0, 0)
+    ingest.ingest(1.5, 0.0, 2)
+    assert ingest.wheel.revolutions == WHEEL_MASK - 10 + 3 * 19 + 2
+
+
+@pytest.mark.parametrize('before, after, interval, edge', [
+    ((350.0, 1.0), (10.0, 1.1), 0.1, 1.05),
+    ((300.0, 2.0), (60.0, 2.12), 0.12, 2.06),
+    ((359.0, 3.0), (0.0, 3.01), 0.01, 3.01),
+])
+def test_angle_wrap_interpolation(before, after, interval, edge):
+    ingest = gatt_revolutions.RevolutionIngest(lambda: None)
+    ingest.ingest(before[1] - interval, before[0] - 30.0, 0)
+    ingest.ingest(before[1], before[0], 0)
+    assert ingest.crank.revolutions == 0
+    ingest.ingest(after[1], after[0], 0)
+    assert ingest.crank.revolutions == 1
+    assert ingest.crank.last_event == pytest.approx(edge)
+
+
+def test_vector_and_measurement_share_the_revolutions(application, tmp_path):
+    path = str(tmp_path / 'ring')
+    writer = gatt_ring.SampleRingWriter(path, capacity=64)
+    application.revolutions = gatt_revolutions.RevolutionIngest(lambda: gatt_ring.SampleRingReader(path))
+    application.revolutions.poll()
+    measurement = application.services[1].get_characteristics()[0]
+    vector = application.services[1].get_characteristics()[3]
+
+    for index in range(40):
+        writer.write([150.0, 200.0, (index * 45.0) % 360.0, 0.0], 10.0 + index * 0.0625)
+    vector.send_vector([100, 200, 300], 0.0)
+    measurement.power_msrmt_cb()
+
+    assert vector.sample['cumulative_crank_revolutions'] == measurement.sample['cumulative_crank_revolutions'] == 4
+    assert vector.sample['last_crank_event_time'] == measurement.sample['last_crank_event_time']
+    writer.close()
+
+
+def test_measurement_sent_on_new_revolutions_only(application, tmp_path):
+    path = str(tmp_path / 'ring')
+    writer = gatt_ring.SampleRingWriter(path, capacity=64)
+    application.revolutions = gatt_revolutions.RevolutionIngest(lambda: gatt_ring.SampleRingReader(path))
+    application.revolutions.poll()
+    measurement = application.services[1].get_characteristics()[0]
+    measurement.sample_reader = gatt_ring.SampleRingReader(path)
+
+    def pedal(first, angles, power=150.0):
+        for index, angle in enumerate(angles):
+            writer.write([power, 200.0, angle, 0.0], 10.0 + (first + index) * 0.0625)
+        measurement.power_msrmt_cb()
+
+    pedal(0, [0.0, 90.0, 180.0, 270.0, 0.0])
+    assert measurement.notify_sent == 1
+    # Stopped at the same power, nothing new to send until the heartbeat
+    pedal(5, [0.0, 0.0])
+    assert (measurement.notify_sent, measurement.notify_suppressed) == (1, 1)
+    pedal(7, [90.0, 180.0, 270.0, 0.0])
+    assert measurement.notify_sent == 2
+    pedal(11, [0.0], power=180.0)
+    assert measurement.notify_sent == 3
+    writer.close()
@@ -0,0 +1,107 @@
+import os
+import sys
+import math
+import time
+import subprocess
+
+import gatt_example.gatt_base.gatt_lib_sample_ring as gatt_ring
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_latest_gives_up_on_a_torn_record(tmp_path):
+    path = str(tmp_path / 'ring')
+    writer = gatt_ring.SampleRingWriter(path, capacity=8)
+    reader = gatt_ring.SampleRingReader(path)
+    writer.write([1.0, 2.0, 3.0, 4.0], 10.0)
+    assert reader.latest().values == (1.0, 2.0, 3.0, 4.0)
+
+    # A producer that died writing the next record after publishing it: the trailing sequence never came
+    record = gatt_ring._record_struct(writer.channels)
+    record.pack_into(writer._mm, gatt_ring.HEADER_SIZE + record.size, 2, 11.0, 5.0, 6.0, 7.0, 8.0, 0)
+    gatt_ring.WRITE_SEQ_STRUCT.pack_into(writer._mm, gatt_ring.WRITE_SEQ_OFFSET, 2)
+
+    sample = reader.latest()
+    assert sample.seq == 1
+    assert reader.overruns == gatt_ring.MAX_READ_ATTEMPTS
+
+    fresh = gatt_ring.SampleRingReader(path)
+    assert fresh.latest() is None
+    reader.close()
+    fresh.close()
+    writer.close()
+
+
+def test_producer_throughput(tmp_path):
+    path = str(tmp_path / 'ring')
+    rate = 2000.0
+    cadence = 90.0
+    env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    producer = subprocess.Popen([sys.executable, '-m', 'gatt_example.Sampleproducer', path, '-r', str(rate), '-d',
+                                 '3', '--cadence', str(cadence)], env=env, stdout=subprocess.DEVNULL)
+    try:
+        reader = None
+        deadline = time.monotonic() + 10
+        while reader is None:
+            try:
+                reader = gatt_ring.SampleRingReader(path)
+            except (OSError, ValueError):
+                assert time.monotonic() < deadline, 'The producer did not create the ring'
+                time.sleep(0.01)
+        while reader.write_seq() == 0:
+            time.sleep(0.001)
+        reader.read_new()
+
+        samples = []
+        start_seq = reader.write_seq()
+        start = time.monotonic()
+        while time.monotonic() - start < 1.0:
+            samples.extend(reader.read_new())
+            time.sleep(0.005)
+        elapsed = time.monotonic() - start
+        written = reader.write_seq() - start_seq
+        samples.extend(reader.read_new())
+    finally:
+        producer.kill()
+        producer.wait()
+
+    assert reader.overruns == 0
+    # In order and none missing
+    assert [sample.seq for sample in samples] == list(range(start_seq + 1, start_seq + 1 + len(samples)))
+    assert len(samples) >= written
+    # Every record as the producer wrote it: the force is the one of the crank angle of the same record
+    for sample in samples:
+        angle = sample.values[gatt_ring.CHANNEL_CRANK_ANGLE]
+        assert sample.values[gatt_ring.CHANNEL_FORCE] == 150.0 + 250.0 * math.sin(math.radians(angle))
+    assert written / elapsed > 0.9 * rate
+    reader.close()
+
+
+def test_reader_follows_a_restarted_producer(tmp_path):
+    path = str(tmp_path / 'ring')
+    writer = gatt_ring.SampleRingWriter(path, capacity=8)
+    reader = gatt_ring.SampleRingReader(path)
+    for index in range(3):
+        writer.write([float(index), 0.0, 0.0, 0.0])
+    assert [sample.seq for sample in reader.read_new()] == [1, 2, 3]
+    writer.close()
+
+    # A larger ring replaces the file, the reader keeps the old mapping until it has nothing new
+    writer = gatt_ring.SampleRingWriter(path, capacity=64)
+    assert os.listdir(str(tmp_path)) == ['ring']
+    for index in range(20):
+        writer.write([100.0 + index, 0.0, 0.0, 0.0])
+    samples = reader.read_new()
+    assert reader.capacity == 64
+    assert [sample.seq for sample in samples] == list(range(1, 21))
+    assert samples[-1].values[gatt_ring.CHANNEL_POWER] == 119.0
+    assert reader.overruns == 0
+
+    writer.write([200.0, 0.0, 0.0, 0.0])
+    assert reader.latest().values[gatt_ring.CHANNEL_POWER] == 200.0
+    writer.close()
+    writer = gatt_ring.SampleRingWriter(path, capacity=8)
+    writer.write([300.0, 0.0, 0.0, 0.0])
+    assert reader.latest().values[gatt_ring.CHANNEL_POWER] == 300.0
+    writer.close()
+    reader.close()
@@ -0,0 +1,19 @@
+import logging
+
+import gatt_example.gatt_base.gatt_lib_scheduler as gatt_sched
+
+
+def test_stats_logged_when_jobs_end(backend, run_loop, caplog):
+    scheduler = gatt_sched.NotificationScheduler()
+    runs = []
+    job_id = scheduler.add(20, lambda: runs.append(1), 'fast')
+    scheduler.add(1000, lambda: None, 'slow')
+    with caplog.at_level(logging.INFO, logger='rotating.logger.scheduler'):
+        run_loop(0.2)
+        assert scheduler.cancel(job_id)
+        scheduler.stop()
+
+    assert len(runs) >= 5
+    cancelled, stopped = [record.getMessage() for record in caplog.records]
+    assert cancelled.startswith('[SCHEDULER] Job fast cancelled') and "'runs': %d" % len(runs) in cancelled
+    assert stopped.startswith('[SCHEDULER] Stopping 1 jobs, 0 missed deadlines') and "'slow'" in stopped
@@ -0,0 +1,73 @@
+import pytest
+
+import gatt_example.gatt_base.gatt_lib_exceptions as gatt_except
+import gatt_example.gatt_base.gatt_lib_write_assembler as gatt_assembler
+
+FIRST = '/org/bluez/hci0/dev_00_00_00_00_00_01'
+SECOND = '/org/bluez/hci0/dev_00_00_00_00_00_02'
+
+
+@pytest.fixture
+def assembler(backend):
+    payloads = []
+    assembler = gatt_assembler.WriteAssembler(lambda device, payload: payloads.append((device, payload)),
+                                              max_payload=8192, initial_size=64, max_devices=2, commit_delay_ms=5)
+    assembler.received = payloads
+    return assembler
+
+
+def write_long(assembler, device, payload, chunk=18):
+    for offset in range(0, len(payload), chunk):
+        assembler.write(payload[offset:offset + chunk], {'device': device, 'offset': offset, 'type': 'reliable'})
+
+
+def test_single_write_is_a_payload(assembler):
+    assembler.write(b'abc', {'device': FIRST, 'type': 'command'})
+    assert assembler.received == [(FIRST, b'abc')]
+
+
+def test_offset_writes_reassembled(assembler, run_loop):
+    first = bytes(range(256)) * 20
+    second = b'x' * 700
+    # Interleaved, each device has its own buffer
+    for offset in range(0, len(first), 18):
+        assembler.write(first[offset:offset + 18], {'device': FIRST, 'offset': offset, 'type': 'reliable'})
+        if offset < len(second):
+            assembler.write(second[offset:offset + 18], {'device': SECOND, 'offset': offset, 'type': 'reliable'})
+    assert assembler.received == []
+    run_loop(0.05)
+
+    assert sorted(assembler.received) == [(FIRST, first), (SECOND, second)]
+    assert assembler.dropped == 0
+
+
+def test_gap_dropped(assembler, run_loop):
+    assembler.write(b'a' * 18, {'device': FIRST, 'offset': 0, 'type': 'reliable'})
+    with pytest.raises(gatt_except.InvalidOffsetException):
+        assembler.write(b'b' * 18, {'device': FIRST, 'offset': 36, 'type': 'reliable'})
+    run_loop(0.05)
+    assert assembler.received == []
+    assert assembler.dropped == 1
+
+
+def test_max_payload_enforced(assembler, run_loop):
+    with pytest.raises(gatt_except.InvalidValueLengthException):
+        write_long(assembler, FIRST, bytes(8193), chunk=512)
+    run_loop(0.05)
+    assert assembler.received == []
+    assert assembler.dropped == 1
+
+    # The next sequence starts over
+    write_long(assembler, FIRST, bytes(8192), chunk=512)
+    run_loop(0.05)
+    assert assembler.received == [(FIRST, bytes(8192))]
+
+
+def test_idle_buffer_released_first(assembler, run_loop):
+    write_long(assembler, FIRST, b'1' * 40)
+    run_loop(0.05)
+    write_long(assembler, SECOND, b'2' * 40)
+    write_long(assembler, '/org/bluez/hci0/dev_00_00_00_00_00_03', b'3' * 40)
+    run_loop(0.05)
+    assert [payload for _, payload in assembler.received] == [b'1' * 40, b'2' * 40, b'3' * 40]
+    assert assembler.dropped == 0